@@ -0,0 +1,231 @@
+import os
+import time
+from collections import deque
+
+from write_cost import WRITE_OPS, record_writes
+from partial_index import tally_constants
+from query_shape import pipeline_hash, shape_hash
+from workload_ingest import aggregates_to_results, filter_slow_ops, follow_profile, parse_log_lines, parse_profile_entries
+
+DECAYED_COUNTERS = ["count", "total_duration_ms", "docs_examined", "keys_examined", "n_returned"]
+
+
+def decay_factor(elapsed_s, half_life_s):
+    return 0.5 ** (max(elapsed_s, 0) / half_life_s) if half_life_s else 1.0
+
+
+def decay_write_mixes(write_mixes, factor):
+    """Age observed write counts in place so write costs follow the same time horizon as the reads"""
+    for write_mix in write_mixes.values():
+        for op_type in WRITE_OPS:
+            write_mix[op_type] *= factor
+        for field in write_mix["update_fields"]:
+            write_mix["update_fields"][field] *= factor
+
+
+class DecayedShapeStats:
+    """Per-shape aggregates in the aggregate_ops format whose counters decay exponentially with age
+
+    Durations are kept in a sliding window of the most recent executions. Memory is bounded by max_shapes: the shape
+    with the lowest decayed weight is evicted to make room, and shapes that have decayed below min_weight are pruned.
+    """
+
+    def __init__(self, half_life_s=3600, max_shapes=10000, window_size=256, min_weight=0.05):
+        self.half_life_s = half_life_s
+        self.max_shapes = max_shapes
+        self.window_size = window_size
+        self.min_weight = min_weight
+        self.aggregates = {}
+        self.evicted = 0
+
+    def weight(self, aggregate, now):
+        return aggregate["count"] * decay_factor(now - aggregate["updated_at"], self.half_life_s)
+
+    def _decay(self, aggregate, now):
+        factor = decay_factor(now - aggregate["updated_at"], self.half_life_s)
+        if factor < 1:
+            for counter in DECAYED_COUNTERS:
+                aggregate[counter] *= factor
+            for plan_summary in aggregate["plan_summaries"]:
+                aggregate["plan_summaries"][plan_summary] *= factor
+            for constant in aggregate["constants"].values():
+                constant["count"] *= factor
+
+        aggregate["updated_at"] = now
+
+    def _evict_coldest(self, now):
+        coldest = min(self.aggregates, key=lambda key: self.weight(self.aggregates[key], now))
+        del self.aggregates[coldest]
+        self.evicted += 1
+
+    def add(self, op, now=None):
+        now = time.time() if now is None else now
+        fingerprint = pipeline_hash(op["pipeline"]) if op.get("pipeline") else shape_hash(op.get("filter"), op.get("sort"), op.get("projection"))
+        key = (op.get("collection", ""), fingerprint)
+        aggregate = self.aggregates.get(key)
+
+        if aggregate is None:
+            if len(self.aggregates) >= self.max_shapes:
+                self._evict_coldest(now)
+
+            aggregate = {"collection": op.get("collection", ""), "op": op.get("op"), "source": op.get("source"), "example": op, "count": 0, "total_duration_ms": 0, "reservoir": deque(maxlen=self.window_size), "docs_examined": 0, "keys_examined": 0, "n_returned": 0, "plan_summaries": {}, "has_sort_stage": False, "constants": {}, "updated_at": now}
+            self.aggregates[key] = aggregate
+
+        self._decay(aggregate, now)
+        duration_ms = op.get("duration_ms", 0)
+        aggregate["example"] = op
+        aggregate["count"] += 1
+        aggregate["total_duration_ms"] += duration_ms
+        aggregate["reservoir"].append(duration_ms)
+        tally_constants(aggregate["constants"], op.get("filter"))
+        aggregate["docs_examined"] += op.get("docs_examined", 0) or 0
+        aggregate["keys_examined"] += op.get("keys_examined", 0) or 0
+        aggregate["n_returned"] += op.get("n_returned", 0) or 0
+        aggregate["has_sort_stage"] = aggregate["has_sort_stage"] or bool(op.get("has_sort_stage"))
+
+        plan_summary = op.get("plan_summary", "")
+        aggregate["plan_summaries"][plan_summary] = aggregate["plan_summaries"].get(plan_summary, 0) + 1
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        for key in [key for key, aggregate in self.aggregates.items() if self.weight(aggregate, now) < self.min_weight]:
+            del self.aggregates[key]
+
+    def snapshot(self, now=None):
+        """Aggregates decayed to now, in the shape aggregates_to_results expects"""
+        now = time.time() if now is None else now
+        for aggregate in self.aggregates.values():
+            self._decay(aggregate, now)
+
+        return {"aggregates": dict(self.aggregates), "overflow": self.evicted}
+
+
+class LogTail:
+    """Return the complete lines appended to a mongod log since the previous read, starting over after a rotation"""
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+
+        if not from_start and os.path.exists(path):
+            stat = os.stat(path)
+            self.inode = stat.st_ino
+            self.offset = stat.st_size
+
+    def read_lines(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.inode = stat.st_ino
+            self.offset = 0
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        # A partially written last line is left for the next read
+        complete = data.rfind(b"\n") + 1
+        self.offset += complete
+        return data[:complete].decode("utf-8", errors="replace").splitlines()
+
+
+class OnlineAdvisor:
+    """Long-running advisor that folds new profiler or log traffic into decayed shape statistics on an interval
+
+    Recommendations are recomputed every interval but only emitted when the top_n ranking changes materially: an
+    index enters or leaves it, or its net benefit moves by more than change_ratio.
+    """
+
+    def __init__(self, recommender, log_path=None, interval_s=60, half_life_s=3600, max_shapes=10000, slow_ms=0, op_types=("find", "aggregate"), top_n=10, change_ratio=0.25):
+        self.recommender = recommender
+        self.log_tail = LogTail(log_path) if log_path else None
+        self.interval_s = interval_s
+        self.half_life_s = half_life_s
+        self.slow_ms = slow_ms
+        self.op_types = op_types
+        self.top_n = top_n
+        self.change_ratio = change_ratio
+        self.stats = DecayedShapeStats(half_life_s, max_shapes)
+        self.ranking = None
+        self.last_profile_ts = None
+        self.last_poll = None
+
+    def _profile_entries(self):
+        for entry in follow_profile(self.recommender.db_queries, since=self.last_profile_ts, tailable=False):
+            self.last_profile_ts = entry.get("ts", self.last_profile_ts)
+            yield entry
+
+    def new_ops(self):
+        if self.log_tail:
+            return parse_log_lines(self.log_tail.read_lines())
+
+        return parse_profile_entries(self._profile_entries())
+
+    def poll(self, now=None):
+        """Fold operations that arrived since the previous poll into the statistics; returns how many were read"""
+        now = time.time() if now is None else now
+        if self.last_poll is not None:
+            decay_write_mixes(self.recommender.write_mixes, decay_factor(now - self.last_poll, self.half_life_s))
+        self.last_poll = now
+
+        ingested = 0
+        for op in filter_slow_ops(record_writes(self.new_ops(), self.recommender.write_mixes), self.slow_ms, self.op_types):
+            self.stats.add(op, now)
+            ingested += 1
+
+        self.stats.prune(now)
+        return ingested
+
+    def _ranking(self, recommendations):
+        return [((rec["collection"], tuple(tuple(key) for key in rec["index_spec"])), rec.get("net_benefit_ms", 0)) for rec in recommendations[: self.top_n]]
+
+    def ranking_changed(self, ranking):
+        if self.ranking is None:
+            return True
+
+        previous = dict(self.ranking)
+        if set(previous) != {key for key, _ in ranking}:
+            return True
+
+        return any(abs(benefit - previous[key]) > self.change_ratio * max(abs(previous[key]), 1e-9) for key, benefit in ranking)
+
+    def step(self, now=None):
+        """Poll once and return the new recommendations when the ranking changed materially, else None"""
+        self.poll(now)
+
+        snapshot = self.stats.snapshot(now)
+        if not snapshot["aggregates"]:
+            return None
+
+        self.recommender.query_results = aggregates_to_results(snapshot)
+        recommendations = self.recommender.recommend_indexes(record_history=False)
+
+        ranking = self._ranking(recommendations)
+        if not self.ranking_changed(ranking):
+            return None
+
+        self.ranking = ranking
+        if self.recommender.metrics_store:
+            self.recommender.metrics_store.record_recommendations(self.recommender.metrics_store.start_run("advisor"), recommendations)
+
+        return recommendations
+
+    def run(self, iterations=None, on_change=None):
+        """Advise every interval_s seconds until iterations are done or the process is interrupted"""
+        completed = 0
+        try:
+            while iterations is None or completed < iterations:
+                started = time.monotonic()
+                recommendations = self.step()
+                if recommendations is not None and on_change:
+                    on_change(recommendations)
+
+                completed += 1
+                if iterations is None or completed < iterations:
+                    time.sleep(max(self.interval_s - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
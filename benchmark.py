@@ -0,0 +1,332 @@
+"""Synthetic data and workload generator plus benchmarks for the recommender
+
+Speed benchmarks time the pure-Python stages (field extraction, workload ingestion, recommend_indexes) against a
+synthetic in-process stand-in for the database and record peak memory with tracemalloc. Results can be saved as a
+baseline and later compared against it. The quality benchmark needs a real mongod: it loads a synthetic collection,
+replays a generated workload, applies the recommendations and reports the latency reduction.
+
+    python benchmark.py --shapes 1000 10000 --save-baseline
+    python benchmark.py --shapes 1000 10000 --compare
+    python benchmark.py --quality --db index_benchmark --documents 200000
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import bisect
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+from bson import json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+
+DEFAULT_BASELINE_PATH = "benchmark_baseline.json"
+DEFAULT_TOLERANCE = 0.25
+BENCHMARK_COLLECTION = "bench_items"
+DATE_EPOCH = datetime(2024, 1, 1)
+
+# field -> (kind, cardinality); categories and arrays draw Zipf-skewed values
+DEFAULT_SCHEMA = {
+    "category": ("category", 50),
+    "status": ("category", 4),
+    "user_id": ("category", 100000),
+    "price": ("number", 10000),
+    "tags": ("array", 200),
+    "created": ("date", 365),
+}
+
+
+class ZipfSampler:
+    """Draw ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** skew; skew 0 is uniform"""
+
+    def __init__(self, n, skew=1.0, rng=None):
+        self.rng = rng or random.Random()
+        self.cumulative = []
+        total = 0.0
+        for rank in range(n):
+            total += 1 / (rank + 1) ** skew
+            self.cumulative.append(total)
+
+    def sample(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+def generate_documents(count, schema=None, skew=1.0, seed=0):
+    """Yield synthetic documents following the schema, with Zipf-skewed category and tag values"""
+    schema = schema or DEFAULT_SCHEMA
+    rng = random.Random(seed)
+    samplers = {field: ZipfSampler(cardinality, skew, rng) for field, (kind, cardinality) in schema.items() if kind in ["category", "array"]}
+
+    for position in range(count):
+        document = {}
+        for field, (kind, cardinality) in schema.items():
+            if kind == "category":
+                document[field] = f"{field}_{samplers[field].sample()}"
+            elif kind == "array":
+                document[field] = sorted({f"{field}_{samplers[field].sample()}" for _ in range(rng.randint(1, 5))})
+            elif kind == "number":
+                document[field] = rng.randint(0, cardinality)
+            elif kind == "date":
+                document[field] = DATE_EPOCH + timedelta(days=rng.randint(0, cardinality), seconds=position % 86400)
+        yield document
+
+
+def _shape_fields(schema, num_shapes):
+    """Schema fields plus enough synthetic attribute fields that the workload can reach num_shapes distinct shapes"""
+    fields = list(schema)
+    while len(fields) ** 3 < num_shapes:
+        fields.append(f"attr{len(fields)}")
+    return fields
+
+
+def make_shape(shape_id, fields, schema=None):
+    """Deterministic query shape (filter, sort) for a shape id; the same id always yields the same shape"""
+    schema = schema or DEFAULT_SCHEMA
+    rng = random.Random(shape_id)
+    chosen = rng.sample(fields, rng.randint(1, 3))
+
+    query = {}
+    for field in chosen:
+        kind, cardinality = schema.get(field, ("category", 1000))
+        if kind == "date":
+            # Documents carry a time of day, so a date is matched by its day rather than by an exact instant
+            day = DATE_EPOCH + timedelta(days=rng.randrange(cardinality))
+            query[field] = {"$gte": day, "$lt": day + timedelta(days=1)} if rng.random() < 0.5 else {"$gt": day}
+            continue
+
+        operator = rng.choice(["eq", "eq", "range", "in"]) if kind != "array" else "eq"
+        value = f"{field}_{rng.randrange(cardinality)}" if kind in ["category", "array"] else rng.randrange(cardinality)
+
+        if operator == "eq":
+            query[field] = value
+        elif operator == "range":
+            query[field] = {"$gt": value}
+        else:
+            query[field] = {"$in": [value, f"{value}_alt" if isinstance(value, str) else value + 1]}
+
+    sort_field = rng.choice(fields)
+    sort = [(sort_field, rng.choice([1, -1]))] if rng.random() < 0.3 and sort_field not in chosen else None
+    return query, sort
+
+
+def generate_ops(num_shapes, executions, schema=None, skew=1.0, collection=BENCHMARK_COLLECTION, seed=0):
+    """Yield normalized find operations (the workload_ingest format) over num_shapes Zipf-popular shapes"""
+    schema = schema or DEFAULT_SCHEMA
+    rng = random.Random(seed)
+    popularity = ZipfSampler(num_shapes, skew, rng)
+    fields = _shape_fields(schema, num_shapes)
+
+    for _ in range(executions):
+        shape_id = popularity.sample()
+        query, sort = make_shape(shape_id, fields, schema)
+        docs_examined = rng.randint(1000, 100000)
+        yield {"op": "find", "collection": collection, "filter": query, "sort": sort, "projection": None, "limit": None, "source": "synthetic", "duration_ms": rng.lognormvariate(math.log(80), 0.8), "docs_examined": docs_examined, "keys_examined": 0, "n_returned": rng.randint(0, 100), "plan_summary": "COLLSCAN", "has_sort_stage": bool(sort)}
+
+
+def generate_log_lines(ops):
+    """Render operations as mongod structured slow query log lines"""
+    for op in ops:
+        command = {"find": op["collection"], "filter": op["filter"]}
+        if op["sort"]:
+            command["sort"] = dict(op["sort"])
+        attr = {"type": "command", "ns": f"bench.{op['collection']}", "command": command, "durationMillis": int(op["duration_ms"]), "docsExamined": op["docs_examined"], "keysExamined": 0, "nreturned": op["n_returned"], "planSummary": op["plan_summary"], "hasSortStage": op["has_sort_stage"]}
+        yield json_util.dumps({"t": {"$date": "2024-01-01T00:00:00.000+00:00"}, "s": "I", "c": "COMMAND", "id": 51803, "msg": "Slow query", "attr": attr}, json_options=RELAXED_JSON_OPTIONS)
+
+
+def workload_file(path, num_shapes, schema=None, collection=BENCHMARK_COLLECTION):
+    """Write the first num_shapes generated shapes as a queries.json workload"""
+    schema = schema or DEFAULT_SCHEMA
+    fields = list(schema)
+    queries = []
+    for shape_id in range(num_shapes):
+        query, sort = make_shape(shape_id, fields, schema)
+        queries.append({"name": f"shape_{shape_id}", "query": query, "projection": None, "sort": [list(item) for item in sort] if sort else None, "limit": 100})
+
+    # Extended JSON keeps date literals dates when the workload is loaded back
+    with open(path, "w") as f:
+        f.write(json_util.dumps({"queries": [{"collection": collection, "queries": queries}]}, json_options=RELAXED_JSON_OPTIONS))
+
+
+class SyntheticDB:
+    """In-process stand-in for DBQueries covering what recommend_indexes reads, backed by generated documents"""
+
+    def __init__(self, document_count=1000000, sample_size=1000, schema=None, skew=1.0):
+        self.document_count = document_count
+        self.sample = list(generate_documents(sample_size, schema, skew))
+
+    def list_collections(self):
+        return [BENCHMARK_COLLECTION]
+
+    def list_indexes(self, collection_name):
+        return [{"name": "_id_", "key": [("_id", 1)]}]
+
+    def estimated_document_count(self, collection_name):
+        return self.document_count
+
+    def sample_field_values(self, collection_name, fields, sample_size=1000):
+        return [{field: document[field] for field in fields if field in document} for document in self.sample[:sample_size]]
+
+    def collection_stats(self, collection_name):
+        return {"latencyStats": {"reads": {"ops": 1000, "latency": 0}, "writes": {"ops": 100, "latency": 0}}, "storageStats": {}}
+
+    def server_opcounters(self):
+        return {"insert": 50, "update": 40, "delete": 10}
+
+
+def measure(function, track_memory=True):
+    """Wall time of one call, then peak traced memory of a second call (tracing slows the code it measures)"""
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if track_memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+
+    return {"seconds": seconds, "peak_mb": peak_mb}
+
+
+def speed_benchmarks(shape_counts, executions_per_shape=5, skew=1.0, track_memory=True):
+    """Time field extraction, log and op ingestion and recommend_indexes at each workload size"""
+    from index_recommender import IndexRecommender
+    from query_shape import shape_string
+    from workload_ingest import aggregate_ops, aggregates_to_results, parse_log_lines
+
+    results = {}
+    for num_shapes in shape_counts:
+        executions = num_shapes * executions_per_shape
+        ops = list(generate_ops(num_shapes, executions, skew=skew))
+        log_lines = list(generate_log_lines(ops))
+        shapes = [shape_string(op["filter"]) for op in ops[:num_shapes]]
+        recommender = IndexRecommender(SyntheticDB())
+
+        def extract_fields():
+            for shape in shapes:
+                recommender.extract_fields_from_query_shape(shape)
+
+        def ingest_ops():
+            aggregates_to_results(aggregate_ops(iter(ops)))
+
+        def ingest_logs():
+            aggregates_to_results(aggregate_ops(parse_log_lines(iter(log_lines))))
+
+        def recommend():
+            recommender.ingest_workload(iter(ops), slow_ms=0)
+            recommender.recommend_indexes(record_history=False)
+
+        for stage, function in [("extract_fields_from_query_shape", extract_fields), ("ingest_ops", ingest_ops), ("ingest_logs", ingest_logs), ("recommend_indexes", recommend)]:
+            results[f"{stage}@{num_shapes}"] = measure(function, track_memory)
+            print(f"{stage} with {num_shapes} shapes / {executions} ops: {results[f'{stage}@{num_shapes}']['seconds']:.3f}s", file=sys.stderr)
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Benchmarks that got slower (or used more memory) than the baseline by more than tolerance"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric in ["seconds", "peak_mb"]:
+            previous = (baseline.get(name) or {}).get(metric)
+            current = metrics.get(metric)
+            if previous and current is not None and current > previous * (1 + tolerance):
+                regressions.append({"benchmark": name, "metric": metric, "baseline": previous, "current": current, "change": current / previous - 1})
+
+    return regressions
+
+
+def quality_benchmark(database_name, document_count=100000, num_shapes=20, skew=1.0, trials=3, batch_size=5000):
+    """Load a synthetic collection, replay a generated workload, apply every recommendation and measure the gain
+
+    The benchmark collection is dropped and recreated, and the indexes it creates are dropped again afterwards.
+    """
+    from db_queries import DBQueries
+    from index_recommender import IndexRecommender
+
+    db_queries = DBQueries(database_name)
+    collection = db_queries.db[BENCHMARK_COLLECTION]
+    collection.drop()
+
+    batch = []
+    for document in generate_documents(document_count, skew=skew):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        path = f.name
+    workload_file(path, num_shapes)
+
+    created = []
+    try:
+        recommender = IndexRecommender(db_queries, warmup=1, trials=trials, slow_threshold_ms=0)
+        before = recommender.run_test_queries(path, incremental=False)
+        recommendations = recommender.recommend_indexes(record_history=False)
+
+        for recommendation in recommendations:
+            created.append(db_queries.create_index(BENCHMARK_COLLECTION, recommender.generate_index_spec(recommendation), **recommendation.get("index_options") or {}))
+
+        after = recommender.run_test_queries(path, incremental=False)
+    finally:
+        for index_name in created:
+            db_queries.drop_index(BENCHMARK_COLLECTION, index_name)
+        os.unlink(path)
+        db_queries.close()
+
+    before_ms = sum(result["timing"]["p50_ms"] for result in before)
+    after_ms = sum(result["timing"]["p50_ms"] for result in after)
+    return {"documents": document_count, "shapes": num_shapes, "indexes_created": len(created), "before_p50_total_ms": before_ms, "after_p50_total_ms": after_ms, "latency_reduction": 1 - after_ms / before_ms if before_ms else 0, "indexed_before": sum(result["is_indexed"] for result in before), "indexed_after": sum(result["is_indexed"] for result in after)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the index recommender on synthetic data and workloads")
+    parser.add_argument("--shapes", type=int, nargs="+", default=[1000, 10000], help="workload sizes in distinct shapes (default: 1000 10000)")
+    parser.add_argument("--executions-per-shape", type=int, default=5, help="average executions per shape (default: 5)")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf skew of shape popularity and values (default: 1.0)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help=f"baseline file (default: {DEFAULT_BASELINE_PATH})")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="exit with status 1 when a benchmark regressed beyond --tolerance")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help=f"allowed slowdown before a regression is reported (default: {DEFAULT_TOLERANCE})")
+    parser.add_argument("--quality", action="store_true", help="run the recommendation quality benchmark against a real mongod ($MONGO_URL)")
+    parser.add_argument("--db", default="index_benchmark", help="database for the quality benchmark (default: index_benchmark)")
+    parser.add_argument("--documents", type=int, default=100000, help="documents loaded for the quality benchmark (default: 100000)")
+    args = parser.parse_args(argv)
+
+    if args.quality:
+        print(json.dumps(quality_benchmark(args.db, args.documents, skew=args.skew), indent=2))
+        return 0
+
+    results = speed_benchmarks(args.shapes, args.executions_per_shape, args.skew, not args.no_memory)
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print(f"Regression in {regression['benchmark']} {regression['metric']}: {regression['baseline']:.3f} -> {regression['current']:.3f} (+{regression['change']:.0%})", file=sys.stderr)
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
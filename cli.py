@@ -0,0 +1,242 @@
+"""Headless entry point for CI and cron: analyze a workload, write recommendations, gate on a latency budget
+
+Exit codes: 0 when the run succeeds within budget, 1 when any query shape exceeds the p95 budget, 2 on errors,
+including any workload entry that failed to execute and a run that analyzed nothing.
+Only the standard library (and the stdlib-only instrumentation module) is imported until the arguments are parsed;
+pymongo, pandas and pyarrow load on demand.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+from instrumentation import METRICS, configure_logging, serve_metrics, write_prometheus
+
+EXIT_OK = 0
+EXIT_BUDGET_EXCEEDED = 1
+EXIT_ERROR = 2
+
+RESULT_FIELDS = ["collection", "query_name", "shape_hash", "query_shape", "execution_count", "is_indexed", "cached"]
+TIMING_FIELDS = ["p50_ms", "p95_ms", "p99_ms", "stddev_ms", "trials", "round_trip_p50_ms", "client_p50_ms", "documents", "bytes"]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Analyze a MongoDB workload and recommend indexes without the Streamlit UI")
+    parser.add_argument("--uri", help="MongoDB connection string (defaults to $MONGO_URL, then localhost)")
+    parser.add_argument("--db", required=True, help="database to analyze")
+    parser.add_argument("--read-preference", choices=["primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"], help="where replays, explains and sampling are sent (index builds always use the primary)")
+
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--queries", default="queries.json", help="workload file to replay (default: queries.json)")
+    source.add_argument("--profile", action="store_true", help="ingest operations recorded in system.profile instead of replaying a file")
+    source.add_argument("--logs", nargs="+", metavar="PATH", help="ingest slow operations from mongod JSON log files or globs")
+    parser.add_argument("--slow-ms", type=float, default=100, help="only ingest operations slower than this (default: 100)")
+    parser.add_argument("--profile-idle-s", type=float, default=10, help="stop tailing system.profile once no operation arrived for this long (default: 10)")
+    parser.add_argument("--profile-max-s", type=float, default=300, help="stop tailing system.profile after this long in total (default: 300)")
+    parser.add_argument("--no-tail", action="store_true", help="only read the current contents of system.profile instead of tailing it")
+
+    parser.add_argument("--workers", type=int, default=1, help="parallel replay workers (default: 1)")
+    parser.add_argument("--per-collection", type=int, default=None, help="max concurrent queries per collection")
+    parser.add_argument("--warmup", type=int, default=1, help="warmup runs per query (default: 1)")
+    parser.add_argument("--trials", type=int, default=5, help="timed trials per query (default: 5)")
+    parser.add_argument("--drain", action="store_true", help="drain result cursors as raw BSON, counting documents and bytes without decoding them")
+    parser.add_argument("--batch-size", type=int, help="cursor batch size when draining (default: sized from the average document size)")
+    parser.add_argument("--slow-threshold-ms", type=float, default=50, help="shapes faster than this are not considered for indexes (default: 50)")
+
+    parser.add_argument("--metrics-db", help="SQLite metrics store; unchanged collections are served from it")
+    parser.add_argument("--full", action="store_true", help="re-execute every workload entry even when a stored result is still valid")
+
+    parser.add_argument("--advise", action="store_true", help="keep running: poll --profile or --logs every --interval-s and emit a JSON line whenever the ranking changes materially")
+    parser.add_argument("--interval-s", type=float, default=60, help="advisor polling interval (default: 60)")
+    parser.add_argument("--half-life-s", type=float, default=3600, help="advisor statistics half-life (default: 3600)")
+    parser.add_argument("--max-shapes", type=int, default=10000, help="advisor shape limit; the coldest shapes are evicted (default: 10000)")
+    parser.add_argument("--iterations", type=int, help="stop the advisor after this many polls")
+
+    parser.add_argument("--output", "-o", default="-", help="where to write results: '-' for stdout, *.json or *.parquet (default: -)")
+    parser.add_argument("--no-partial", action="store_true", help="never restrict recommended indexes to a partial filter or make them sparse")
+    parser.add_argument("--budget-mb", type=float, help="only recommend the best set of indexes whose estimated size fits this many MB")
+    parser.add_argument("--p95-budget-ms", type=float, help="exit with status 1 when any query shape's p95 exceeds this budget")
+
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="log verbosity on stderr (default: INFO)")
+    parser.add_argument("--log-json", action="store_true", help="log one JSON object per line instead of plain text")
+    parser.add_argument("--count-bytes", action="store_true", help="also account the BSON size of every command and reply per stage (adds client overhead)")
+    parser.add_argument("--metrics-file", help="write per-stage metrics in the Prometheus text format to this file when done")
+    parser.add_argument("--metrics-port", type=int, help="serve per-stage metrics for Prometheus at :PORT/metrics while running")
+    return parser
+
+
+def result_row(result):
+    timing = result.get("timing") or {}
+    row = {field: result.get(field) for field in RESULT_FIELDS}
+    row.update({field: timing.get(field) for field in TIMING_FIELDS})
+    row["server_ms"] = (result.get("plan") or {}).get("execution_time_ms")
+    row["execution_count"] = row["execution_count"] or 1
+    row["cached"] = bool(row["cached"])
+    return row
+
+
+def budget_violations(results, p95_budget_ms):
+    if p95_budget_ms is None:
+        return []
+
+    return [result_row(result) for result in results if ((result.get("timing") or {}).get("p95_ms") or 0) > p95_budget_ms]
+
+
+def write_json(report, output):
+    text = json.dumps(report, indent=2, default=str)
+    if output == "-":
+        sys.stdout.write(text + "\n")
+        return
+
+    with open(output, "w") as f:
+        f.write(text)
+
+
+def _flat_value(value):
+    return json.dumps(value, default=str) if isinstance(value, (dict, list, tuple)) else value
+
+
+def _uniform_rows(rows, excluded=()):
+    """Rows with the union of every row's keys, nested values as JSON text, so no column depends on the first row"""
+    columns = list(dict.fromkeys(key for row in rows for key in row if key not in excluded))
+    return [{column: _flat_value(row.get(column)) for column in columns} for row in rows]
+
+
+def write_parquet(report, output):
+    """One Parquet file of recommendations, plus <name>.results.parquet with the per-shape timings"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pq.write_table(pa.Table.from_pylist(_uniform_rows(report["recommendations"], ["serves", "example_query", "pipeline"])), output)
+
+    base, _ = os.path.splitext(output)
+    pq.write_table(pa.Table.from_pylist(_uniform_rows(report["query_results"])), f"{base}.results.parquet")
+
+
+def run(args):
+    if args.uri:
+        os.environ["MONGO_URL"] = args.uri
+
+    from db_queries import DBQueries
+    from index_recommender import IndexRecommender
+
+    metrics_store = None
+    if args.metrics_db:
+        from metrics_store import MetricsStore
+
+        metrics_store = MetricsStore(args.metrics_db)
+
+    db_queries = DBQueries(args.db, read_preference=args.read_preference, drain=args.drain, batch_size=args.batch_size)
+    try:
+        recommender = IndexRecommender(db_queries, max_workers=args.workers, max_per_collection=args.per_collection, warmup=args.warmup, trials=args.trials, slow_threshold_ms=args.slow_threshold_ms, metrics_store=metrics_store, partial_indexes=not args.no_partial)
+
+        if args.profile:
+            results = recommender.ingest_profile(tailable=not args.no_tail, idle_timeout_s=args.profile_idle_s, max_duration_s=args.profile_max_s, slow_ms=args.slow_ms)
+        elif args.logs:
+            results = recommender.ingest_logs(args.logs, slow_ms=args.slow_ms)
+        else:
+            results = recommender.run_test_queries(args.queries, incremental=not args.full)
+
+        recommendations = recommender.recommend_indexes()
+        if args.budget_mb is not None:
+            recommendations = recommender.select_within_budget(int(args.budget_mb * 1024 ** 2), recommendations)["selected"]
+    finally:
+        db_queries.close()
+        if metrics_store:
+            metrics_store.close()
+
+    return {"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "database": args.db, "query_results": [result_row(result) for result in results], "failed_entries": recommender.failed_items, "recommendations": recommendations, "suppressed_recommendations": recommender.suppressed_recommendations, "budget_violations": budget_violations(results, args.p95_budget_ms), "stages": METRICS.snapshot()}
+
+
+def advise(args):
+    """Run the online advisor, appending one JSON line per material ranking change to the output"""
+    if args.uri:
+        os.environ["MONGO_URL"] = args.uri
+
+    from advisor import OnlineAdvisor
+    from db_queries import DBQueries
+    from index_recommender import IndexRecommender
+
+    metrics_store = None
+    if args.metrics_db:
+        from metrics_store import MetricsStore
+
+        metrics_store = MetricsStore(args.metrics_db)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "a")
+    db_queries = DBQueries(args.db, read_preference=args.read_preference)
+
+    def emit(recommendations):
+        output.write(json.dumps({"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "database": args.db, "recommendations": recommendations}, default=str) + "\n")
+        output.flush()
+
+    try:
+        recommender = IndexRecommender(db_queries, slow_threshold_ms=args.slow_threshold_ms, metrics_store=metrics_store)
+        advisor = OnlineAdvisor(recommender, log_path=args.logs[0] if args.logs else None, interval_s=args.interval_s, half_life_s=args.half_life_s, max_shapes=args.max_shapes, slow_ms=args.slow_ms)
+
+        with contextlib.redirect_stdout(sys.stderr):
+            advisor.run(args.iterations, on_change=emit)
+    finally:
+        db_queries.close()
+        if metrics_store:
+            metrics_store.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    configure_logging(args.log_level, args.log_json)
+    METRICS.count_bytes = args.count_bytes
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    if args.advise:
+        if not (args.profile or args.logs):
+            print("Error: --advise needs --profile or --logs", file=sys.stderr)
+            return EXIT_ERROR
+
+        try:
+            advise(args)
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return EXIT_ERROR
+        finally:
+            if args.metrics_file:
+                write_prometheus(args.metrics_file)
+        return EXIT_OK
+
+    try:
+        # Progress messages go to stderr so stdout carries only the report
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run(args)
+
+        if args.output.endswith(".parquet"):
+            write_parquet(report, args.output)
+        else:
+            write_json(report, args.output)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    finally:
+        if args.metrics_file:
+            write_prometheus(args.metrics_file)
+
+    for failed in report["failed_entries"]:
+        print(f"Workload entry failed: {failed['collection']} {failed['query_name']}", file=sys.stderr)
+    if report["failed_entries"] or not report["query_results"]:
+        print(f"Error: {len(report['failed_entries'])} workload entries failed and {len(report['query_results'])} were analyzed", file=sys.stderr)
+        return EXIT_ERROR
+
+    for violation in report["budget_violations"]:
+        print(f"p95 budget exceeded: {violation['collection']} {violation['query_name'] or violation['shape_hash']} p95 {violation['p95_ms']:.2f} ms > {args.p95_budget_ms} ms", file=sys.stderr)
+
+    return EXIT_BUDGET_EXCEEDED if report["budget_violations"] else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
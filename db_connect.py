@@ -1,18 +1,115 @@
 import os
+import atexit
+import threading
+import bson
 from dotenv import load_dotenv
+from pymongo import monitoring
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
+from instrumentation import METRICS, current_stage, record_command_wait
 
 load_dotenv()
 
+DEFAULT_URI = "mongodb://localhost:27017"
+# MongoClient options that can be tuned from the environment, with the type each is parsed as
+ENV_OPTIONS = {
+    "maxPoolSize": ("MONGO_MAX_POOL_SIZE", int),
+    "minPoolSize": ("MONGO_MIN_POOL_SIZE", int),
+    "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", int),
+    "connectTimeoutMS": ("MONGO_CONNECT_TIMEOUT_MS", int),
+    "socketTimeoutMS": ("MONGO_SOCKET_TIMEOUT_MS", int),
+    "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+    "readPreference": ("MONGO_READ_PREFERENCE", str),
+}
 
-def db_connect():
-    mongo_uri = os.getenv("MONGO_URL")
-    if mongo_uri:
-        uri = mongo_uri
-    else:
-        uri = "mongodb://localhost:27017"
+_clients = {}
+_clients_lock = threading.Lock()
 
-    client = MongoClient(uri, server_api=ServerApi('1'))
 
-    return client
+class CommandCounter(monitoring.CommandListener):
+    """Attribute every server round trip to the pipeline stage active on the calling thread
+
+    The driver publishes command events on the thread that issued the command, so the stage context is the caller's.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or METRICS
+
+    def started(self, event):
+        if self.metrics.count_bytes:
+            self.metrics.record_sent(current_stage(), len(bson.encode(event.command)))
+
+    def succeeded(self, event):
+        bytes_received = len(bson.encode(event.reply)) if self.metrics.count_bytes else 0
+        self.metrics.record_command(current_stage(), event.duration_micros / 1_000_000, bytes_received=bytes_received)
+        record_command_wait(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        self.metrics.record_command(current_stage(), event.duration_micros / 1_000_000, failed=True)
+        record_command_wait(event.duration_micros / 1_000_000)
+
+
+COMMAND_COUNTER = CommandCounter()
+
+
+def client_options(**overrides):
+    """Client options from the MONGO_* environment variables, overridden by any non-None keyword arguments"""
+    options = {}
+    for option, (variable, parse) in ENV_OPTIONS.items():
+        value = os.getenv(variable)
+        if value:
+            options[option] = parse(value)
+
+    options.update({option: value for option, value in overrides.items() if value is not None})
+    return options
+
+
+def _client_key(uri, options):
+    return uri, tuple(sorted((option, str(value)) for option, value in options.items()))
+
+
+def get_client(uri=None, **options):
+    """Shared MongoClient for a URI and option set; each call takes a reference that release_client gives back"""
+    uri = uri or os.getenv("MONGO_URL") or DEFAULT_URI
+    options = client_options(**options)
+    key = _client_key(uri, options)
+
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            entry = _clients[key] = {"client": MongoClient(uri, server_api=ServerApi('1'), event_listeners=[COMMAND_COUNTER], **options), "references": 0}
+        entry["references"] += 1
+
+        return entry["client"]
+
+
+def release_client(client):
+    """Give back one reference to a shared client, closing its pool once nothing uses it"""
+    with _clients_lock:
+        for key, entry in _clients.items():
+            if entry["client"] is client:
+                entry["references"] -= 1
+                if entry["references"] <= 0:
+                    del _clients[key]
+                    client.close()
+                return
+
+    # Not managed here (or already closed by close_all)
+    client.close()
+
+
+def close_all():
+    """Close every shared client; registered to run at interpreter exit"""
+    with _clients_lock:
+        entries = list(_clients.values())
+        _clients.clear()
+
+    for entry in entries:
+        entry["client"].close()
+
+
+atexit.register(close_all)
+
+
+def db_connect(uri=None, **options):
+    return get_client(uri, **options)
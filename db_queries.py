@@ -1,41 +1,408 @@
 import time
-from db_connect import db_connect
+import uuid
+import logging
+from contextlib import contextmanager
+
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import CursorType, ReadPreference
+from pymongo.errors import BulkWriteError
+from db_connect import get_client, release_client
+from instrumentation import command_timer, stage
+from timing_stats import summarize_timings
+
+SHADOW_COLLECTION_PREFIX = "__whatif_"
+# Scratch collections older than this are assumed to be left behind by a crashed what-if run rather than in use
+SHADOW_STALE_AFTER_S = 3600
+# listIndexes fields that are not createIndexes options, plus TTL, which would expire the scratch sample's documents
+SHADOW_SKIPPED_INDEX_FIELDS = ["v", "ns", "key", "name", "expireAfterSeconds"]
+# Drained batches aim for this size; the server caps a batch at 16 MB
+DRAIN_BATCH_BYTES = 8 * 1024 ** 2
+MIN_DRAIN_BATCH_SIZE = 101
+MAX_DRAIN_BATCH_SIZE = 100000
+RAW_DOCUMENTS = CodecOptions(document_class=RawBSONDocument)
+READ_PREFERENCES = {"primary": ReadPreference.PRIMARY, "primaryPreferred": ReadPreference.PRIMARY_PREFERRED, "secondary": ReadPreference.SECONDARY, "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED, "nearest": ReadPreference.NEAREST}
+
+logger = logging.getLogger(__name__)
 
 
 class DBQueries:
-    def __init__(self, database_name):
-        self.client = db_connect()
-        self.db = self.client[database_name]
+    def __init__(self, database_name, client=None, read_preference=None, drain=False, batch_size=None):
+        """Analysis reads follow read_preference (a mode name such as "secondaryPreferred"); writes always go to the primary
+
+        Without a client a reference to the shared client is taken and given back by close(). With drain set, timed
+        executions exhaust their cursors as undecoded RawBSONDocument batches and only count documents and bytes, so
+        large result sets measure the database rather than Python decoding; batch_size defaults to one sized from the
+        collection's average document size.
+        """
+        self.drain = drain
+        self.batch_size = batch_size
+        self._batch_sizes = {}
+        self._owns_client = client is None
+        self.client = client or get_client()
+        self.db = self.client.get_database(database_name, read_preference=READ_PREFERENCES[read_preference] if read_preference else None)
+        self.primary_db = self.client.get_database(database_name, read_preference=ReadPreference.PRIMARY)
+
+    def _collection(self, collection_name):
+        # Scratch collections are read right after they are written, so replication lag must not be observed
+        if collection_name.startswith(SHADOW_COLLECTION_PREFIX):
+            return self.primary_db[collection_name]
+
+        return self.db[collection_name]
+
+    def _command(self, collection_name, command, value=1, **kwargs):
+        """Run a command with the same read preference as reads on the collection (commands default to the primary)"""
+        database = self.primary_db if collection_name.startswith(SHADOW_COLLECTION_PREFIX) else self.db
+        return database.command(command, value, read_preference=database.read_preference, **kwargs)
 
     def list_collections(self):
-        return self.db.list_collection_names()
+        return [name for name in self.db.list_collection_names() if not name.startswith(SHADOW_COLLECTION_PREFIX)]
 
-    def execute_query(self, collection_name, query, projection=None, sort=None, limit=None):
-        collection = self.db[collection_name]
-        start_time = time.time()
+    def drain_batch_size(self, collection_name):
+        """Batch size that keeps drained batches near DRAIN_BATCH_BYTES for the collection's average document size"""
+        if self.batch_size:
+            return self.batch_size
+
+        if collection_name not in self._batch_sizes:
+            avg_obj_size = self.collection_stats(collection_name)["storageStats"].get("avgObjSize") or 0
+            batch_size = DRAIN_BATCH_BYTES // avg_obj_size if avg_obj_size else MIN_DRAIN_BATCH_SIZE
+            self._batch_sizes[collection_name] = int(min(max(batch_size, MIN_DRAIN_BATCH_SIZE), MAX_DRAIN_BATCH_SIZE))
 
-        explain_plan = collection.find(query, projection).explain()
+        return self._batch_sizes[collection_name]
 
-        cursor = collection.find(query, projection)
+    def _timed_collection(self, collection_name):
+        collection = self._collection(collection_name)
+        return collection.with_options(codec_options=RAW_DOCUMENTS) if self.drain else collection
+
+    def _consume(self, cursor):
+        """Decoded results, or in drain mode a count of the raw documents and their bytes"""
+        if not self.drain:
+            return list(cursor)
+
+        documents = 0
+        size = 0
+        for document in cursor:
+            documents += 1
+            size += len(document.raw)
+
+        return {"documents": documents, "bytes": size}
+
+    def _run_find(self, collection, query, projection=None, sort=None, limit=None, batch_size=0, hint=None):
+        cursor = collection.find(query, projection, batch_size=batch_size)
         if sort:
             cursor = cursor.sort(sort)
         if limit:
             cursor = cursor.limit(limit)
+        if hint:
+            cursor = cursor.hint(hint)
+
+        return self._consume(cursor)
+
+    def explain_query(self, collection_name, query, projection=None, sort=None, limit=None, verbosity="executionStats", hint=None):
+        """Explain the find exactly as it is executed, including its sort and limit, optionally forcing an index"""
+        find_command = {"find": collection_name, "filter": query}
+        if projection:
+            find_command["projection"] = projection
+        if sort:
+            find_command["sort"] = dict(sort)
+        if limit:
+            find_command["limit"] = limit
+        if hint:
+            find_command["hint"] = dict(hint)
+
+        with stage("explain"):
+            return self._command(collection_name, "explain", find_command, verbosity=verbosity)
+
+    def execute_query(self, collection_name, query, projection=None, sort=None, limit=None):
+        """Explain, then time one execution; in drain mode the results are the document and byte counts"""
+        collection = self._timed_collection(collection_name)
+        batch_size = self.drain_batch_size(collection_name) if self.drain else 0
+
+        explain_plan = self.explain_query(collection_name, query, projection, sort, limit)
 
-        results = list(cursor)
-        end_time = time.time()
-        execution_time_ms = (end_time - start_time) * 1000
+        with stage("execute"):
+            start_ns = time.perf_counter_ns()
+            results = self._run_find(collection, query, projection, sort, limit, batch_size)
+            execution_time_ms = (time.perf_counter_ns() - start_ns) / 1_000_000
 
         return results, execution_time_ms, explain_plan
 
-    def create_index(self, collection_name, index_spec, index_name=None, unique=False):
+    def _run_aggregate(self, collection, pipeline, batch_size=None, hint=None):
+        options = {"hint": hint} if hint else {}
+        return self._consume(collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size, **options))
+
+    def explain_aggregate(self, collection_name, pipeline, verbosity="executionStats"):
+        """Explain an aggregation pipeline as it is executed"""
+        aggregate_command = {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}, "allowDiskUse": True}
+
+        with stage("explain"):
+            return self._command(collection_name, "explain", aggregate_command, verbosity=verbosity)
+
+    def _benchmark(self, run, explain, warmup, trials):
+        explain_start_ns = time.perf_counter_ns()
+        explain_plan = explain()
+        explain_time_ms = (time.perf_counter_ns() - explain_start_ns) / 1_000_000
+
+        with stage("execute"):
+            for _ in range(warmup):
+                run()
+
+            results = []
+            samples_ms = []
+            round_trip_ms = []
+            for _ in range(max(trials, 1)):
+                with command_timer() as waited:
+                    start_ns = time.perf_counter_ns()
+                    results = run()
+                    samples_ms.append((time.perf_counter_ns() - start_ns) / 1_000_000)
+                round_trip_ms.append(waited["seconds"] * 1000)
+
+        timing = summarize_timings(samples_ms)
+        timing["warmup"] = warmup
+        timing["explain_time_ms"] = explain_time_ms
+        # Waiting on the server (execution plus network) versus decoding and iterating on the client
+        timing["round_trip_p50_ms"] = summarize_timings(round_trip_ms)["p50_ms"]
+        timing["client_p50_ms"] = summarize_timings([max(total - waited_ms, 0) for total, waited_ms in zip(samples_ms, round_trip_ms)])["p50_ms"]
+        timing["drained"] = self.drain
+
+        if self.drain:
+            timing["documents"] = results["documents"]
+            timing["bytes"] = results["bytes"]
+            results = []
+
+        return results, timing, explain_plan
+
+    def benchmark_query(self, collection_name, query, projection=None, sort=None, limit=None, warmup=1, trials=5):
+        """Run warmup executions, then time each of N trials separately from the explain round trip
+
+        In drain mode no results are returned; the timing carries the document and byte counts instead.
+        """
+        collection = self._timed_collection(collection_name)
+        batch_size = self.drain_batch_size(collection_name) if self.drain else 0
+
+        return self._benchmark(lambda: self._run_find(collection, query, projection, sort, limit, batch_size), lambda: self.explain_query(collection_name, query, projection, sort, limit), warmup, trials)
+
+    def benchmark_aggregate(self, collection_name, pipeline, warmup=1, trials=5):
+        """benchmark_query for an aggregation pipeline"""
+        collection = self._timed_collection(collection_name)
+        batch_size = self.drain_batch_size(collection_name) if self.drain else None
+
+        return self._benchmark(lambda: self._run_aggregate(collection, pipeline, batch_size), lambda: self.explain_aggregate(collection_name, pipeline), warmup, trials)
+
+    def timed_find(self, collection_name, query, projection=None, sort=None, limit=None, hint=None):
+        """Milliseconds of one execution, optionally forced onto a plan with hint (an index name, key list or $natural)"""
+        collection = self._timed_collection(collection_name)
+        batch_size = self.drain_batch_size(collection_name) if self.drain else 0
+
+        with stage("execute"):
+            start_ns = time.perf_counter_ns()
+            self._run_find(collection, query, projection, sort, limit, batch_size, hint)
+            return (time.perf_counter_ns() - start_ns) / 1_000_000
+
+    def timed_aggregate(self, collection_name, pipeline, hint=None):
+        """timed_find for an aggregation pipeline"""
+        collection = self._timed_collection(collection_name)
+        batch_size = self.drain_batch_size(collection_name) if self.drain else None
+
+        with stage("execute"):
+            start_ns = time.perf_counter_ns()
+            self._run_aggregate(collection, pipeline, batch_size, hint)
+            return (time.perf_counter_ns() - start_ns) / 1_000_000
+
+    def estimated_document_count(self, collection_name):
+        return self._collection(collection_name).estimated_document_count()
+
+    def sample_field_values(self, collection_name, fields, sample_size=1000):
+        """Values of the given field paths in a $sample of the collection; absent fields are left out of each document"""
+        aliases = {f"f{position}": field for position, field in enumerate(fields)}
+        pipeline = [{"$sample": {"size": sample_size}}, {"$project": {"_id": 0, **{alias: f"${field}" for alias, field in aliases.items()}}}]
+
+        return [{aliases[alias]: value for alias, value in document.items()} for document in self._collection(collection_name).aggregate(pipeline, allowDiskUse=True)]
+
+    def collection_stats(self, collection_name):
+        """Latency and storage statistics of a collection from $collStats, summed across shards
+
+        Read from the primary: latency statistics are per node and only the primary sees the collection's writes.
+        """
+        pipeline = [{"$collStats": {"latencyStats": {"histograms": False}, "storageStats": {}}}]
+
+        combined = {"latencyStats": {"reads": {"ops": 0, "latency": 0}, "writes": {"ops": 0, "latency": 0}}, "storageStats": {}}
+        for shard_stats in self.primary_db[collection_name].aggregate(pipeline):
+            for op_type in ["reads", "writes"]:
+                for counter in ["ops", "latency"]:
+                    combined["latencyStats"][op_type][counter] += shard_stats.get("latencyStats", {}).get(op_type, {}).get(counter, 0)
+
+            for index_name, details in shard_stats.get("storageStats", {}).get("indexDetails", {}).items():
+                cache_bytes = details.get("cache", {}).get("bytes currently in the cache", 0)
+                index_cache_bytes = combined["storageStats"].setdefault("indexCacheBytes", {})
+                index_cache_bytes[index_name] = index_cache_bytes.get(index_name, 0) + cache_bytes
+
+            for key, value in shard_stats.get("storageStats", {}).items():
+                if isinstance(value, (int, float)):
+                    combined["storageStats"][key] = combined["storageStats"].get(key, 0) + value
+                elif isinstance(value, dict) and key == "indexSizes":
+                    index_sizes = combined["storageStats"].setdefault("indexSizes", {})
+                    for index_name, size in value.items():
+                        index_sizes[index_name] = index_sizes.get(index_name, 0) + size
+
+        return combined
+
+    def server_opcounters(self):
+        return dict(self.primary_db.command("serverStatus").get("opcounters", {}))
+
+    def profile_cursor(self, since=None, tailable=False, await_ms=1000):
+        """Cursor over the primary's system.profile operations, optionally tailing the capped collection"""
+        profile_filter = {"op": {"$in": ["query", "command", "getmore", "insert", "update", "remove"]}}
+        if since is not None:
+            profile_filter["ts"] = {"$gt": since}
+
+        if tailable:
+            cursor = self.primary_db["system.profile"].find(profile_filter, cursor_type=CursorType.TAILABLE_AWAIT)
+            return cursor.max_await_time_ms(await_ms)
+
+        return self.primary_db["system.profile"].find(profile_filter).sort("ts", 1)
+
+    def create_index(self, collection_name, index_spec, index_name=None, unique=False, **options):
+        """Build an index; options such as partialFilterExpression or sparse are passed through to createIndexes"""
         collection = self.db[collection_name]
-        return collection.create_index(index_spec, name=index_name, unique=unique)
+        with stage("apply"):
+            return collection.create_index(index_spec, name=index_name, unique=unique, **options)
+
+    def list_indexes(self, collection_name):
+        """Existing indexes with their key pattern as an ordered list of (field, direction) pairs"""
+        indexes = []
+        for index in self.primary_db[collection_name].list_indexes():
+            index = dict(index)
+            index["key"] = list(index["key"].items())
+            indexes.append(index)
+
+        return indexes
+
+    def index_stats(self, collection_name):
+        """$indexStats access counters per index name, summed across shards with the oldest counter start kept
+
+        Counters are per node and reset on restart; they are read from the primary.
+        """
+        stats = {}
+        for entry in self.primary_db[collection_name].aggregate([{"$indexStats": {}}]):
+            accesses = entry.get("accesses", {})
+            index = stats.setdefault(entry["name"], {"name": entry["name"], "ops": 0, "since": accesses.get("since"), "building": False})
+            index["ops"] += accesses.get("ops", 0)
+            if accesses.get("since") and (index["since"] is None or accesses["since"] < index["since"]):
+                index["since"] = accesses["since"]
+            index["building"] = index["building"] or bool(entry.get("building"))
+
+        return stats
+
+    def index_build_in_progress(self, collection_name, index_name):
+        """Whether a createIndexes operation for the index is still running on the connected node, per $currentOp"""
+        namespace = f"{self.primary_db.name}.{collection_name}"
+        pipeline = [{"$currentOp": {"idleConnections": False}}, {"$match": {"ns": namespace, "command.createIndexes": collection_name, "command.indexes.name": index_name}}]
+
+        return any(True for _ in self.client.admin.aggregate(pipeline))
+
+    def hide_index(self, collection_name, index_name, hidden=True):
+        """Hide an index from the query planner (or unhide it) while it keeps being maintained"""
+        with stage("apply"):
+            return self.primary_db.command("collMod", collection_name, index={"name": index_name, "hidden": hidden})
+
+    def create_shadow_collection(self, collection_name, sample_fraction=0.01, batch_size=1000, max_documents=None, shadow_name=None, copy_indexes=True):
+        """Stream a $sample of a collection into a new scratch collection in batches, then rebuild its indexes there
+
+        With copy_indexes the source's indexes (other than _id) are recreated with their keys and options, so a
+        baseline replay on the sample uses the plans production already has rather than a collection scan.
+        """
+        source = self.db[collection_name]
+        total_documents = source.estimated_document_count()
+
+        sample_size = max(1, int(total_documents * sample_fraction))
+        if max_documents:
+            sample_size = min(sample_size, max_documents)
+
+        shadow_name = shadow_name or self._shadow_name(collection_name)
+        shadow = self.db[shadow_name]
+
+        copied = 0
+        batch = []
+        for document in source.aggregate([{"$sample": {"size": sample_size}}], allowDiskUse=True, batchSize=batch_size):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                copied += self._insert_batch(shadow, batch)
+                batch = []
+        if batch:
+            copied += self._insert_batch(shadow, batch)
+
+        copied_indexes = self._copy_indexes(collection_name, shadow_name) if copy_indexes else []
+
+        return {"name": shadow_name, "source": collection_name, "documents": copied, "indexes": copied_indexes, "source_documents": total_documents, "sample_fraction": copied / total_documents if total_documents else 0}
+
+    def _copy_indexes(self, collection_name, shadow_name):
+        """Recreate a collection's secondary indexes on its scratch copy; returns the names built"""
+        copied = []
+        for index in self.list_indexes(collection_name):
+            if index["name"] == "_id_":
+                continue
+
+            options = {key: value for key, value in index.items() if key not in SHADOW_SKIPPED_INDEX_FIELDS}
+            try:
+                self.primary_db[shadow_name].create_index(index["key"], name=index["name"], **options)
+                copied.append(index["name"])
+            except Exception as e:
+                logger.warning(f"Cannot copy index {index['name']} of {collection_name} to the what-if sample: {e}")
+
+        return copied
+
+    def _insert_batch(self, collection, batch):
+        # $sample can return the same document twice; duplicates are skipped rather than failing the copy
+        try:
+            return len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            return e.details.get("nInserted", 0)
+
+    def _shadow_name(self, collection_name):
+        # The creation time in the name lets a later run tell an abandoned scratch collection from one in use
+        return f"{SHADOW_COLLECTION_PREFIX}{collection_name}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+
+    @contextmanager
+    def shadow_collection(self, collection_name, sample_fraction=0.01, batch_size=1000, max_documents=None):
+        """Scratch sample of a collection that is always dropped on exit, along with any stale ones from crashed runs"""
+        shadow_name = self._shadow_name(collection_name)
+        try:
+            yield self.create_shadow_collection(collection_name, sample_fraction, batch_size, max_documents, shadow_name)
+        finally:
+            self.db.drop_collection(shadow_name)
+            try:
+                self.drop_shadow_collections()
+            except Exception as e:
+                logger.warning(f"Cannot clean up stale what-if collections: {e}")
+
+    def drop_shadow_collections(self, min_age_s=SHADOW_STALE_AFTER_S):
+        """Remove scratch collections left behind by interrupted what-if runs; returns the dropped names
+
+        Only collections created at least min_age_s ago are dropped, so concurrent what-if runs keep theirs. Names
+        without a creation time predate it and are always dropped.
+        """
+        dropped = []
+        for collection_name in self.primary_db.list_collection_names():
+            if not collection_name.startswith(SHADOW_COLLECTION_PREFIX):
+                continue
+
+            created = collection_name.rsplit("_", 2)[-2]
+            if created.isdigit() and time.time() - int(created) < min_age_s:
+                continue
+
+            self.primary_db.drop_collection(collection_name)
+            dropped.append(collection_name)
+
+        return dropped
 
     def drop_index(self, collection_name, index_name):
         collection = self.db[collection_name]
-        collection.drop_index(index_name)
+        with stage("apply"):
+            collection.drop_index(index_name)
 
     def close(self):
-        if self.client:
-            self.client.close()
+        """Give back the shared client reference taken in __init__; a client passed in stays open for its owner"""
+        if self.client and self._owns_client:
+            release_client(self.client)
+            self.client = None
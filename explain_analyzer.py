@@ -0,0 +1,164 @@
+import re
+
+CHILD_STAGE_KEYS = ["inputStage", "outerStage", "innerStage"]
+INDEX_STAGES = ["IXSCAN", "IDHACK", "EXPRESS_IXSCAN", "EXPRESS_CLUSTERED_IXSCAN", "COUNT_SCAN", "DISTINCT_SCAN", "TEXT", "GEO_NEAR_2D", "GEO_NEAR_2DSPHERE"]
+
+
+def _query_planner(explain):
+    if "queryPlanner" in explain:
+        return explain["queryPlanner"]
+
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"].get("queryPlanner", {})
+
+    return {}
+
+
+def _execution_stats(explain):
+    if "executionStats" in explain:
+        return explain["executionStats"]
+
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"].get("executionStats", {})
+
+    return {}
+
+
+def _winning_plan(query_planner):
+    plan = query_planner.get("winningPlan", {})
+
+    # Slot-based engine explains nest the classic-style tree under "queryPlan"
+    if "queryPlan" in plan:
+        plan = plan["queryPlan"]
+
+    return plan
+
+
+def iter_plan_stages(plan):
+    """Yield every stage of a plan tree depth-first, root first"""
+    stack = [plan]
+
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+
+        if "stage" in node:
+            yield node
+
+        children = []
+        for key in CHILD_STAGE_KEYS:
+            if key in node:
+                children.append(node[key])
+        children.extend(node.get("inputStages", []))
+        for shard in node.get("shards", []):
+            children.append(_winning_plan(shard) if "winningPlan" in shard else shard)
+
+        stack.extend(reversed(children))
+
+
+def summarize_plan(stages, total_docs_examined=0, total_keys_examined=0, n_returned=0, execution_time_ms=None, index_names=None, index_keys=None):
+    """Build the plan summary record from a stage list and execution counters
+
+    index_names holds the names of the indexes scanned; index_keys their key patterns as (field, direction) lists.
+    """
+    is_collscan = "COLLSCAN" in stages
+    has_index_stage = any(stage in INDEX_STAGES for stage in stages)
+
+    wasted_docs = max(total_docs_examined - n_returned, 0)
+    wasted_keys = max(total_keys_examined - n_returned, 0)
+
+    return {
+        "stages": stages,
+        "index_names": index_names or [],
+        "index_keys": index_keys or [],
+        "is_collscan": is_collscan,
+        "is_indexed": has_index_stage and not is_collscan,
+        "has_in_memory_sort": "SORT" in stages,
+        "has_fetch": "FETCH" in stages,
+        "total_docs_examined": total_docs_examined,
+        "total_keys_examined": total_keys_examined,
+        "n_returned": n_returned,
+        "execution_time_ms": execution_time_ms,
+        "docs_examined_per_returned": total_docs_examined / max(n_returned, 1),
+        "keys_examined_per_returned": total_keys_examined / max(n_returned, 1),
+        "wasted_docs_examined": wasted_docs,
+        "wasted_keys_examined": wasted_keys,
+    }
+
+
+def _blocking_pipeline_stages(explain):
+    """Plan stage names for aggregation stages that ran after the query layer instead of being pushed into it"""
+    return ["SORT" for stage in explain.get("stages", []) if "$sort" in stage]
+
+
+def _combine_shard_plans(plans):
+    stages = [stage for plan in plans for stage in plan["stages"]]
+    index_names = [name for plan in plans for name in plan["index_names"]]
+    index_keys = [keys for plan in plans for keys in plan["index_keys"]]
+    execution_times = [plan["execution_time_ms"] for plan in plans if plan["execution_time_ms"] is not None]
+
+    return summarize_plan(stages, sum(plan["total_docs_examined"] for plan in plans), sum(plan["total_keys_examined"] for plan in plans), sum(plan["n_returned"] for plan in plans), max(execution_times) if execution_times else None, index_names, index_keys)
+
+
+def analyze_explain(explain):
+    """Parse an explain("executionStats") document into winning plan stages, counters and efficiency ratios"""
+    explain = explain or {}
+
+    # Sharded aggregate explains report one full explain per shard
+    if isinstance(explain.get("shards"), dict) and "queryPlanner" not in explain:
+        return _combine_shard_plans([analyze_explain(shard_explain) for shard_explain in explain["shards"].values()])
+
+    query_planner = _query_planner(explain)
+    execution_stats = _execution_stats(explain)
+
+    stages = []
+    index_names = []
+    index_keys = []
+    for stage in iter_plan_stages(_winning_plan(query_planner)):
+        stages.append(stage["stage"])
+        if stage.get("indexName"):
+            index_names.append(stage["indexName"])
+        if stage.get("keyPattern"):
+            index_keys.append(list(stage["keyPattern"].items()))
+    stages.extend(_blocking_pipeline_stages(explain))
+
+    return summarize_plan(stages, execution_stats.get("totalDocsExamined", 0), execution_stats.get("totalKeysExamined", 0), execution_stats.get("nReturned", 0), execution_stats.get("executionTimeMillis"), index_names, index_keys)
+
+
+def wasted_work(plan):
+    """Documents examined beyond what was returned, plus every document pushed through a blocking sort"""
+    if not plan:
+        return 0
+
+    sort_penalty = plan.get("total_docs_examined", 0) if plan.get("has_in_memory_sort") else 0
+    return plan.get("wasted_docs_examined", 0) + sort_penalty
+
+
+def _parse_key_pattern(text):
+    """[(field, direction)] from a planSummary key pattern such as '{ status: 1, loc: "2dsphere" }'"""
+    keys = []
+    for item in text.strip("{} ").split(","):
+        field, _, direction = item.rpartition(":")
+        direction = direction.strip().strip('"')
+        keys.append((field.strip(), int(direction) if direction.lstrip("-").isdigit() else direction))
+
+    return keys
+
+
+def plan_from_summary(plan_summary, docs_examined=0, keys_examined=0, n_returned=0, has_sort_stage=False, execution_time_ms=None):
+    """Approximate a plan summary from the planSummary string and counters in profiler and slow query log entries
+
+    planSummary names no indexes, only their key patterns, so index_names stays empty and index_keys is filled.
+    """
+    stages = re.findall(r"\b([A-Z][A-Z0-9_]+)\b(?=\s*(?:\{|,|$))", plan_summary or "")
+    index_keys = [_parse_key_pattern(pattern) for pattern in re.findall(r"\{[^}]*\}", plan_summary or "")]
+
+    if has_sort_stage and "SORT" not in stages:
+        stages.insert(0, "SORT")
+    if docs_examined and any(stage in INDEX_STAGES for stage in stages) and "FETCH" not in stages:
+        stages.insert(0, "FETCH")
+
+    return summarize_plan(stages, docs_examined or 0, keys_examined or 0, n_returned or 0, execution_time_ms, index_keys=index_keys)
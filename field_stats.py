@@ -0,0 +1,161 @@
+import json
+import math
+import time
+import threading
+from collections import Counter
+
+LOW_CARDINALITY_THRESHOLD = 3
+
+
+class _Missing:
+    def __repr__(self):
+        return "MISSING"
+
+
+# Marks a field absent from a sampled document, as opposed to present with a null value
+MISSING = _Missing()
+
+
+def _value_key(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+
+    return value if isinstance(value, (str, int, float, bool)) or value is None else str(value)
+
+
+def value_size(value):
+    """Approximate BSON size in bytes of a single value, as stored in an index key"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, int):
+        return 4 if -(2**31) <= value < 2**31 else 8
+    if isinstance(value, float):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 5
+    if isinstance(value, dict):
+        return 5 + sum(len(str(key)) + 2 + value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return 5 + sum(3 + value_size(item) for item in value)
+    if type(value).__name__ == "ObjectId":
+        return 12
+
+    return 8
+
+
+def estimate_distinct(counts, sample_size, population_size):
+    """Guaranteed-Error Estimator: scale values seen once by sqrt(N/n), count repeated values as-is"""
+    if not counts:
+        return 0
+
+    seen_once = sum(1 for count in counts.values() if count == 1)
+    repeated = len(counts) - seen_once
+
+    if not sample_size or not population_size or population_size <= sample_size:
+        return len(counts)
+
+    estimate = math.sqrt(population_size / sample_size) * seen_once + repeated
+    return int(min(max(estimate, len(counts)), population_size))
+
+
+def summarize_field(values, sample_size, population_size, top_k=5):
+    """Distribution summary of one field from its sampled values; a missing field is passed as the MISSING marker"""
+    missing = sum(1 for value in values if value is MISSING)
+    nulls = sum(1 for value in values if value is None)
+    present = [value for value in values if value is not MISSING]
+
+    is_array = any(isinstance(value, list) for value in present)
+    array_lengths = [len(value) for value in present if isinstance(value, list)]
+
+    keys = Counter()
+    sizes = []
+    for value in present:
+        for item in value if isinstance(value, list) else [value]:
+            keys[_value_key(item)] += 1
+            sizes.append(value_size(item))
+
+    total_keys = sum(keys.values())
+    return {
+        "sample_size": sample_size,
+        "distinct_estimate": estimate_distinct(keys, total_keys, population_size * (total_keys / max(len(present), 1))),
+        "missing_ratio": missing / sample_size if sample_size else 0,
+        "null_ratio": nulls / sample_size if sample_size else 0,
+        "is_array": is_array,
+        "avg_array_length": sum(array_lengths) / len(array_lengths) if array_lengths else 1,
+        "avg_size_bytes": sum(sizes) / len(sizes) if sizes else 0,
+        "top_values": [{"value": value, "frequency": count / total_keys} for value, count in keys.most_common(top_k)],
+        "collected_at": time.time(),
+    }
+
+
+class FieldStatsCache:
+    def __init__(self, db_queries, ttl_seconds=3600, sample_size=1000, top_k=5, drift_ratio=0.1):
+        self.db_queries = db_queries
+        self.ttl_seconds = ttl_seconds
+        self.sample_size = sample_size
+        self.top_k = top_k
+        self.drift_ratio = drift_ratio
+        self._stats = {}
+        self._document_counts = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, collection, fields=None):
+        """Drop cached stats for a whole collection or just the given fields"""
+        with self._lock:
+            if fields is None:
+                self._stats.pop(collection, None)
+                self._document_counts.pop(collection, None)
+            else:
+                for field in fields:
+                    self._stats.get(collection, {}).pop(field, None)
+
+    def _check_drift(self, collection):
+        document_count = self.db_queries.estimated_document_count(collection)
+        previous = self._document_counts.get(collection)
+
+        if previous is not None and abs(document_count - previous) > self.drift_ratio * max(previous, 1):
+            self.invalidate(collection)
+
+        self._document_counts.setdefault(collection, document_count)
+        return document_count
+
+    def get(self, collection, fields):
+        """Stats for each field, sampling only the fields that are missing, expired or invalidated by data drift"""
+        document_count = self._check_drift(collection)
+        now = time.time()
+
+        with self._lock:
+            cached = self._stats.setdefault(collection, {})
+            stale = [field for field in fields if field not in cached or now - cached[field]["collected_at"] > self.ttl_seconds]
+
+        if stale:
+            sampled = self.db_queries.sample_field_values(collection, stale, self.sample_size)
+            collected = {field: summarize_field([document.get(field, MISSING) for document in sampled], len(sampled), document_count, self.top_k) for field in stale}
+
+            with self._lock:
+                self._stats.setdefault(collection, {}).update(collected)
+                self._document_counts[collection] = document_count
+
+        with self._lock:
+            return {field: self._stats[collection][field] for field in fields if field in self._stats.get(collection, {})}
+
+    def document_count(self, collection):
+        return self._document_counts.get(collection) or self._check_drift(collection)
+
+
+def equality_selectivity(stats, value=MISSING):
+    """Estimated fraction of documents matching an equality predicate on the field"""
+    if not stats:
+        return 1.0
+
+    if value is not MISSING:
+        for top_value in stats["top_values"]:
+            if top_value["value"] == _value_key(value):
+                return top_value["frequency"]
+
+    present_ratio = 1 - stats["missing_ratio"]
+    return present_ratio / max(stats["distinct_estimate"], 1)
+
+
+def is_low_cardinality(stats, threshold=LOW_CARDINALITY_THRESHOLD):
+    return bool(stats) and stats["distinct_estimate"] <= threshold
@@ -0,0 +1,138 @@
+import logging
+from datetime import datetime, timezone
+
+from index_consolidation import serves
+
+UNUSED = "unused"
+REDUNDANT = "redundant"
+DUPLICATE = "duplicate"
+# Counters younger than this say little about whether an index is needed (they reset on every restart)
+DEFAULT_MIN_OBSERVATION_S = 7 * 86400
+
+logger = logging.getLogger(__name__)
+
+
+def _options(index):
+    """Index options that change which queries an index can serve or what it enforces"""
+    return (str(index.get("partialFilterExpression")), bool(index.get("sparse")), str(index.get("collation")))
+
+
+def _is_btree(index):
+    return all(isinstance(direction, (int, float)) for _, direction in index["key"])
+
+
+def drop_blocker(index):
+    """Why an index must never be dropped by the audit, or None"""
+    if index["name"] == "_id_":
+        return "the _id index cannot be dropped"
+    if index.get("unique"):
+        return "enforces a unique constraint"
+    if "expireAfterSeconds" in index:
+        return "TTL index removes expired documents"
+    if any(direction == "hashed" for _, direction in index["key"]):
+        return "hashed index may back a shard key"
+
+    return None
+
+
+def _observed_for_s(since, now):
+    if since is None:
+        return 0
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+
+    return (now - since).total_seconds()
+
+
+def audit_indexes(collection, indexes, index_stats=None, storage_stats=None, min_observation_s=DEFAULT_MIN_OBSERVATION_S, now=None):
+    """Flag duplicate, redundant-prefix and unused indexes of one collection with the space dropping them frees
+
+    A duplicate has the same keys (or all directions reversed) and options as another index; a redundant index is a
+    key prefix of a wider index with the same options, so the wider one serves all its queries. Unused means zero
+    $indexStats accesses over at least min_observation_s. Indexes that enforce something (unique, TTL, _id, possible shard keys) are never flagged.
+    """
+    index_stats = index_stats or {}
+    storage_stats = storage_stats or {}
+    now = now or datetime.now(timezone.utc)
+    index_sizes = storage_stats.get("indexSizes", {})
+    index_cache_bytes = storage_stats.get("indexCacheBytes", {})
+
+    def finding(index, issue, reason, covered_by=None):
+        stats = index_stats.get(index["name"], {})
+        return {"collection": collection, "name": index["name"], "key": index["key"], "issue": issue, "reason": reason, "covered_by": covered_by, "hidden": bool(index.get("hidden")), "accesses": stats.get("ops"), "since": stats.get("since"), "disk_bytes": index_sizes.get(index["name"], 0), "cache_bytes": index_cache_bytes.get(index["name"], 0)}
+
+    findings = []
+    flagged = set()
+    candidates = [index for index in indexes if not drop_blocker(index) and not index_stats.get(index["name"], {}).get("building")]
+
+    # Unused indexes first: one that is dropped cannot be the wider index a prefix is redundant with
+    for index in candidates:
+        stats = index_stats.get(index["name"])
+        if stats is None or stats.get("ops"):
+            continue
+
+        observed_s = _observed_for_s(stats.get("since"), now)
+        if observed_s >= min_observation_s:
+            findings.append(finding(index, UNUSED, f"no accesses in {observed_s / 86400:.1f} days"))
+            flagged.add(index["name"])
+
+    # Wider indexes first, so a prefix is reported against an index that is itself kept
+    keepers = set()
+    for index in sorted(candidates, key=lambda index: len(index["key"]), reverse=True):
+        if index["name"] in flagged or index["name"] in keepers:
+            continue
+
+        for other in indexes:
+            if other["name"] == index["name"] or other["name"] in flagged or other.get("hidden") or not _is_btree(index) or not _is_btree(other) or _options(index) != _options(other):
+                continue
+
+            if len(other["key"]) == len(index["key"]) and serves(other["key"], index["key"]):
+                # Keep whichever of the two is used more (or the one that enforces something)
+                if drop_blocker(other) or index_stats.get(other["name"], {}).get("ops", 0) >= index_stats.get(index["name"], {}).get("ops", 0):
+                    findings.append(finding(index, DUPLICATE, f"same keys and options as {other['name']} (directions may be reversed)", other["name"]))
+                    flagged.add(index["name"])
+                    keepers.add(other["name"])
+                    break
+            elif len(other["key"]) > len(index["key"]) and serves(other["key"], index["key"]):
+                findings.append(finding(index, REDUNDANT, f"key prefix of {other['name']}, which serves the same queries", other["name"]))
+                flagged.add(index["name"])
+                keepers.add(other["name"])
+                break
+
+    return findings
+
+
+def audit_database(db_queries, collections=None, min_observation_s=DEFAULT_MIN_OBSERVATION_S):
+    """Audit every collection and total the disk and cache space the flagged indexes occupy"""
+    findings = []
+    errors = {}
+
+    for collection in collections or db_queries.list_collections():
+        try:
+            findings.extend(audit_indexes(collection, db_queries.list_indexes(collection), db_queries.index_stats(collection), db_queries.collection_stats(collection).get("storageStats", {}), min_observation_s))
+        except Exception as e:
+            logger.error(f"Error auditing indexes on {collection}: {e}")
+            errors[collection] = str(e)
+
+    return {"findings": findings, "reclaimable_disk_bytes": sum(item["disk_bytes"] for item in findings), "reclaimable_cache_bytes": sum(item["cache_bytes"] for item in findings), "errors": errors}
+
+
+def drop_plan(findings):
+    """Guarded removal order: hide every flagged index first, and drop only those already hidden"""
+    return [{"collection": item["collection"], "name": item["name"], "action": "drop" if item["hidden"] else "hide", "reason": item["reason"]} for item in findings]
+
+
+def apply_plan_step(db_queries, step):
+    """Carry out one drop plan step; a drop is refused unless the index is currently hidden"""
+    if step["action"] == "hide":
+        return db_queries.hide_index(step["collection"], step["name"])
+    if step["action"] == "unhide":
+        return db_queries.hide_index(step["collection"], step["name"], hidden=False)
+
+    index = next((index for index in db_queries.list_indexes(step["collection"]) if index["name"] == step["name"]), None)
+    if index is None:
+        raise ValueError(f"Index {step['name']} not found on {step['collection']}")
+    if not index.get("hidden"):
+        raise ValueError(f"Index {step['name']} must be hidden and observed before it is dropped")
+
+    return db_queries.drop_index(step["collection"], step["name"])
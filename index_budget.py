@@ -0,0 +1,99 @@
+from index_consolidation import serves
+from partial_index import options_key
+
+# KeyString adds a type byte per key field; each entry also stores the record id of its document
+KEY_TYPE_BYTES = 1
+RECORD_ID_BYTES = 8
+DEFAULT_FIELD_BYTES = 8
+# B-tree pages are not kept full, so an index occupies more than the sum of its entries
+PAGE_OVERHEAD = 1.25
+
+
+def estimate_index_size(index_fields, document_count, field_stats=None, keys_per_document=1.0):
+    """Estimated entry count and uncompressed size in bytes of an index over a collection
+
+    Entry width comes from each field's average sampled value size; multikey fan-out multiplies the entry count.
+    Documents missing a field are still indexed (as null) unless the index is sparse or partial.
+    """
+    field_stats = field_stats or {}
+    key_bytes = sum((field_stats.get(field) or {}).get("avg_size_bytes") or DEFAULT_FIELD_BYTES for field in index_fields)
+    entry_bytes = key_bytes + KEY_TYPE_BYTES * len(index_fields) + RECORD_ID_BYTES
+    entries = document_count * keys_per_document
+
+    return {"entries": entries, "bytes": int(entries * entry_bytes * PAGE_OVERHEAD)}
+
+
+def _shape_key(collection, shape):
+    return collection, shape.get("shape_hash"), tuple(tuple(key) for key in shape.get("index_spec") or [])
+
+
+def _shapes(recommendation):
+    """Shapes a recommended index serves, each with its share of the read benefit"""
+    shapes = recommendation.get("serves") or [{"shape_hash": recommendation.get("shape_hash"), "index_spec": recommendation.get("index_spec"), "esr": recommendation.get("esr"), "potential_impact": recommendation.get("potential_impact", 0)}]
+    total_impact = sum(shape.get("potential_impact", 0) for shape in shapes)
+    read_benefit = recommendation.get("read_benefit_ms", total_impact)
+    scale = read_benefit / total_impact if total_impact else 0
+
+    return [(shape, shape.get("potential_impact", 0) * scale) for shape in shapes]
+
+
+def select_indexes(recommendations, budget_bytes):
+    """Choose the indexes that maximize workload benefit within a size budget
+
+    Benefit is counted per query shape, once, however many chosen indexes can serve it (an index also serves shapes
+    of other recommendations on the same collection when its keys fit them), minus each index's write cost. That
+    coverage objective is submodular, so candidates are added greedily by marginal benefit per byte, and the result
+    is compared against the best single index that fits, the usual guarantee for budgeted submodular selection.
+    Every recommendation needs an "estimated_size_bytes".
+    """
+    shape_benefits = {}
+    shape_kinds = {}
+    shape_options = {}
+    for recommendation in recommendations:
+        for shape, benefit in _shapes(recommendation):
+            key = _shape_key(recommendation["collection"], shape)
+            shape_benefits[key] = max(shape_benefits.get(key, 0), benefit)
+            shape_kinds[key] = shape.get("esr")
+            shape_options.setdefault(key, set()).add(options_key(recommendation.get("index_options")))
+
+    served_by = []
+    for recommendation in recommendations:
+        keys = [tuple(key) for key in recommendation["index_spec"]]
+        # A partial index only serves shapes that were matched to its own filter; a full index serves any shape
+        options = options_key(recommendation.get("index_options"))
+        served_by.append({key for key in shape_benefits if key[0] == recommendation["collection"] and (not recommendation.get("index_options") or options in shape_options[key]) and serves(keys, list(key[2]), shape_kinds[key])})
+
+    def marginal_benefit(position, covered):
+        recommendation = recommendations[position]
+        return sum(shape_benefits[key] for key in served_by[position] - covered) - recommendation.get("write_cost_ms", 0)
+
+    def evaluate(positions):
+        covered = set()
+        benefit = 0
+        for position in positions:
+            benefit += marginal_benefit(position, covered)
+            covered |= served_by[position]
+        return benefit
+
+    fitting = [position for position, recommendation in enumerate(recommendations) if recommendation["estimated_size_bytes"] <= budget_bytes]
+
+    chosen = []
+    covered = set()
+    used_bytes = 0
+    remaining = list(fitting)
+    while remaining:
+        best = max(remaining, key=lambda position: marginal_benefit(position, covered) / max(recommendations[position]["estimated_size_bytes"], 1))
+        remaining.remove(best)
+        if marginal_benefit(best, covered) <= 0 or used_bytes + recommendations[best]["estimated_size_bytes"] > budget_bytes:
+            continue
+
+        chosen.append(best)
+        covered |= served_by[best]
+        used_bytes += recommendations[best]["estimated_size_bytes"]
+
+    best_single = max(fitting, key=lambda position: marginal_benefit(position, set()), default=None)
+    if best_single is not None and marginal_benefit(best_single, set()) > evaluate(chosen):
+        chosen = [best_single]
+
+    selected = [recommendations[position] for position in chosen]
+    return {"selected": selected, "rejected": [recommendation for position, recommendation in enumerate(recommendations) if position not in chosen], "total_bytes": sum(recommendation["estimated_size_bytes"] for recommendation in selected), "total_benefit_ms": evaluate(chosen), "budget_bytes": budget_bytes}
@@ -0,0 +1,205 @@
+from query_shape import shape_fields
+
+EQUALITY = "equality"
+SORT = "sort"
+RANGE = "range"
+# Trailing keys that only exist so the projection can be answered from the index
+COVER = "cover"
+
+EQUALITY_OPERATORS = ["$eq", "$all"]
+RANGE_OPERATORS = ["$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$regex", "$exists", "$type", "$not", "$mod"]
+# Operators that need special index types (or none at all) and are left out of B-tree compound keys
+UNSUPPORTED_OPERATORS = ["$near", "$nearSphere", "$geoWithin", "$geoIntersects", "$size", "$bitsAllSet", "$bitsAnyClear", "$bitsAllClear", "$bitsAnySet", "$where"]
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and all(key.startswith("$") for key in value)
+
+
+def _classify_operators(operators, has_sort):
+    operator_names = [operator for operator in operators if operator != "$options"]
+
+    if any(operator in UNSUPPORTED_OPERATORS for operator in operator_names):
+        return None
+    if any(operator in RANGE_OPERATORS for operator in operator_names):
+        return RANGE
+    if "$in" in operator_names:
+        # A multi-value $in feeding a sort behaves like a range: the index returns one sorted run per value
+        values = operators.get("$in") or []
+        return RANGE if has_sort and len(values) > 1 else EQUALITY
+    if any(operator in EQUALITY_OPERATORS for operator in operator_names):
+        return EQUALITY
+
+    return RANGE
+
+
+def classify_predicates(query, has_sort=False, prefix=""):
+    """Classify every indexable predicate of a filter (outside $or) as equality or range, in first-seen order"""
+    predicates = []
+
+    for key, value in (query or {}).items():
+        if key == "$and" and isinstance(value, (list, tuple)):
+            for branch in value:
+                predicates.extend(classify_predicates(branch, has_sort, prefix))
+            continue
+
+        if key.startswith("$"):
+            continue
+
+        field = f"{prefix}.{key}" if prefix else key
+
+        if isinstance(value, dict) and isinstance(value.get("$elemMatch"), dict) and not _is_operator_dict(value["$elemMatch"]):
+            predicates.extend(classify_predicates(value["$elemMatch"], has_sort, field))
+        elif isinstance(value, dict) and "$elemMatch" in value:
+            predicates.append((field, _classify_operators(value["$elemMatch"], has_sort) or RANGE))
+        elif _is_operator_dict(value):
+            kind = _classify_operators(value, has_sort)
+            if kind:
+                predicates.append((field, kind))
+        else:
+            predicates.append((field, EQUALITY))
+
+    merged = {}
+    for field, kind in predicates:
+        # A field constrained by both an equality and a range is an equality match as far as key order goes
+        if merged.get(field) != EQUALITY:
+            merged[field] = kind
+
+    return list(merged.items())
+
+
+def or_branches(query):
+    """Split a filter with a top-level $or into one filter per branch, each carrying the shared predicates"""
+    query = query or {}
+    branches = query.get("$or")
+
+    if not isinstance(branches, (list, tuple)) or not branches:
+        return [query]
+
+    shared = {key: value for key, value in query.items() if key != "$or"}
+    return [{"$and": [shared, branch]} if shared else branch for branch in branches]
+
+
+def build_esr_index(query, sort=None, multikey_fields=None, equality_order=None):
+    """Order index keys Equality, Sort, Range with sort directions preserved
+
+    At most one multikey (array) field is kept, because a compound index cannot key two parallel arrays.
+    equality_order optionally maps a field to a sort key used to order the equality fields.
+    """
+    sort = sort or []
+    predicates = classify_predicates(query, has_sort=bool(sort))
+    multikey_fields = set(multikey_fields or [])
+
+    equality_fields = [field for field, kind in predicates if kind == EQUALITY]
+    range_fields = [field for field, kind in predicates if kind == RANGE]
+    if equality_order:
+        equality_fields.sort(key=equality_order)
+
+    index_spec = []
+    kinds = []
+    for field in equality_fields:
+        index_spec.append((field, 1))
+        kinds.append(EQUALITY)
+    for field, direction in sort:
+        if field not in equality_fields and field not in [key for key, _ in index_spec]:
+            index_spec.append((field, direction))
+            kinds.append(SORT)
+    for field in range_fields:
+        if field not in [key for key, _ in index_spec]:
+            index_spec.append((field, 1))
+            kinds.append(RANGE)
+
+    keyed_array = False
+    esr_spec = []
+    for (field, direction), kind in zip(index_spec, kinds):
+        if field in multikey_fields:
+            if keyed_array:
+                continue
+            keyed_array = True
+        esr_spec.append({"field": field, "direction": direction, "kind": kind})
+
+    return esr_spec
+
+
+def build_index_specs(query, sort=None, multikey_fields=None, equality_order=None):
+    """One ESR index per $or branch (or a single index when there is no top-level $or), duplicates removed"""
+    specs = []
+    seen = set()
+
+    for branch in or_branches(query):
+        esr_spec = build_esr_index(branch, sort, multikey_fields, equality_order)
+        key = tuple((key["field"], key["direction"]) for key in esr_spec)
+        if esr_spec and key not in seen:
+            seen.add(key)
+            specs.append(esr_spec)
+
+    return specs
+
+
+def equality_values(query):
+    """Literal value of each top-level equality predicate (including inside $and), keyed by field"""
+    values = {}
+
+    for key, value in (query or {}).items():
+        if key == "$and" and isinstance(value, (list, tuple)):
+            for branch in value:
+                values.update(equality_values(branch))
+        elif key.startswith("$"):
+            continue
+        elif isinstance(value, dict) and "$eq" in value:
+            values[key] = value["$eq"]
+        elif not _is_operator_dict(value):
+            values[key] = value
+
+    return values
+
+
+def projected_fields(projection):
+    """Fields an inclusion projection returns, ending with _id unless it is excluded; None when no index can cover it"""
+    if not projection:
+        return None
+
+    fields = []
+    include_id = True
+    for field, value in projection.items():
+        if value is not True and value is not False and value not in [0, 1]:
+            # $slice, $elemMatch and computed fields need the full document
+            return None
+        if field == "_id":
+            include_id = bool(value)
+        elif not value or "$" in field:
+            return None
+        else:
+            fields.append(field)
+
+    if not fields:
+        return None
+
+    return fields + (["_id"] if include_id else [])
+
+
+def build_covering_index(esr_spec, query, projection, multikey_fields=None, max_width=6):
+    """Extend an ESR index with the projected fields so the query is answered from index keys alone
+
+    Returns None when the projection cannot be covered: an exclusion or computed projection, a filter field the ESR
+    index leaves out, a multikey (array) field, or an index wider than max_width keys.
+    """
+    projected = projected_fields(projection)
+    if projected is None:
+        return None
+
+    index_fields = [key["field"] for key in esr_spec]
+    if not set(shape_fields(query)) <= set(index_fields):
+        return None
+
+    covering_spec = list(esr_spec)
+    for field in projected:
+        if field not in index_fields:
+            covering_spec.append({"field": field, "direction": 1, "kind": COVER})
+            index_fields.append(field)
+
+    multikey_fields = set(multikey_fields or [])
+    if len(covering_spec) > max_width or any(field in multikey_fields for field in index_fields):
+        return None
+
+    return covering_spec
@@ -0,0 +1,152 @@
+from index_builder import EQUALITY, SORT
+from partial_index import options_key
+
+
+def _keys(recommendation):
+    return [(field, direction) for field, direction in recommendation.get("index_spec") or [(field, 1) for field in recommendation.get("fields", [])]]
+
+
+def _kinds(recommendation, keys):
+    kinds = recommendation.get("esr")
+    return kinds if kinds and len(kinds) == len(keys) else [None] * len(keys)
+
+
+def serves(index_keys, candidate_keys, candidate_kinds=None):
+    """True when an index with index_keys can answer a query whose ideal ESR index is candidate_keys
+
+    Equality keys may appear in any order at the front of the index; the remaining keys must follow in order, with
+    sort keys matching direction either all the same or all reversed. Without kinds this is a plain prefix test.
+    """
+    candidate_kinds = candidate_kinds or [None] * len(candidate_keys)
+    if len(index_keys) < len(candidate_keys):
+        return False
+
+    equality_fields = {field for (field, _), kind in zip(candidate_keys, candidate_kinds) if kind == EQUALITY}
+    rest = [(key, kind) for key, kind in zip(candidate_keys, candidate_kinds) if kind != EQUALITY]
+
+    if {field for field, _ in index_keys[: len(equality_fields)]} != equality_fields:
+        return False
+
+    sort_direction = None
+    for position, ((field, direction), kind) in enumerate(rest):
+        index_field, index_direction = index_keys[len(equality_fields) + position]
+        if index_field != field:
+            return False
+
+        if kind == SORT or kind is None:
+            same = index_direction == direction
+            if sort_direction is None:
+                sort_direction = same
+            elif sort_direction != same:
+                return False
+
+    return True
+
+
+def _existing_options(index):
+    if index.get("partialFilterExpression"):
+        return {"partialFilterExpression": index["partialFilterExpression"]}
+
+    return {"sparse": True} if index.get("sparse") else {}
+
+
+def usable_existing_indexes(existing_indexes, index_options=None):
+    """Existing indexes that can serve the candidates: full B-tree indexes plus any created with exactly index_options
+
+    Hidden indexes, special index types and partial or sparse indexes with other filters never serve them.
+    """
+    usable = []
+
+    for index in existing_indexes:
+        options = _existing_options(index)
+        if index.get("hidden") or (options and options_key(options) != options_key(index_options)):
+            continue
+
+        keys = [(field, direction) for field, direction in index.get("key", [])]
+        if any(not isinstance(direction, (int, float)) for _, direction in keys):
+            continue
+
+        usable.append({"name": index.get("name"), "key": keys})
+
+    return usable
+
+
+def _served_shape(recommendation):
+    return {"shape_hash": recommendation.get("shape_hash"), "query_pattern": recommendation.get("query_pattern"), "example_query": recommendation.get("example_query"), "sort": recommendation.get("sort"), "projection": recommendation.get("projection"), "limit": recommendation.get("limit"), "pipeline": recommendation.get("pipeline"), "lookup_from": recommendation.get("lookup_from"), "execution_count": recommendation.get("execution_count", 0), "potential_impact": recommendation.get("potential_impact", 0), "index_spec": _keys(recommendation), "esr": _kinds(recommendation, _keys(recommendation))}
+
+
+def _reorder_to_serve(chosen, candidate):
+    """Try to reorder the leading equality keys of a chosen index so it also serves the candidate"""
+    keys = chosen["index_spec"]
+    kinds = chosen["esr"]
+    equality_block = 0
+    while equality_block < len(kinds) and kinds[equality_block] == EQUALITY:
+        equality_block += 1
+
+    candidate_keys = _keys(candidate)
+    candidate_kinds = _kinds(candidate, candidate_keys)
+    candidate_equality = [field for (field, _), kind in zip(candidate_keys, candidate_kinds) if kind == EQUALITY]
+
+    if not candidate_equality or not set(candidate_equality) <= {field for field, _ in keys[:equality_block]}:
+        return None
+
+    leading = [key for key in keys[:equality_block] if key[0] in candidate_equality]
+    trailing = [key for key in keys[:equality_block] if key[0] not in candidate_equality]
+    reordered = leading + trailing + keys[equality_block:]
+
+    shapes = chosen["serves"] + [_served_shape(candidate)]
+    if all(serves(reordered, shape["index_spec"], shape["esr"]) for shape in shapes):
+        return reordered
+
+    return None
+
+
+def consolidate_recommendations(recommendations, existing_indexes_by_collection=None):
+    """Merge per-shape recommendations into the fewest compound indexes that serve every shape
+
+    Returns (consolidated, suppressed): suppressed lists recommendations already served by an existing index.
+    """
+    existing_indexes_by_collection = existing_indexes_by_collection or {}
+    consolidated = []
+    suppressed = []
+
+    # Partial and sparse candidates only merge with candidates that have the same filter
+    by_collection = {}
+    for recommendation in recommendations:
+        by_collection.setdefault((recommendation["collection"], options_key(recommendation.get("index_options"))), []).append(recommendation)
+
+    for (collection, _), candidates in by_collection.items():
+        existing = usable_existing_indexes(existing_indexes_by_collection.get(collection, []), candidates[0].get("index_options"))
+        chosen = []
+
+        for candidate in sorted(candidates, key=lambda rec: (len(_keys(rec)), rec.get("potential_impact", 0)), reverse=True):
+            keys = _keys(candidate)
+            kinds = _kinds(candidate, keys)
+
+            covering_index = next((index for index in existing if serves(index["key"], keys, kinds)), None)
+            if covering_index:
+                suppressed.append({**candidate, "suppressed_reason": f"served by existing index {covering_index['name']}"})
+                continue
+
+            target = next((index for index in chosen if serves(index["index_spec"], keys, kinds)), None)
+            if target is None:
+                for index in chosen:
+                    reordered = _reorder_to_serve(index, candidate)
+                    if reordered:
+                        index["index_spec"] = reordered
+                        index["fields"] = [field for field, _ in reordered]
+                        target = index
+                        break
+
+            if target is None:
+                chosen.append({**candidate, "index_spec": keys, "esr": kinds, "serves": [_served_shape(candidate)]})
+                continue
+
+            target["serves"].append(_served_shape(candidate))
+            target["execution_count"] = target.get("execution_count", 0) + candidate.get("execution_count", 0)
+            target["potential_impact"] = target.get("potential_impact", 0) + candidate.get("potential_impact", 0)
+            target["wasted_work"] = (target.get("wasted_work") or 0) + (candidate.get("wasted_work") or 0)
+
+        consolidated.extend(chosen)
+
+    return consolidated, suppressed
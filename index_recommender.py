@@ -1,51 +1,320 @@
+import ast
 import json
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from bson import json_util
+from timing_stats import summarize_timings
+from instrumentation import stage
+from explain_analyzer import analyze_explain, wasted_work
+from index_builder import COVER, EQUALITY, build_covering_index, build_index_specs, equality_values, projected_fields
+from write_cost import WriteCostModel, record_writes, write_mix_from_stats
+from field_stats import MISSING, FieldStatsCache, equality_selectivity, is_low_cardinality
+from index_budget import estimate_index_size, select_indexes
+from index_consolidation import consolidate_recommendations
+from index_validation import replayable_shapes
+from metrics_store import collection_fingerprint, workload_item_key
+from partial_index import DEFAULT_MAX_SUBSET, DEFAULT_MIN_EXECUTIONS, DEFAULT_MIN_SHARE, index_options, merge_tallies, partial_filter, query_can_use, recurring_constants
+from pipeline_analysis import analyze_pipeline, index_sort
+from query_shape import pipeline_hash, pipeline_string, shape_fields, shape_hash, shape_string
+from workload_ingest import aggregate_ops, aggregates_to_results, filter_slow_ops, follow_profile, iter_log_lines, parse_log_lines, parse_profile_entries
+
+# Profile ingestion tails system.profile until it has been quiet this long, or for at most the second bound
+DEFAULT_PROFILE_IDLE_S = 10
+DEFAULT_PROFILE_MAX_S = 300
+
+logger = logging.getLogger(__name__)
 
 
 class IndexRecommender:
-    def __init__(self, db_queries):
+    def __init__(self, db_queries, max_workers=1, max_per_collection=None, warmup=1, trials=5, slow_threshold_ms=50, rank_percentile="p95", max_docs_examined_ratio=2.0, max_selectivity=0.5, field_stats=None, write_cost_model=None, metrics_store=None, max_index_width=6, partial_indexes=True, min_constant_share=DEFAULT_MIN_SHARE, min_constant_executions=DEFAULT_MIN_EXECUTIONS, max_partial_subset=DEFAULT_MAX_SUBSET):
         self.db_queries = db_queries
+        self.max_workers = max_workers
+        self.max_per_collection = max_per_collection
+        self.warmup = warmup
+        self.trials = trials
+        self.slow_threshold_ms = slow_threshold_ms
+        self.rank_percentile = rank_percentile
+        self.max_docs_examined_ratio = max_docs_examined_ratio
+        self.max_selectivity = max_selectivity
+        self.max_index_width = max_index_width
+        self.partial_indexes = partial_indexes
+        self.min_constant_share = min_constant_share
+        self.min_constant_executions = min_constant_executions
+        self.max_partial_subset = max_partial_subset
+        self.field_stats = field_stats or FieldStatsCache(db_queries)
+        self.write_cost_model = write_cost_model or WriteCostModel()
+        self.metrics_store = metrics_store
+        self.run_id = None
+        self.write_mixes = {}
         self.query_results = []
+        self.failed_items = []
         self.recommendations = []
+        self.suppressed_recommendations = []
 
-    def run_test_queries(self, queries_file_path="queries.json"):
-        """Run test queries from JSON file and collect performance data"""
-        self.query_results = []
+    def load_workload(self, queries_file_path="queries.json"):
+        """Flatten a queries JSON file into (collection, query_item) jobs in file order"""
+        with stage("load"):
+            with open(queries_file_path, "r") as f:
+                # Extended JSON ({"$date": ...}, {"$oid": ...}) lets a workload file carry BSON literals
+                query_data = json_util.loads(f.read())
 
-        with open(queries_file_path, "r") as f:
-            query_data = json.load(f)
+            all_collections = set(self.db_queries.list_collections())
 
-        for collection_data in query_data.get("queries", []):
-            collection_name = collection_data.get("collection")
+            jobs = []
+            for collection_data in query_data.get("queries", []):
+                collection_name = collection_data.get("collection")
 
-            all_collections = self.db_queries.list_collections()
-            if collection_name not in all_collections:
-                print(f"Collection {collection_name} not found in database. Skipping...")
-                continue
+                if collection_name not in all_collections:
+                    logger.warning(f"Collection {collection_name} not found in database. Skipping...")
+                    continue
 
-            for query_item in collection_data.get("queries", []):
-                query = query_item.get("query", {})
-                projection = query_item.get("projection")
+                for query_item in collection_data.get("queries", []):
+                    jobs.append((collection_name, query_item))
 
-                sort = None
-                if query_item.get("sort"):
-                    sort = []
-                    for sort_item in query_item.get("sort"):
-                        if isinstance(sort_item, list) and len(sort_item) == 2:
-                            sort.append((sort_item[0], sort_item[1]))
+        return jobs
 
-                limit = query_item.get("limit", 100)
+    def _parse_sort(self, sort_items):
+        if not sort_items:
+            return None
 
-                try:
-                    results, execution_time_ms, explain = self.db_queries.execute_query(collection_name, query, projection, sort, limit)
-                    is_indexed = "COLLSCAN" not in str(explain)
-                    result = {"collection": collection_name, "query": query, "query_name": query_item.get("name", ""), "query_shape": str(query), "execution_time_ms": execution_time_ms, "is_indexed": is_indexed, "result_count": len(results)}
-                    self.query_results.append(result)
-                    print(f"Executed {query_item.get('name')} on {collection_name}: {execution_time_ms:.2f}ms, indexed: {is_indexed}")
+        sort = []
+        for sort_item in sort_items:
+            if isinstance(sort_item, list) and len(sort_item) == 2:
+                sort.append((sort_item[0], sort_item[1]))
+
+        return sort
+
+    def run_query_item(self, collection_name, query_item, warmup=None, trials=None):
+        """Execute a single workload entry and return its result record, or None on error"""
+        warmup = self.warmup if warmup is None else warmup
+        trials = self.trials if trials is None else trials
+
+        if "pipeline" in query_item:
+            return self.run_pipeline_item(collection_name, query_item, warmup, trials)
+
+        query = query_item.get("query", {})
+        projection = query_item.get("projection")
+        sort = self._parse_sort(query_item.get("sort"))
+        limit = query_item.get("limit", 100)
+
+        try:
+            results, timing, explain = self.db_queries.benchmark_query(collection_name, query, projection, sort, limit, warmup=warmup, trials=trials)
+            execution_time_ms = timing["p50_ms"]
+            plan = analyze_explain(explain)
+            is_indexed = plan["is_indexed"]
+            result = {"collection": collection_name, "query": query, "query_name": query_item.get("name", ""), "query_shape": shape_string(query), "shape_hash": shape_hash(query, sort, projection), "sort": sort, "projection": projection, "limit": limit, "execution_time_ms": execution_time_ms, "timing": timing, "is_indexed": is_indexed, "plan": plan, "result_count": timing.get("documents", len(results))}
+            logger.info(f"Executed {query_item.get('name')} on {collection_name}: p50 {execution_time_ms:.2f}ms, p95 {timing['p95_ms']:.2f}ms over {timing['trials']} trials, indexed: {is_indexed}, docs examined/returned: {plan['docs_examined_per_returned']:.1f}", extra={"collection": collection_name, "query_name": result["query_name"], "shape_hash": result["shape_hash"], "p50_ms": execution_time_ms, "p95_ms": timing["p95_ms"], "is_indexed": is_indexed})
+            return result
+
+        except Exception as e:
+            logger.error(f"Error executing query {query_item.get('name')} on {collection_name}: {e}")
+            return None
 
-                except Exception as e:
-                    print(f"Error executing query {query_item.get('name')} on {collection_name}: {e}")
+    def run_pipeline_item(self, collection_name, query_item, warmup=None, trials=None):
+        """Execute an aggregation workload entry; its leading $match and $sort (or $group keys) stand in for the query"""
+        warmup = self.warmup if warmup is None else warmup
+        trials = self.trials if trials is None else trials
 
-            return self.query_results
+        pipeline = query_item.get("pipeline", [])
+        analysis = analyze_pipeline(pipeline)
+
+        try:
+            results, timing, explain = self.db_queries.benchmark_aggregate(collection_name, pipeline, warmup=warmup, trials=trials)
+            execution_time_ms = timing["p50_ms"]
+            plan = analyze_explain(explain)
+            is_indexed = plan["is_indexed"]
+            result = {"collection": collection_name, "query": analysis["filter"], "query_name": query_item.get("name", ""), "query_shape": pipeline_string(pipeline), "shape_hash": pipeline_hash(pipeline), "sort": index_sort(analysis), "projection": None, "limit": None, "pipeline": pipeline, "lookups": analysis["lookups"], "execution_time_ms": execution_time_ms, "timing": timing, "is_indexed": is_indexed, "plan": plan, "result_count": timing.get("documents", len(results))}
+            logger.info(f"Executed pipeline {query_item.get('name')} on {collection_name}: p50 {execution_time_ms:.2f}ms, p95 {timing['p95_ms']:.2f}ms over {timing['trials']} trials, indexed: {is_indexed}, lookups: {len(analysis['lookups'])}", extra={"collection": collection_name, "query_name": result["query_name"], "shape_hash": result["shape_hash"], "p50_ms": execution_time_ms, "p95_ms": timing["p95_ms"], "is_indexed": is_indexed})
+            return result
+
+        except Exception as e:
+            logger.error(f"Error executing pipeline {query_item.get('name')} on {collection_name}: {e}")
+            return None
+
+    def _replay_threaded(self, run_item, jobs, max_workers, max_per_collection):
+        """Replay jobs on a thread pool, never running more than max_per_collection at once per collection"""
+        slots = [None] * len(jobs)
+        pending = {}
+        for position, (collection_name, query_item) in enumerate(jobs):
+            pending.setdefault(collection_name, deque()).append(position)
+
+        running = {}
+        active = {collection_name: 0 for collection_name in pending}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for collection_name in list(pending):
+                    while pending.get(collection_name) and len(running) < max_workers and (not max_per_collection or active[collection_name] < max_per_collection):
+                        position = pending[collection_name].popleft()
+                        future = executor.submit(run_item, *jobs[position])
+                        running[future] = (position, collection_name)
+                        active[collection_name] += 1
+
+                    if not pending.get(collection_name):
+                        pending.pop(collection_name, None)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    position, collection_name = running.pop(future)
+                    active[collection_name] -= 1
+                    slots[position] = future.result()
+
+        return slots
+
+    async def _replay_async(self, run_item, jobs, max_workers, max_per_collection):
+        """Replay jobs as asyncio tasks that drive the blocking driver calls on worker threads"""
+        global_limit = asyncio.Semaphore(max_workers)
+        collection_limits = {}
+        for collection_name, _ in jobs:
+            if max_per_collection and collection_name not in collection_limits:
+                collection_limits[collection_name] = asyncio.Semaphore(max_per_collection)
+
+        async def run_job(collection_name, query_item):
+            collection_limit = collection_limits.get(collection_name)
+            if collection_limit:
+                async with collection_limit:
+                    async with global_limit:
+                        return await asyncio.to_thread(run_item, collection_name, query_item)
+
+            async with global_limit:
+                return await asyncio.to_thread(run_item, collection_name, query_item)
+
+        return await asyncio.gather(*(run_job(collection_name, query_item) for collection_name, query_item in jobs))
+
+    async def run_test_queries_async(self, queries_file_path="queries.json", max_workers=None, max_per_collection=None, warmup=None, trials=None, incremental=True):
+        """Asyncio driver for run_test_queries, for callers that already own an event loop"""
+        run_item = partial(self.run_query_item, warmup=warmup, trials=trials)
+        item_key = self._item_key_function(warmup, trials)
+        jobs = await asyncio.to_thread(self.load_workload, queries_file_path)
+        slots, pending, fingerprints = await asyncio.to_thread(self._split_cached, jobs, incremental, item_key)
+
+        replayed = await self._replay_async(run_item, [jobs[position] for position in pending], max_workers or self.max_workers, max_per_collection or self.max_per_collection)
+        await asyncio.to_thread(self._store_replayed, jobs, slots, pending, replayed, fingerprints, item_key)
+
+        self.query_results = [result for result in slots if result is not None]
+        return self.query_results
+
+    def run_test_queries(self, queries_file_path="queries.json", max_workers=None, max_per_collection=None, use_asyncio=False, warmup=None, trials=None, incremental=True):
+        """Run test queries from JSON file and collect performance data
+
+        Results are returned in workload file order regardless of how many workers replayed them. With a metrics store
+        and incremental set, entries whose collection's index set and size bucket are unchanged are served from the store.
+        """
+        max_workers = max_workers or self.max_workers
+        max_per_collection = max_per_collection or self.max_per_collection
+
+        if use_asyncio:
+            return asyncio.run(self.run_test_queries_async(queries_file_path, max_workers, max_per_collection, warmup, trials, incremental))
+
+        self.query_results = []
+        run_item = partial(self.run_query_item, warmup=warmup, trials=trials)
+        item_key = self._item_key_function(warmup, trials)
+        jobs = self.load_workload(queries_file_path)
+        slots, pending, fingerprints = self._split_cached(jobs, incremental, item_key)
+        pending_jobs = [jobs[position] for position in pending]
+
+        if max_workers <= 1:
+            replayed = [run_item(collection_name, query_item) for collection_name, query_item in pending_jobs]
+        else:
+            replayed = self._replay_threaded(run_item, pending_jobs, max_workers, max_per_collection)
+
+        self._store_replayed(jobs, slots, pending, replayed, fingerprints, item_key)
+
+        self.query_results = [result for result in slots if result is not None]
+        return self.query_results
+
+    def collection_fingerprints(self, collections):
+        """Index-set and size-bucket fingerprint per collection; None when it cannot be read, which forces a rerun"""
+        fingerprints = {}
+        for collection in collections:
+            try:
+                fingerprints[collection] = collection_fingerprint(self.db_queries.list_indexes(collection), self.db_queries.estimated_document_count(collection))
+            except Exception as e:
+                logger.error(f"Error fingerprinting {collection}: {e}")
+                fingerprints[collection] = None
+
+        return fingerprints
+
+    def _item_key_function(self, warmup=None, trials=None):
+        """Metrics store key of a workload entry replayed with these settings; a result measured differently is not reused"""
+        warmup = self.warmup if warmup is None else warmup
+        trials = self.trials if trials is None else trials
+        return partial(workload_item_key, warmup=warmup, trials=trials, drain=self.db_queries.drain)
+
+    def _split_cached(self, jobs, incremental=True, item_key=workload_item_key):
+        """Fill result slots from the metrics store and return the positions of the jobs that still have to run"""
+        slots = [None] * len(jobs)
+        if not self.metrics_store:
+            return slots, list(range(len(jobs))), {}
+
+        fingerprints = self.collection_fingerprints({collection_name for collection_name, _ in jobs})
+        pending = []
+        for position, (collection_name, query_item) in enumerate(jobs):
+            fingerprint = fingerprints.get(collection_name)
+            cached = self.metrics_store.cached_result(collection_name, item_key(query_item), fingerprint) if incremental and fingerprint else None
+
+            if cached is None:
+                pending.append(position)
+            else:
+                slots[position] = {**cached, "cached": True}
+
+        if incremental:
+            logger.info(f"Reusing {len(jobs) - len(pending)} stored results; re-executing {len(pending)} of {len(jobs)} workload entries")
+        return slots, pending, fingerprints
+
+    def _store_replayed(self, jobs, slots, pending, replayed, fingerprints, item_key=workload_item_key):
+        self.failed_items = []
+        for position, result in zip(pending, replayed):
+            slots[position] = result
+            if result is None:
+                collection_name, query_item = jobs[position]
+                self.failed_items.append({"collection": collection_name, "query_name": query_item.get("name", "")})
+
+        if not self.metrics_store:
+            return
+
+        stored = [(result, item_key(jobs[position][1])) for position, result in zip(pending, replayed) if result is not None]
+        self.run_id = self.metrics_store.start_run("workload")
+        self.metrics_store.record_results(self.run_id, [result for result, _ in stored], [item_key for _, item_key in stored], fingerprints)
+
+    def ingest_workload(self, ops, slow_ms=100, op_types=("find", "aggregate"), max_shapes=100000, append=False):
+        """Aggregate a stream of normalized operations into query results without holding the raw stream"""
+        if not append:
+            self.write_mixes = {}
+            self.failed_items = []
+
+        with stage("aggregate"):
+            aggregated = aggregate_ops(filter_slow_ops(record_writes(ops, self.write_mixes), slow_ms, op_types), max_shapes=max_shapes)
+            if aggregated["overflow"]:
+                logger.warning(f"Workload exceeded {max_shapes} distinct shapes; {aggregated['overflow']} operations were not tracked")
+
+            results = aggregates_to_results(aggregated)
+        if self.metrics_store:
+            self.run_id = self.metrics_store.start_run(results[0]["source"] if results else "ingest")
+            self.metrics_store.record_results(self.run_id, results)
+
+        self.query_results = (self.query_results if append else []) + results
+        return self.query_results
+
+    def ingest_profile(self, since=None, tailable=True, idle_timeout_s=DEFAULT_PROFILE_IDLE_S, max_duration_s=DEFAULT_PROFILE_MAX_S, **kwargs):
+        """Ingest real traffic recorded by the database profiler in system.profile
+
+        By default the capped collection is tailed, so operations arriving during ingestion are included, until no new
+        entry arrived for idle_timeout_s or max_duration_s passed. With tailable off only the current contents are read.
+        """
+        entries = follow_profile(self.db_queries, since=since, tailable=tailable, idle_timeout_s=idle_timeout_s, max_duration_s=max_duration_s)
+        return self.ingest_workload(parse_profile_entries(entries), **kwargs)
+
+    def ingest_logs(self, paths, **kwargs):
+        """Ingest slow queries from mongod structured JSON logs, including rotated and gzip-compressed files"""
+        return self.ingest_workload(parse_log_lines(iter_log_lines(paths)), **kwargs)
 
     def _extract_query_fields(self, query, prefix=""):
         fields = []
@@ -67,60 +336,75 @@ class IndexRecommender:
         return fields
 
     def extract_fields_from_query_shape(self, query_shape):
-        """Extract field names from a query using pure JSON parsing without regex"""
-        fields = []
-
-        if not query_shape or query_shape in ["{}", "{}"]:
-            return fields
+        """Extract field paths from a query or canonical query shape, including $and/$or branches and $elemMatch paths"""
+        if not query_shape or query_shape == "{}":
+            return []
 
-        try:
-            if isinstance(query_shape, str):
+        if isinstance(query_shape, str):
+            try:
+                query_shape = json.loads(query_shape)
+            except json.JSONDecodeError:
                 try:
-                    cleaned_shape = query_shape.replace("'", '"')
-                    query_dict = json.loads(cleaned_shape)
-                except json.JSONDecodeError:
-                    first_field = query_shape.split(":")[0].strip().strip("{").strip("\"'")
-                    if first_field and not first_field.startswith("$"):
-                        return [first_field]
+                    query_shape = ast.literal_eval(query_shape)
+                except (ValueError, SyntaxError) as e:
+                    logger.warning(f"Error extracting fields: {e}")
                     return []
-            else:
-                query_dict = query_shape
 
-            for field in query_dict:
-                if field and not field.startswith("$") and not field.isdigit() and field not in ["type", "coordinates", "geometry"]:
-                    fields.append(field)
+        return shape_fields(query_shape)
 
-            return fields
+    def is_efficient_plan(self, plan):
+        """A plan is efficient when it uses an index, avoids a blocking sort and examines few documents per result"""
+        if not plan:
+            return False
 
-        except Exception as e:
-            print(f"Error extracting fields: {e}")
-            return []
+        return plan["is_indexed"] and not plan["has_in_memory_sort"] and plan["docs_examined_per_returned"] <= self.max_docs_examined_ratio
 
-    def recommend_indexes(self):
+    @stage("recommend")
+    def recommend_indexes(self, consolidate=True, write_mixes=None, record_history=True, verify_covering=False, verify_partial=False):
+        self.suppressed_recommendations = []
         if not self.query_results:
-            print("No query results found. Running test queries...")
-            self.run_test_queries()
+            logger.warning("No query results to analyze; run or ingest a workload first")
+            self.recommendations = []
+            return self.recommendations
 
         query_patterns = {}
         for result in self.query_results:
-            query_pattern = str(result.get("query_shape", {}))
             collection = result.get("collection", "")
-
-            if (query_pattern, collection) in query_patterns:
-                query_patterns[(query_pattern, collection)]["count"] += 1
-                query_patterns[(query_pattern, collection)]["total_time"] += result.get("execution_time_ms", 0)
+            fingerprint = result.get("shape_hash") or shape_hash(result.get("query", {}), result.get("sort"), result.get("projection"))
+            samples_ms = (result.get("timing") or {}).get("samples_ms") or [result.get("execution_time_ms", 0)]
+            plan = result.get("plan")
+            execution_count = result.get("execution_count", 1)
+            # Only ingested shapes carry a tally of observed constants; a replayed example's literal says nothing about recurrence
+            constants = result.get("constants") or {}
+
+            if (fingerprint, collection) in query_patterns:
+                stats = query_patterns[(fingerprint, collection)]
+                stats["count"] += execution_count
+                merge_tallies(stats["constants"], constants)
+                stats["samples_ms"].extend(samples_ms)
+                stats["wasted_work"] += wasted_work(plan) * execution_count
+                if plan and wasted_work(plan) >= wasted_work(stats["plan"]):
+                    stats["plan"] = plan
             else:
-                query_patterns[(query_pattern, collection)] = {"count": 1, "total_time": result.get("execution_time_ms", 0), "collection": collection, "is_indexed": result.get("is_indexed", False)}
+                query_patterns[(fingerprint, collection)] = {"query_shape": result.get("query_shape") or shape_string(result.get("query", {})), "example_query": result.get("query", {}), "sort": result.get("sort"), "projection": result.get("projection"), "limit": result.get("limit"), "count": execution_count, "samples_ms": list(samples_ms), "collection": collection, "is_indexed": result.get("is_indexed", False), "plan": plan, "wasted_work": wasted_work(plan) * execution_count, "pipeline": result.get("pipeline"), "lookups": result.get("lookups") or [], "constants": merge_tallies({}, constants)}
 
         candidates = []
-        for (pattern, collection), stats in query_patterns.items():
-            if stats.get("is_indexed", False):
-                continue
+        for (fingerprint, collection), stats in query_patterns.items():
+            distribution = summarize_timings(stats["samples_ms"])
+            rank_time = distribution[f"{self.rank_percentile}_ms"]
 
-            avg_time = stats["total_time"] / stats["count"] if stats["count"] > 0 else 0
+            if rank_time > self.slow_threshold_ms:
+                # The outer plan says nothing about how the foreign collection is probed, so lookups are always candidates
+                candidates.extend(self.lookup_candidates(collection, stats, distribution, rank_time))
 
-            if (avg_time > 50 and stats["count"] >= 1) or avg_time > 100:
-                candidates.append({"pattern": pattern, "avg_execution_time_ms": avg_time, "execution_count": stats["count"], "collection": stats["collection"]})
+            plan = stats.get("plan")
+            if plan is not None and self.is_efficient_plan(plan):
+                continue
+            if plan is None and stats.get("is_indexed", False):
+                continue
+
+            if rank_time > self.slow_threshold_ms:
+                candidates.append({"pattern": stats["query_shape"], "shape_hash": fingerprint, "example_query": stats["example_query"], "sort": stats["sort"], "projection": stats["projection"], "limit": stats["limit"], "pipeline": stats["pipeline"], "avg_execution_time_ms": distribution["mean_ms"], "p50_ms": distribution["p50_ms"], "p95_ms": distribution["p95_ms"], "p99_ms": distribution["p99_ms"], "stddev_ms": distribution["stddev_ms"], "rank_time_ms": rank_time, "execution_count": stats["count"], "collection": stats["collection"], "plan": plan, "wasted_work": stats["wasted_work"], "constants": stats["constants"]})
 
         recommendations = []
         for candidate in candidates:
@@ -129,17 +413,327 @@ class IndexRecommender:
                 continue
 
             query_pattern = candidate.get("pattern")
-            fields = self.extract_fields_from_query_shape(query_pattern)
+            query = candidate.get("example_query") or {}
+            sort = candidate.get("sort")
+            fields = self.extract_fields_from_query_shape(query or query_pattern) + [field for field, _ in (sort or []) if field]
+
+            if not fields:
+                continue
 
-            if fields:
-                recommendation = {"collection": collection, "fields": fields, "query_pattern": query_pattern, "avg_execution_time_ms": candidate.get("avg_execution_time_ms"), "execution_count": candidate.get("execution_count"), "potential_impact": candidate.get("avg_execution_time_ms") * candidate.get("execution_count")}
+            projection = candidate.get("projection")
+            field_stats = self.collect_field_stats(collection, fields + [field for field in projected_fields(projection) or [] if field not in fields])
+            multikey_fields = {field for field, stats in field_stats.items() if stats["is_array"]}
+            example_values = equality_values(query)
+            index_specs = build_index_specs(query, sort, multikey_fields, lambda field: equality_selectivity(field_stats.get(field), example_values.get(field, MISSING)))
+
+            for branch, esr_spec in enumerate(index_specs):
+                selectivity = self.estimate_selectivity(esr_spec, field_stats, example_values)
+                narrows_scan = any(key["kind"] != EQUALITY for key in esr_spec) or selectivity <= self.max_selectivity
+                if field_stats and not narrows_scan and all(is_low_cardinality(field_stats.get(key["field"])) for key in esr_spec if key["kind"] == EQUALITY):
+                    self.suppressed_recommendations.append({"collection": collection, "fields": [key["field"] for key in esr_spec], "index_spec": [(key["field"], key["direction"]) for key in esr_spec], "query_pattern": query_pattern, "estimated_selectivity": selectivity, "suppressed_reason": f"low-cardinality keys would still match ~{selectivity:.0%} of documents"})
+                    continue
+
+                covering_spec = build_covering_index(esr_spec, query, projection, multikey_fields, self.max_index_width)
+                if covering_spec:
+                    esr_spec = covering_spec
+
+                recommendation = {"estimated_selectivity": selectivity, "covering": bool(covering_spec), "collection": collection, "fields": [key["field"] for key in esr_spec], "index_spec": [(key["field"], key["direction"]) for key in esr_spec], "esr": [key["kind"] for key in esr_spec], "or_branch": branch if len(index_specs) > 1 else None, "query_pattern": query_pattern, "shape_hash": candidate.get("shape_hash"), "example_query": candidate.get("example_query"), "sort": sort, "projection": candidate.get("projection"), "limit": candidate.get("limit"), "pipeline": candidate.get("pipeline"), "lookup_from": candidate.get("lookup_from"), "avg_execution_time_ms": candidate.get("avg_execution_time_ms"), "p50_ms": candidate.get("p50_ms"), "p95_ms": candidate.get("p95_ms"), "p99_ms": candidate.get("p99_ms"), "stddev_ms": candidate.get("stddev_ms"), "execution_count": candidate.get("execution_count"), "potential_impact": candidate.get("rank_time_ms") * candidate.get("execution_count"), "wasted_work": candidate.get("wasted_work"), "plan_stages": (candidate.get("plan") or {}).get("stages", []), "docs_examined_per_returned": (candidate.get("plan") or {}).get("docs_examined_per_returned"), "has_in_memory_sort": (candidate.get("plan") or {}).get("has_in_memory_sort", False)}
+                if self.partial_indexes:
+                    self.apply_partial_filter(recommendation, candidate.get("constants"), field_stats)
                 recommendations.append(recommendation)
 
-        recommendations.sort(key=lambda x: x.get("potential_impact", 0), reverse=True)
+        if consolidate:
+            recommendations = self.consolidate(recommendations)
+
+        if verify_covering:
+            for recommendation in recommendations:
+                if recommendation.get("covering"):
+                    self.check_covering(recommendation)
+
+        if verify_partial:
+            for recommendation in recommendations:
+                if recommendation.get("index_options"):
+                    self.check_partial(recommendation)
+
+        recommendations = self.apply_write_costs(recommendations, write_mixes)
+        self.estimate_index_sizes(recommendations)
+        recommendations.sort(key=lambda x: (x.get("net_benefit_ms", 0), x.get("wasted_work", 0)), reverse=True)
+        if self.metrics_store and record_history:
+            self.metrics_store.record_recommendations(self.run_id or self.metrics_store.start_run("recommend"), recommendations)
+
         self.recommendations = recommendations
         return recommendations
 
+    def lookup_candidates(self, collection, stats, distribution, rank_time):
+        """Candidates for the foreign collection of every $lookup, keyed on the fields each input document probes"""
+        candidates = []
+
+        for lookup in stats.get("lookups", []):
+            # One equality probe per input document; the literal is unknown, so a placeholder stands in for it
+            lookup_query = {field: "?lookup" for field in lookup["fields"]}
+            local_field = lookup.get("local_field") or "let"
+            candidates.append({"pattern": f"$lookup from {collection}.{local_field} on {', '.join(lookup['fields'])}", "shape_hash": shape_hash({"$lookup": collection, **lookup_query}), "example_query": lookup_query, "sort": None, "projection": None, "limit": None, "pipeline": None, "lookup_from": collection, "avg_execution_time_ms": distribution["mean_ms"], "p50_ms": distribution["p50_ms"], "p95_ms": distribution["p95_ms"], "p99_ms": distribution["p99_ms"], "stddev_ms": distribution["stddev_ms"], "rank_time_ms": rank_time, "execution_count": stats["count"], "collection": lookup["collection"], "plan": None, "wasted_work": 0})
+
+        return candidates
+
+    def apply_partial_filter(self, recommendation, constants, field_stats):
+        """Restrict the index to the subset selected by constants that recur across the shape's executions
+
+        Only applies when field statistics put the subset below max_partial_subset and the shape's own query implies the
+        filter, so the planner can still use the index for it. Executions with other constants fall back to other plans.
+        """
+        recurring = recurring_constants(constants, recommendation.get("execution_count") or 1, self.min_constant_share, self.min_constant_executions)
+        partial = partial_filter(recurring, field_stats, self.max_partial_subset)
+        if partial is None or not query_can_use(recommendation.get("example_query"), partial["filter"]):
+            return recommendation
+
+        recommendation["partial_filter"] = partial["filter"]
+        recommendation["subset_fraction"] = partial["subset_fraction"]
+        recommendation["index_options"] = index_options(partial["filter"], recommendation["fields"])
+        return recommendation
+
+    def consolidate(self, recommendations):
+        """Merge recommendations into a minimal index set and drop those already served by existing indexes"""
+        existing_indexes = {}
+        for collection in {recommendation["collection"] for recommendation in recommendations}:
+            try:
+                existing_indexes[collection] = self.db_queries.list_indexes(collection)
+            except Exception as e:
+                logger.error(f"Error listing indexes on {collection}: {e}")
+                existing_indexes[collection] = []
+
+        consolidated, suppressed = consolidate_recommendations(recommendations, existing_indexes)
+        self.suppressed_recommendations.extend(suppressed)
+        logger.info(f"Consolidated {len(recommendations)} candidate indexes into {len(consolidated)}; {len(suppressed)} already served by existing indexes")
+        return consolidated
+
+    def collect_write_mix(self, collection, workload_reads):
+        """Write mix observed during ingestion, else projected from $collStats and serverStatus counters"""
+        if collection in self.write_mixes:
+            return self.write_mixes[collection]
+
+        try:
+            return write_mix_from_stats(self.db_queries.collection_stats(collection), self.db_queries.server_opcounters(), workload_reads)
+        except Exception as e:
+            logger.error(f"Error collecting write statistics on {collection}: {e}")
+            return None
+
+    def apply_write_costs(self, recommendations, write_mixes=None):
+        """Attach index maintenance cost and net benefit, suppressing indexes that cost the write path more than they save"""
+        write_mixes = write_mixes or {}
+        workload_reads = {}
+        for result in self.query_results:
+            workload_reads[result.get("collection", "")] = workload_reads.get(result.get("collection", ""), 0) + result.get("execution_count", 1)
+
+        kept = []
+        collected_mixes = {}
+        for recommendation in recommendations:
+            collection = recommendation["collection"]
+            if collection not in collected_mixes:
+                collected_mixes[collection] = write_mixes.get(collection) or self.collect_write_mix(collection, workload_reads.get(collection, 0))
+            write_mix = collected_mixes[collection]
+
+            fields = recommendation.get("fields", [])
+            write_cost_ms = self.write_cost_model.maintenance_cost_ms(fields, write_mix, self.collect_field_stats(collection, fields)) * recommendation.get("subset_fraction", 1)
+            read_benefit_ms = self.read_saving_ms(recommendation)
+
+            recommendation["write_cost_ms"] = write_cost_ms
+            recommendation["read_benefit_ms"] = read_benefit_ms
+            recommendation["net_benefit_ms"] = read_benefit_ms - write_cost_ms
+            recommendation["write_mix"] = {op_type: (write_mix or {}).get(op_type, 0) for op_type in ["insert", "update", "delete"]}
+
+            if recommendation["net_benefit_ms"] <= 0:
+                self.suppressed_recommendations.append({**recommendation, "suppressed_reason": f"index maintenance (~{write_cost_ms:.0f} ms) outweighs read savings (~{read_benefit_ms:.0f} ms)"})
+                continue
+
+            kept.append(recommendation)
+
+        return kept
+
+    def read_saving_ms(self, recommendation):
+        """Read time the index is expected to save across the workload, not the read time it applies to
+
+        A what-if run's measured saving is used when one is attached. Otherwise the saving is the share of
+        potential_impact spent examining documents the query does not return, which an index on its keys avoids, plus
+        the blocking sort when the index provides the sort order. As in wasted_work, a blocking sort costs one more pass
+        over every examined document. Shapes without a plan (such as $lookup probes) fall back to the share the equality
+        keys' selectivity filters out.
+        """
+        what_if = recommendation.get("what_if")
+        if what_if:
+            recommendation["read_saving_source"] = "what_if"
+            return max(what_if["estimated_saving_ms"], 0)
+
+        docs_examined_per_returned = recommendation.get("docs_examined_per_returned")
+        if docs_examined_per_returned:
+            sort = recommendation.get("sort") or []
+            removes_sort = recommendation.get("has_in_memory_sort") and sort and all(field in recommendation.get("fields", []) for field, _ in sort)
+            remaining = 1 / (max(docs_examined_per_returned, 1) * (2 if removes_sort else 1))
+        else:
+            remaining = recommendation.get("estimated_selectivity")
+            remaining = 1 if remaining is None else remaining
+
+        recommendation["read_saving_source"] = "plan"
+        return recommendation.get("potential_impact", 0) * (1 - remaining)
+
+    def attach_what_if(self, recommendation, report):
+        """Replace the plan-based read saving with a what-if run's measured one and recompute the net benefit"""
+        recommendation["what_if"] = report
+        recommendation["read_benefit_ms"] = self.read_saving_ms(recommendation)
+        recommendation["net_benefit_ms"] = recommendation["read_benefit_ms"] - recommendation.get("write_cost_ms", 0)
+        return recommendation
+
+    def estimate_index_sizes(self, recommendations):
+        """Attach the estimated entry count and size of each recommended index"""
+        for recommendation in recommendations:
+            collection = recommendation["collection"]
+            fields = recommendation.get("fields", [])
+            try:
+                document_count = self.field_stats.document_count(collection)
+            except Exception as e:
+                logger.error(f"Error counting documents in {collection}: {e}")
+                document_count = 0
+
+            field_stats = self.collect_field_stats(collection, fields)
+            # A partial or sparse index only holds entries for its subset of the documents
+            size = estimate_index_size(fields, document_count * recommendation.get("subset_fraction", 1), field_stats, self.write_cost_model.keys_per_document(fields, field_stats))
+            recommendation["estimated_entries"] = size["entries"]
+            recommendation["estimated_size_bytes"] = size["bytes"]
+
+        return recommendations
+
+    def select_within_budget(self, budget_bytes, recommendations=None):
+        """Best subset of the recommendations whose combined estimated size fits budget_bytes"""
+        recommendations = self.recommendations if recommendations is None else recommendations
+        if any("estimated_size_bytes" not in recommendation for recommendation in recommendations):
+            self.estimate_index_sizes(recommendations)
+
+        return select_indexes(recommendations, budget_bytes)
+
+    def verify_covering(self, recommendation, max_documents=1000):
+        """Build the index on a small scratch sample and confirm every served shape's hinted plan has no FETCH stage"""
+        collection = recommendation["collection"]
+        index_spec = self.generate_index_spec(recommendation)
+        shapes = replayable_shapes(recommendation)
+
+        with self.db_queries.shadow_collection(collection, sample_fraction=1.0, max_documents=max_documents) as shadow:
+            self.db_queries.create_index(shadow["name"], index_spec, **recommendation.get("index_options") or {})
+            plans = [analyze_explain(self.db_queries.explain_query(shadow["name"], shape.get("example_query") or {}, shape.get("projection"), shape.get("sort"), shape.get("limit"), hint=index_spec)) for shape in shapes if not shape.get("pipeline")]
+
+        return bool(plans) and all(plan["is_indexed"] and not plan["has_fetch"] for plan in plans)
+
+    def check_covering(self, recommendation):
+        """Keep the covering keys only when explain confirms the index covers the query; otherwise drop them"""
+        try:
+            covered = self.verify_covering(recommendation)
+        except Exception as e:
+            logger.error(f"Error verifying covering index on {recommendation['collection']}: {e}")
+            covered = False
+
+        recommendation["covered_verified"] = covered
+        if covered:
+            return
+
+        keys = [(key, kind) for key, kind in zip(recommendation["index_spec"], recommendation["esr"]) if kind != COVER]
+        recommendation["index_spec"] = [key for key, _ in keys]
+        recommendation["esr"] = [kind for _, kind in keys]
+        recommendation["fields"] = [field for field, _ in recommendation["index_spec"]]
+        recommendation["covering"] = False
+
+    def verify_partial(self, recommendation, max_documents=1000):
+        """Build the partial or sparse index on a scratch sample and confirm the planner picks it for every served shape"""
+        collection = recommendation["collection"]
+        index_spec = self.generate_index_spec(recommendation)
+        shapes = [shape for shape in replayable_shapes(recommendation) if not shape.get("pipeline")]
+
+        with self.db_queries.shadow_collection(collection, sample_fraction=1.0, max_documents=max_documents) as shadow:
+            index_name = self.db_queries.create_index(shadow["name"], index_spec, **recommendation["index_options"])
+            plans = [analyze_explain(self.db_queries.explain_query(shadow["name"], shape.get("example_query") or {}, shape.get("projection"), shape.get("sort"), shape.get("limit"))) for shape in shapes]
+
+        return bool(plans) and all(index_name in plan["index_names"] for plan in plans)
+
+    def check_partial(self, recommendation):
+        """Keep the partial filter only when explain confirms the served shapes can use the index; otherwise build it full"""
+        try:
+            usable = self.verify_partial(recommendation)
+        except Exception as e:
+            logger.error(f"Error verifying partial index on {recommendation['collection']}: {e}")
+            usable = False
+
+        recommendation["partial_verified"] = usable
+        if not usable:
+            for key in ["partial_filter", "subset_fraction", "index_options"]:
+                recommendation.pop(key, None)
+
+    def _replay_shapes(self, collection_name, shapes, warmup, trials):
+        measurements = []
+        for shape in shapes:
+            if shape.get("pipeline"):
+                results, timing, explain = self.db_queries.benchmark_aggregate(collection_name, shape["pipeline"], warmup=warmup, trials=trials)
+                measurements.append({"timing": timing, "plan": analyze_explain(explain), "result_count": timing.get("documents", len(results))})
+                continue
+
+            results, timing, explain = self.db_queries.benchmark_query(collection_name, shape.get("example_query") or {}, shape.get("projection"), shape.get("sort"), shape.get("limit"), warmup=warmup, trials=trials)
+            measurements.append({"timing": timing, "plan": analyze_explain(explain), "result_count": timing.get("documents", len(results))})
+
+        return measurements
+
+    def evaluate_what_if(self, recommendation, sample_fraction=0.01, warmup=1, trials=3, max_documents=None):
+        """Estimate an index's benefit by building it on a sampled scratch copy of the collection
+
+        Timings and examined documents on the sample are extrapolated linearly to the full collection, which is
+        accurate for scan-bound plans and an upper bound for index plans that stop at a limit. $lookup probes are left
+        out: their placeholder literal matches nothing outside the pipeline that supplies the values.
+        """
+        collection = recommendation["collection"]
+        index_spec = self.generate_index_spec(recommendation)
+        shapes = replayable_shapes(recommendation)
+        if not shapes:
+            raise ValueError(f"The index on {collection} only serves $lookup probes, which cannot be replayed on their own")
+
+        with self.db_queries.shadow_collection(collection, sample_fraction, max_documents=max_documents) as shadow:
+            before = self._replay_shapes(shadow["name"], shapes, warmup, trials)
+            self.db_queries.create_index(shadow["name"], index_spec, **recommendation.get("index_options") or {})
+            after = self._replay_shapes(shadow["name"], shapes, warmup, trials)
+
+        scale = 1 / shadow["sample_fraction"] if shadow["sample_fraction"] else 0
+
+        shape_reports = []
+        estimated_saving_ms = 0
+        for shape, before_run, after_run in zip(shapes, before, after):
+            before_ms = before_run["timing"]["p50_ms"]
+            after_ms = after_run["timing"]["p50_ms"]
+            saving_ms = (before_ms - after_ms) * scale
+            estimated_saving_ms += saving_ms * shape.get("execution_count", 1)
+
+            shape_reports.append({"query_pattern": shape.get("query_pattern"), "execution_count": shape.get("execution_count", 1), "sample_before_ms": before_ms, "sample_after_ms": after_ms, "estimated_before_ms": before_ms * scale, "estimated_after_ms": after_ms * scale, "estimated_docs_examined_before": before_run["plan"]["total_docs_examined"] * scale, "estimated_docs_examined_after": after_run["plan"]["total_docs_examined"] * scale, "index_used": after_run["plan"]["is_indexed"], "covered": after_run["plan"]["is_indexed"] and not after_run["plan"]["has_fetch"], "blocking_sort_removed": before_run["plan"]["has_in_memory_sort"] and not after_run["plan"]["has_in_memory_sort"]})
+
+        total_before = sum(report["sample_before_ms"] for report in shape_reports)
+        total_after = sum(report["sample_after_ms"] for report in shape_reports)
+
+        return {"collection": collection, "index_spec": index_spec, "sample_documents": shadow["documents"], "collection_documents": shadow["source_documents"], "sample_fraction": shadow["sample_fraction"], "shapes": shape_reports, "speedup": total_before / total_after if total_after else None, "estimated_saving_ms": estimated_saving_ms, "index_used": all(report["index_used"] for report in shape_reports)}
+
+    def collect_field_stats(self, collection, fields):
+        """Cached distribution stats for the fields, or an empty mapping when the collection cannot be sampled"""
+        try:
+            return self.field_stats.get(collection, fields)
+        except Exception as e:
+            logger.error(f"Error collecting field statistics on {collection}: {e}")
+            return {}
+
+    def estimate_selectivity(self, esr_spec, field_stats, example_values):
+        """Fraction of documents an index's equality keys narrow a scan to, assuming independent fields"""
+        selectivity = 1.0
+        for key in esr_spec:
+            if key["kind"] == EQUALITY:
+                selectivity *= equality_selectivity(field_stats.get(key["field"]), example_values.get(key["field"], MISSING))
+
+        return selectivity
+
     def generate_index_spec(self, recommendation):
+        if recommendation.get("index_spec"):
+            return [(field, direction) for field, direction in recommendation["index_spec"]]
+
         index_spec = []
 
         for field in recommendation.get("fields", []):
@@ -0,0 +1,159 @@
+import math
+import time
+import logging
+
+from explain_analyzer import analyze_explain
+from timing_stats import summarize_timings
+
+DEFAULT_ALPHA = 0.05
+# ABBA blocks per shape; each block gives two samples per arm
+DEFAULT_BLOCKS = 10
+# Smaller p50 gains are treated as noise even when they are statistically significant
+DEFAULT_MIN_IMPROVEMENT = 0.05
+NATURAL_ORDER = {"$natural": 1}
+
+logger = logging.getLogger(__name__)
+
+
+def _average_ranks(values):
+    """Rank of each value among values (1-based), ties sharing their average rank, and the tie group sizes"""
+    order = sorted(range(len(values)), key=lambda position: values[position])
+    ranks = [0.0] * len(values)
+    tie_sizes = []
+
+    start = 0
+    while start < len(order):
+        end = start
+        while end + 1 < len(order) and values[order[end + 1]] == values[order[start]]:
+            end += 1
+
+        for position in order[start : end + 1]:
+            ranks[position] = (start + end) / 2 + 1
+        tie_sizes.append(end - start + 1)
+        start = end + 1
+
+    return ranks, tie_sizes
+
+
+def mann_whitney_u(before, after):
+    """Mann-Whitney U test that after's latencies tend to be lower than before's
+
+    Returns U for before and the one-sided p-value from the normal approximation with tie and continuity correction,
+    which is adequate from about eight samples per side. Identical distributions give p = 1.
+    """
+    n1, n2 = len(before), len(after)
+    if not n1 or not n2:
+        return {"u": 0.0, "z": 0.0, "p_value": 1.0}
+
+    ranks, tie_sizes = _average_ranks(list(before) + list(after))
+    u = sum(ranks[:n1]) - n1 * (n1 + 1) / 2
+
+    n = n1 + n2
+    tie_correction = sum(size ** 3 - size for size in tie_sizes) / (n * (n - 1)) if n > 1 else 0
+    variance = n1 * n2 / 12 * ((n + 1) - tie_correction)
+    if variance <= 0:
+        return {"u": u, "z": 0.0, "p_value": 1.0}
+
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return {"u": u, "z": z, "p_value": 0.5 * math.erfc(z / math.sqrt(2))}
+
+
+def replayable_shapes(recommendation):
+    """Shapes the index was recommended for that can be replayed as-is; $lookup probes only exist inside another pipeline"""
+    return [shape for shape in recommendation.get("serves") or [recommendation] if not shape.get("lookup_from")]
+
+
+def _explain(db_queries, collection, shape, hint=None):
+    if shape.get("pipeline"):
+        return analyze_explain(db_queries.explain_aggregate(collection, shape["pipeline"]))
+
+    return analyze_explain(db_queries.explain_query(collection, shape.get("example_query") or {}, shape.get("projection"), shape.get("sort"), shape.get("limit"), hint=hint))
+
+
+def baseline_hints(db_queries, recommendation):
+    """The plan each replayable shape uses before the index exists, as a hint: its index name, or $natural for a scan
+
+    Call this before create_index; the A arm of the validation is forced back onto these plans.
+    """
+    hints = []
+    for shape in replayable_shapes(recommendation):
+        plan = _explain(db_queries, recommendation["collection"], shape)
+        hints.append(plan["index_names"][0] if plan["index_names"] else NATURAL_ORDER)
+
+    return hints
+
+
+def wait_for_index_build(db_queries, collection, index_name, timeout_s=3600, poll_s=2):
+    """Block until the index is listed by $indexStats as built and no createIndexes for it shows in $currentOp"""
+    deadline = time.monotonic() + timeout_s
+
+    while True:
+        entry = db_queries.index_stats(collection).get(index_name)
+        building = entry is None or entry["building"]
+        if not building:
+            try:
+                building = db_queries.index_build_in_progress(collection, index_name)
+            except Exception as e:
+                # $currentOp needs the inprog privilege; $indexStats alone is then trusted
+                logger.warning(f"Cannot check $currentOp for the build of {index_name}: {e}")
+
+        if not building:
+            return
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Index {index_name} on {collection} was still building after {timeout_s}s")
+        time.sleep(poll_s)
+
+
+def _timed_run(db_queries, collection, shape, hint):
+    if shape.get("pipeline"):
+        return db_queries.timed_aggregate(collection, shape["pipeline"], hint)
+
+    return db_queries.timed_find(collection, shape.get("example_query") or {}, shape.get("projection"), shape.get("sort"), shape.get("limit"), hint)
+
+
+def ab_validate(db_queries, recommendation, index_name, before_hints, blocks=DEFAULT_BLOCKS, warmup=1, alpha=DEFAULT_ALPHA, min_improvement=DEFAULT_MIN_IMPROVEMENT):
+    """Compare each shape's previous plan (A) with the new index (B) in interleaved ABBA trials forced with hint
+
+    Interleaving in ABBA order spreads cache warming and background load evenly over both arms. A shape improved when
+    its p50 dropped by at least min_improvement and the Mann-Whitney test rejects "no faster" at alpha. The index is
+    confirmed when no shape got significantly slower and significantly improved shapes carry most executions.
+    """
+    collection = recommendation["collection"]
+    shapes = replayable_shapes(recommendation)
+
+    reports = []
+    for shape, before_hint in zip(shapes, before_hints):
+        for _ in range(warmup):
+            _timed_run(db_queries, collection, shape, before_hint)
+            _timed_run(db_queries, collection, shape, index_name)
+
+        before_ms = []
+        after_ms = []
+        for _ in range(blocks):
+            before_ms.append(_timed_run(db_queries, collection, shape, before_hint))
+            after_ms.append(_timed_run(db_queries, collection, shape, index_name))
+            after_ms.append(_timed_run(db_queries, collection, shape, index_name))
+            before_ms.append(_timed_run(db_queries, collection, shape, before_hint))
+
+        before = summarize_timings(before_ms)
+        after = summarize_timings(after_ms)
+        improvement = 1 - after["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 0
+        faster = mann_whitney_u(before_ms, after_ms)
+        slower = mann_whitney_u(after_ms, before_ms)
+        # Without a hint, does the planner choose the new index on its own?
+        planner_uses_index = index_name in _explain(db_queries, collection, shape)["index_names"]
+
+        reports.append({"query_pattern": shape.get("query_pattern"), "execution_count": shape.get("execution_count") or 1, "before_hint": before_hint, "before": before, "after": after, "improvement": improvement, "p_value": faster["p_value"], "improved": faster["p_value"] < alpha and improvement >= min_improvement, "regressed": slower["p_value"] < alpha, "planner_uses_index": planner_uses_index})
+
+    executions = sum(report["execution_count"] for report in reports)
+    improved_share = sum(report["execution_count"] for report in reports if report["improved"]) / executions if executions else 0
+    before_p50_ms = sum(report["before"]["p50_ms"] * report["execution_count"] for report in reports) / executions if executions else 0
+    after_p50_ms = sum(report["after"]["p50_ms"] * report["execution_count"] for report in reports) / executions if executions else 0
+
+    return {"collection": collection, "index_name": index_name, "shapes": reports, "alpha": alpha, "blocks": blocks, "before_p50_ms": before_p50_ms, "after_p50_ms": after_p50_ms, "saving_ms": sum((report["before"]["p50_ms"] - report["after"]["p50_ms"]) * report["execution_count"] for report in reports), "improved_share": improved_share, "confirmed": bool(reports) and improved_share >= 0.5 and not any(report["regressed"] for report in reports), "planner_uses_index": bool(reports) and all(report["planner_uses_index"] for report in reports)}
+
+
+def rollback(db_queries, collection, index_name):
+    """Drop an applied index whose improvement was not confirmed"""
+    return db_queries.drop_index(collection, index_name)
@@ -0,0 +1,180 @@
+"""Per-stage timing, server round-trip accounting, structured logging and Prometheus export
+
+Pipeline code wraps its work in stage("load" | "execute" | "explain" | "aggregate" | "recommend" | "apply"). The
+command listener registered on every shared client (db_connect) attributes each server round trip, the time spent
+waiting for it and optionally its wire size to the innermost active stage. Stage seconds minus command seconds is
+time spent in the recommender itself, which tells a slow run's client-side cost apart from database cost.
+"""
+
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UNATTRIBUTED = "other"
+METRIC_PREFIX = "index_recommender"
+# Counter name, help text and the stage entry key it is read from
+PROMETHEUS_COUNTERS = [
+    ("stage_calls_total", "Times each pipeline stage ran", "calls"),
+    ("stage_errors_total", "Stage runs that raised", "errors"),
+    ("stage_seconds_total", "Wall time spent in each stage, including nested stages", "seconds"),
+    ("round_trips_total", "Server commands issued while the stage was active", "round_trips"),
+    ("command_failures_total", "Server commands that failed", "failed_commands"),
+    ("command_seconds_total", "Time spent waiting for server replies", "command_seconds"),
+    ("bytes_sent_total", "BSON bytes of commands sent (when byte counting is enabled)", "bytes_sent"),
+    ("bytes_received_total", "BSON bytes of replies received (when byte counting is enabled)", "bytes_received"),
+]
+# Attributes every LogRecord has; anything else was passed through extra= and belongs in the structured output
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_current_stage = contextvars.ContextVar("stage", default=UNATTRIBUTED)
+_command_waits = contextvars.ContextVar("command_waits", default=None)
+
+logger = logging.getLogger(__name__)
+
+
+class StageMetrics:
+    """Thread-safe counters per stage; count_bytes enables BSON size accounting, which re-encodes every command and reply"""
+
+    def __init__(self, count_bytes=False):
+        self.count_bytes = count_bytes
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def _entry(self, stage_name):
+        return self.stages.setdefault(stage_name, {"calls": 0, "errors": 0, "seconds": 0.0, "round_trips": 0, "failed_commands": 0, "command_seconds": 0.0, "bytes_sent": 0, "bytes_received": 0})
+
+    def record_stage(self, stage_name, seconds, failed=False):
+        with self._lock:
+            entry = self._entry(stage_name)
+            entry["calls"] += 1
+            entry["errors"] += int(failed)
+            entry["seconds"] += seconds
+
+    def record_command(self, stage_name, seconds, failed=False, bytes_received=0):
+        with self._lock:
+            entry = self._entry(stage_name)
+            entry["round_trips"] += 1
+            entry["failed_commands"] += int(failed)
+            entry["command_seconds"] += seconds
+            entry["bytes_received"] += bytes_received
+
+    def record_sent(self, stage_name, bytes_sent):
+        with self._lock:
+            self._entry(stage_name)["bytes_sent"] += bytes_sent
+
+    def snapshot(self):
+        with self._lock:
+            return {stage_name: dict(entry) for stage_name, entry in self.stages.items()}
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    def prometheus_text(self, prefix=METRIC_PREFIX):
+        """The counters in the Prometheus text exposition format"""
+        stages = self.snapshot()
+        lines = []
+        for name, help_text, key in PROMETHEUS_COUNTERS:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for stage_name, entry in sorted(stages.items()):
+                lines.append(f'{prefix}_{name}{{stage="{stage_name}"}} {entry[key]}')
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = StageMetrics()
+
+
+def current_stage():
+    return _current_stage.get()
+
+
+@contextmanager
+def stage(name, metrics=None):
+    """Time a block as a pipeline stage; server commands issued inside it are attributed to it"""
+    metrics = metrics or METRICS
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _current_stage.reset(token)
+        metrics.record_stage(name, time.perf_counter() - start, failed)
+
+
+@contextmanager
+def command_timer():
+    """Accumulate the time the block spends waiting on server replies (and how many) into the yielded dict"""
+    waited = {"seconds": 0.0, "round_trips": 0}
+    token = _command_waits.set(waited)
+    try:
+        yield waited
+    finally:
+        _command_waits.reset(token)
+
+
+def record_command_wait(seconds):
+    waited = _command_waits.get()
+    if waited is not None:
+        waited["seconds"] += seconds
+        waited["round_trips"] += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per log line with the active stage and any extra= fields"""
+
+    def format(self, record):
+        entry = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name, "stage": current_stage(), "message": record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level="INFO", json_format=False, stream=None):
+    """Send log records to stream (stderr by default), as JSON lines or as plain text"""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
+def write_prometheus(path, metrics=None):
+    """Write the metrics to a file, e.g. for the node_exporter textfile collector"""
+    with open(path, "w") as f:
+        f.write((metrics or METRICS).prometheus_text())
+
+
+def serve_metrics(port, host="", metrics=None):
+    """Expose the metrics for scraping at http://host:port/metrics from a daemon thread; returns the server"""
+    metrics = metrics or METRICS
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,162 @@
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+
+DEFAULT_STORE_PATH = "index_metrics.db"
+# Workload entry keys that do not change what is executed
+IGNORED_ITEM_KEYS = ["description"]
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, started_at REAL NOT NULL, source TEXT)",
+    "CREATE TABLE IF NOT EXISTS shape_results (run_id INTEGER, collection TEXT, item_key TEXT, shape_hash TEXT, query_name TEXT, fingerprint TEXT, collected_at REAL, result TEXT)",
+    "CREATE INDEX IF NOT EXISTS shape_results_item ON shape_results (collection, item_key, collected_at)",
+    "CREATE TABLE IF NOT EXISTS timing_samples (run_id INTEGER, collection TEXT, shape_hash TEXT, collected_at REAL, duration_ms REAL)",
+    "CREATE INDEX IF NOT EXISTS timing_samples_shape ON timing_samples (collection, shape_hash, collected_at)",
+    "CREATE TABLE IF NOT EXISTS plan_summaries (run_id INTEGER, collection TEXT, shape_hash TEXT, collected_at REAL, is_indexed INTEGER, has_in_memory_sort INTEGER, total_docs_examined INTEGER, total_keys_examined INTEGER, n_returned INTEGER, stages TEXT, index_names TEXT)",
+    "CREATE TABLE IF NOT EXISTS recommendations (run_id INTEGER, created_at REAL, collection TEXT, index_spec TEXT, net_benefit_ms REAL, potential_impact REAL, execution_count INTEGER, record TEXT)",
+]
+
+
+def _digest(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, separators=(",", ":"), default=str).encode(), digest_size=8).hexdigest()
+
+
+def size_bucket(document_count):
+    """Power-of-two bucket of a collection's size; results are reused until the collection doubles or halves"""
+    return int(math.log2(document_count)) if document_count and document_count > 0 else 0
+
+
+def collection_fingerprint(indexes, document_count):
+    """Fingerprint of what determines a shape's plan and cost: the index set and the data-size bucket"""
+    index_set = sorted([list(map(list, index.get("key", []))), bool(index.get("hidden")), bool(index.get("sparse")), index.get("partialFilterExpression")] for index in indexes)
+    return _digest({"indexes": index_set, "size_bucket": size_bucket(document_count)})
+
+
+def workload_item_key(query_item, warmup=None, trials=None, drain=False):
+    """Stable key of a workload entry's executed content and of how it was measured"""
+    return _digest({"item": {key: value for key, value in query_item.items() if key not in IGNORED_ITEM_KEYS}, "warmup": warmup, "trials": trials, "drain": drain})
+
+
+class MetricsStore:
+    """SQLite store of per-shape timing samples, plan summaries and recommendation history across runs"""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self.connection:
+            if path != ":memory:":
+                self.connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def start_run(self, source="workload"):
+        with self._lock, self.connection:
+            return self.connection.execute("INSERT INTO runs (started_at, source) VALUES (?, ?)", (time.time(), source)).lastrowid
+
+    def record_results(self, run_id, results, item_keys=None, fingerprints=None):
+        """Persist query result records with their timing samples and plan summaries
+
+        item_keys (per result) and fingerprints (per collection) make a result reusable by later incremental runs.
+        """
+        item_keys = item_keys or [None] * len(results)
+        fingerprints = fingerprints or {}
+        now = time.time()
+
+        result_rows = []
+        sample_rows = []
+        plan_rows = []
+        for result, item_key in zip(results, item_keys):
+            collection = result.get("collection", "")
+            shape = result.get("shape_hash")
+            result_rows.append((run_id, collection, item_key, shape, result.get("query_name", ""), fingerprints.get(collection), now, json_util.dumps(result, json_options=CANONICAL_JSON_OPTIONS)))
+
+            samples_ms = (result.get("timing") or {}).get("samples_ms") or [result.get("execution_time_ms", 0)]
+            sample_rows.extend((run_id, collection, shape, now, duration_ms) for duration_ms in samples_ms)
+
+            plan = result.get("plan")
+            if plan:
+                plan_rows.append((run_id, collection, shape, now, int(plan["is_indexed"]), int(plan["has_in_memory_sort"]), plan["total_docs_examined"], plan["total_keys_examined"], plan["n_returned"], json.dumps(plan["stages"]), json.dumps(plan["index_names"])))
+
+        with self._lock, self.connection:
+            self.connection.executemany("INSERT INTO shape_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", result_rows)
+            self.connection.executemany("INSERT INTO timing_samples VALUES (?, ?, ?, ?, ?)", sample_rows)
+            self.connection.executemany("INSERT INTO plan_summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", plan_rows)
+
+    def cached_result(self, collection, item_key, fingerprint):
+        """Latest stored result of a workload entry, or None when its collection's fingerprint has changed since"""
+        with self._lock:
+            row = self.connection.execute("SELECT fingerprint, result FROM shape_results WHERE collection = ? AND item_key = ? ORDER BY collected_at DESC LIMIT 1", (collection, item_key)).fetchone()
+
+        if row is None or row[0] != fingerprint:
+            return None
+
+        # Canonical extended JSON brings ObjectId, datetime and Decimal128 values back as the types a live run returns
+        return json_util.loads(row[1], json_options=CANONICAL_JSON_OPTIONS)
+
+    def record_recommendations(self, run_id, recommendations):
+        now = time.time()
+        rows = [(run_id, now, rec["collection"], json.dumps(rec.get("index_spec")), rec.get("net_benefit_ms"), rec.get("potential_impact"), rec.get("execution_count"), json.dumps(rec, default=str)) for rec in recommendations]
+
+        with self._lock, self.connection:
+            self.connection.executemany("INSERT INTO recommendations VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def recommendation_history(self, collection=None):
+        """How often and how recently each index was recommended, with its latest net benefit"""
+        query = "SELECT collection, index_spec, COUNT(*), MIN(created_at), MAX(created_at), net_benefit_ms FROM recommendations"
+        params = []
+        if collection:
+            query += " WHERE collection = ?"
+            params.append(collection)
+        query += " GROUP BY collection, index_spec ORDER BY MAX(created_at) DESC"
+
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+
+        return [{"collection": row[0], "index_spec": json.loads(row[1]), "times_recommended": row[2], "first_recommended_at": row[3], "last_recommended_at": row[4], "net_benefit_ms": row[5]} for row in rows]
+
+    def timing_frame(self, collection=None, shape_hash=None, since=None):
+        """Raw timing samples as a pandas DataFrame (pandas is only imported when trends are requested)"""
+        import pandas as pd
+
+        conditions = []
+        params = []
+        for column, value in [("collection", collection), ("shape_hash", shape_hash)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("collected_at >= ?")
+            params.append(since)
+
+        query = "SELECT run_id, collection, shape_hash, collected_at, duration_ms FROM timing_samples"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        with self._lock:
+            return pd.read_sql_query(query, self.connection, params=params)
+
+    def latency_trend(self, collection=None, shape_hash=None, since=None, bucket_seconds=86400):
+        """p50/p95/p99 latency and sample count per shape and time bucket, computed with grouped quantiles"""
+        frame = self.timing_frame(collection, shape_hash, since)
+        if frame.empty:
+            return frame
+
+        frame["bucket"] = (frame["collected_at"] // bucket_seconds * bucket_seconds).astype("int64")
+        grouped = frame.groupby(["collection", "shape_hash", "bucket"])["duration_ms"]
+        trend = grouped.quantile([0.5, 0.95, 0.99]).unstack()
+        trend.columns = ["p50_ms", "p95_ms", "p99_ms"]
+        trend["samples"] = grouped.size()
+
+        return trend.reset_index()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
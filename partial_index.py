@@ -0,0 +1,181 @@
+import json
+
+from field_stats import equality_selectivity
+
+# A constant must appear in at least this share of a shape's executions to bound the index to its subset
+DEFAULT_MIN_SHARE = 0.9
+# ...and the subset it selects must be at most this fraction of the collection to be worth a partial index
+DEFAULT_MAX_SUBSET = 0.5
+# ...over at least this many observed executions; fewer cannot tell a recurring constant from a one-off literal
+DEFAULT_MIN_EXECUTIONS = 10
+# Distinct constants tracked per shape; high-cardinality literals (ids, timestamps) would otherwise grow without bound
+MAX_TRACKED_CONSTANTS = 32
+
+# Operators a partialFilterExpression accepts on a field, apart from $exists, which only accepts true
+PARTIAL_OPERATORS = ["$eq", "$gt", "$gte", "$lt", "$lte", "$type"]
+
+
+def _is_constant(value):
+    return value is not None and not isinstance(value, (dict, list, tuple)) and not (isinstance(value, str) and value.startswith("?"))
+
+
+def constant_predicates(query):
+    """Top-level predicates (including inside $and) a partialFilterExpression can express, as {field: {op: value}}
+
+    $exists: false, $ne, $nin, $not, $in, regexes and null equality have no partial filter form and are left out.
+    """
+    predicates = {}
+
+    for key, value in (query or {}).items():
+        if key == "$and" and isinstance(value, (list, tuple)):
+            for branch in value:
+                for field, expression in constant_predicates(branch).items():
+                    predicates.setdefault(field, {}).update(expression)
+            continue
+
+        if key.startswith("$"):
+            continue
+
+        if not isinstance(value, dict) or not value or not all(operator.startswith("$") for operator in value):
+            if _is_constant(value):
+                predicates[key] = {"$eq": value}
+            continue
+
+        if value.get("$exists") is False:
+            continue
+
+        expression = {operator: operand for operator, operand in value.items() if operator in PARTIAL_OPERATORS and _is_constant(operand)}
+        if value.get("$exists") is True:
+            expression["$exists"] = True
+        if expression:
+            predicates[key] = expression
+
+    return predicates
+
+
+def _predicate_key(field, expression):
+    # Literal type matters (a date is not its string), so the key only groups; the expression keeps the value
+    return f"{field}:{json.dumps(expression, sort_keys=True, default=str)}"
+
+
+def tally_constants(tally, query, weight=1, max_tracked=MAX_TRACKED_CONSTANTS):
+    """Count one execution's constant predicates into tally, keyed by field and expression"""
+    for field, expression in constant_predicates(query).items():
+        key = _predicate_key(field, expression)
+        if key in tally:
+            tally[key]["count"] += weight
+        elif len(tally) < max_tracked:
+            tally[key] = {"field": field, "expression": expression, "count": weight}
+
+    return tally
+
+
+def merge_tallies(tally, other):
+    """Add another tally's counts into tally"""
+    for key, entry in (other or {}).items():
+        if key in tally:
+            tally[key]["count"] += entry["count"]
+        elif len(tally) < MAX_TRACKED_CONSTANTS:
+            tally[key] = dict(entry)
+
+    return tally
+
+
+def recurring_constants(tally, executions, min_share=DEFAULT_MIN_SHARE, min_executions=DEFAULT_MIN_EXECUTIONS):
+    """{field: expression} of the predicates carrying the same constant in at least min_share of the executions
+
+    Nothing recurs over fewer than min_executions (and never over fewer than two) executions.
+    """
+    recurring = {}
+    if executions < max(min_executions, 2):
+        return recurring
+
+    for entry in sorted((tally or {}).values(), key=lambda entry: entry["count"], reverse=True):
+        if executions and entry["count"] / executions >= min_share and entry["field"] not in recurring:
+            recurring[entry["field"]] = entry["expression"]
+
+    return recurring
+
+
+def subset_fraction(expression, stats):
+    """Estimated fraction of documents a filter on one field keeps, from its sampled statistics, or None if unknown"""
+    if not stats:
+        return None
+    if set(expression) == {"$eq"}:
+        return equality_selectivity(stats, expression["$eq"])
+    if set(expression) == {"$exists"}:
+        return 1 - stats["missing_ratio"]
+
+    # Range bounds and $type are not estimable from top values; only the present share is known for them
+    return None
+
+
+def partial_filter(recurring, field_stats, max_subset=DEFAULT_MAX_SUBSET):
+    """Smallest-subset partial filter built from recurring constants, with its estimated subset fraction, or None
+
+    Fields are assumed independent. Constants whose subset cannot be estimated are left out of the filter.
+    """
+    expression = {}
+    fraction = 1.0
+    for field, field_expression in recurring.items():
+        field_fraction = subset_fraction(field_expression, field_stats.get(field))
+        if field_fraction is None or field_fraction >= 1:
+            continue
+
+        expression[field] = field_expression["$eq"] if set(field_expression) == {"$eq"} else field_expression
+        fraction *= field_fraction
+
+    if not expression or fraction > max_subset:
+        return None
+
+    return {"filter": expression, "subset_fraction": fraction}
+
+
+def index_options(filter_expression, index_fields):
+    """createIndex options for a filter: sparse when it only requires the single indexed field to exist"""
+    if list(filter_expression) == index_fields[:1] == index_fields and filter_expression[index_fields[0]] == {"$exists": True}:
+        return {"sparse": True}
+
+    return {"partialFilterExpression": filter_expression}
+
+
+def _compare(left, right):
+    try:
+        return (left > right) - (left < right)
+    except TypeError:
+        return None
+
+
+def _implies(query_expression, filter_expression):
+    """Whether every value matching the query's predicate on a field also matches the filter's $eq or $exists: true"""
+    if not isinstance(filter_expression, dict) or not all(operator.startswith("$") for operator in filter_expression):
+        filter_expression = {"$eq": filter_expression}
+
+    for operator, bound in filter_expression.items():
+        if operator == "$exists":
+            # Any constant equality or bound on a field implies that it exists
+            if not (query_expression.get("$exists") is True or any(other in query_expression for other in PARTIAL_OPERATORS)):
+                return False
+        elif operator not in query_expression or _compare(query_expression[operator], bound) != 0:
+            return False
+
+    return True
+
+
+def query_can_use(query, filter_expression):
+    """Whether the planner may answer a query from an index with this partial filter: its predicates imply the filter
+
+    Queries with a top-level $or are never treated as served.
+    """
+    if not filter_expression:
+        return True
+    if "$or" in (query or {}):
+        return False
+
+    predicates = constant_predicates(query)
+    return all(field in predicates and _implies(predicates[field], expression) for field, expression in filter_expression.items())
+
+
+def options_key(options):
+    """Hashable identity of createIndex options; indexes only merge or replace each other when it matches"""
+    return json.dumps(options or {}, sort_keys=True, default=str)
@@ -0,0 +1,107 @@
+def _field_ref(value):
+    """Field path of a "$field" expression, or None for literals, variables and computed expressions"""
+    if isinstance(value, str) and value.startswith("$") and not value.startswith("$$"):
+        return value[1:]
+
+    return None
+
+
+def group_key_fields(group_id):
+    """Plain field paths a $group groups by; empty when any part of the key is computed"""
+    if isinstance(group_id, dict):
+        fields = [_field_ref(value) for value in group_id.values()]
+        return fields if fields and all(fields) else []
+
+    field = _field_ref(group_id)
+    return [field] if field else []
+
+
+def _expr_equality_fields(expression):
+    """Foreign fields compared for equality with a $$variable inside a $lookup sub-pipeline $expr"""
+    fields = []
+
+    if not isinstance(expression, dict):
+        return fields
+
+    for operator, operands in expression.items():
+        if operator == "$and" and isinstance(operands, list):
+            for operand in operands:
+                fields.extend(_expr_equality_fields(operand))
+        elif operator == "$eq" and isinstance(operands, list) and len(operands) == 2:
+            refs = [_field_ref(operand) for operand in operands]
+            variables = [isinstance(operand, str) and operand.startswith("$$") for operand in operands]
+            if any(refs) and any(variables):
+                fields.append(next(ref for ref in refs if ref))
+
+    return fields
+
+
+def lookup_fields(lookup):
+    """Foreign collection fields a $lookup probes per input document"""
+    fields = []
+
+    if lookup.get("foreignField"):
+        fields.append(lookup["foreignField"])
+
+    for stage in lookup.get("pipeline", []):
+        match = stage.get("$match")
+        if not isinstance(match, dict):
+            break
+
+        for key, value in match.items():
+            if key == "$expr":
+                fields.extend(_expr_equality_fields(value))
+            elif not key.startswith("$"):
+                fields.append(key)
+
+    unique_fields = []
+    for field in fields:
+        if field not in unique_fields:
+            unique_fields.append(field)
+
+    return unique_fields
+
+
+def analyze_pipeline(pipeline):
+    """Index-relevant parts of an aggregation pipeline
+
+    Returns the filter of the leading $match stages, the $sort that immediately follows them, the plain group keys of
+    a $group fed directly by that prefix, and the foreign collection fields probed by every $lookup.
+    """
+    match = {}
+    sort = None
+    group_fields = []
+    lookups = []
+    leading = True
+
+    for stage in pipeline or []:
+        if not isinstance(stage, dict) or not stage:
+            leading = False
+            continue
+
+        name, body = next(iter(stage.items()))
+
+        if leading and name == "$match" and isinstance(body, dict):
+            match = {"$and": [match, body]} if match else dict(body)
+        elif leading and name == "$sort" and sort is None and isinstance(body, dict):
+            sort = [(field, direction) for field, direction in body.items() if isinstance(direction, int)]
+        elif leading and name == "$group" and isinstance(body, dict):
+            group_fields = group_key_fields(body.get("_id"))
+            leading = False
+        else:
+            leading = False
+
+        if name == "$lookup" and isinstance(body, dict) and body.get("from"):
+            fields = lookup_fields(body)
+            if fields:
+                lookups.append({"collection": body["from"], "fields": fields, "local_field": body.get("localField")})
+
+    return {"filter": match, "sort": sort, "group_fields": group_fields, "lookups": lookups}
+
+
+def index_sort(analysis):
+    """Sort order an index should provide for the pipeline: the explicit $sort, else the $group keys"""
+    if analysis.get("sort"):
+        return analysis["sort"]
+
+    return [(field, 1) for field in analysis.get("group_fields", [])] or None
@@ -0,0 +1,167 @@
+import json
+import hashlib
+
+LOGICAL_OPERATORS = ["$and", "$or", "$nor"]
+LIST_OPERATORS = ["$in", "$nin", "$all"]
+# Operators whose literal changes which indexes can serve the query, so the literal is part of the shape
+SHAPE_LITERAL_OPERATORS = ["$exists", "$type"]
+EXTENDED_JSON_TYPES = {"$date": "date", "$oid": "objectId", "$numberLong": "number", "$numberInt": "number", "$numberDouble": "number", "$numberDecimal": "number", "$binary": "binData", "$regularExpression": "regex", "$timestamp": "timestamp", "$uuid": "binData"}
+PYTHON_TYPES = {"bool": "bool", "int": "number", "float": "number", "Int64": "number", "Decimal128": "number", "str": "string", "NoneType": "null", "datetime": "date", "ObjectId": "objectId", "Binary": "binData", "UUID": "binData", "Regex": "regex", "Pattern": "regex", "Timestamp": "timestamp", "list": "array", "tuple": "array", "dict": "object"}
+
+
+def _is_extended_json(value):
+    return isinstance(value, dict) and len(value) == 1 and next(iter(value)) in EXTENDED_JSON_TYPES
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and all(key.startswith("$") for key in value) and not _is_extended_json(value)
+
+
+def placeholder(value):
+    """Type placeholder that stands in for a literal value in a canonical shape"""
+    if _is_extended_json(value):
+        return f"?{EXTENDED_JSON_TYPES[next(iter(value))]}"
+
+    return f"?{PYTHON_TYPES.get(type(value).__name__, type(value).__name__)}"
+
+
+def _canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _normalize_operators(operators):
+    normalized = {}
+
+    for operator, value in operators.items():
+        if operator in SHAPE_LITERAL_OPERATORS:
+            normalized[operator] = value if isinstance(value, (bool, int, str)) else placeholder(value)
+        elif operator in LIST_OPERATORS and isinstance(value, (list, tuple)):
+            normalized[operator] = sorted({placeholder(item) for item in value})
+        elif operator == "$elemMatch" and isinstance(value, dict):
+            normalized[operator] = _normalize_operators(value) if _is_operator_dict(value) else normalize_shape(value)
+        elif operator == "$not" and isinstance(value, dict) and not _is_extended_json(value):
+            normalized[operator] = _normalize_operators(value)
+        elif operator == "$options":
+            continue
+        else:
+            normalized[operator] = placeholder(value)
+
+    return normalized
+
+
+def normalize_shape(query):
+    """Canonical form of a filter: literals replaced by type placeholders, keys and commutative branches sorted"""
+    if not isinstance(query, dict):
+        return placeholder(query)
+
+    shape = {}
+    for key in sorted(query):
+        value = query[key]
+
+        if key in LOGICAL_OPERATORS and isinstance(value, (list, tuple)):
+            branches = [normalize_shape(branch) for branch in value]
+            unique_branches = {_canonical_json(branch): branch for branch in branches}
+            shape[key] = [unique_branches[branch_key] for branch_key in sorted(unique_branches)]
+        elif key == "$comment":
+            continue
+        elif key.startswith("$"):
+            shape[key] = placeholder(value) if not isinstance(value, dict) else normalize_shape(value)
+        elif _is_operator_dict(value):
+            shape[key] = _normalize_operators(value)
+        else:
+            shape[key] = placeholder(value)
+
+    return shape
+
+
+def canonical_shape(query, sort=None, projection=None):
+    """Canonical document describing a query shape: normalized filter plus sort and projection keys"""
+    return {"filter": normalize_shape(query or {}), "sort": [[field, direction] for field, direction in (sort or [])], "projection": {field: (value if value in [0, 1, True, False] else "?expression") for field, value in sorted((projection or {}).items())}}
+
+
+def shape_hash(query, sort=None, projection=None):
+    """Compact stable hash of a query shape, independent of literal values and key order"""
+    return hashlib.blake2b(_canonical_json(canonical_shape(query, sort, projection)).encode(), digest_size=8).hexdigest()
+
+
+def _normalize_stage_value(value):
+    if isinstance(value, dict):
+        return {key: _normalize_stage_value(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_stage_value(item) for item in value]
+    if isinstance(value, str) and value.startswith("$"):
+        # Field paths and variables are structure, not literals
+        return value
+
+    return placeholder(value)
+
+
+def normalize_pipeline(pipeline):
+    """Canonical form of an aggregation pipeline: $match filters normalized as shapes, other literals replaced"""
+    normalized = []
+
+    for stage in pipeline or []:
+        if not isinstance(stage, dict):
+            normalized.append(placeholder(stage))
+            continue
+
+        normalized_stage = {}
+        for name, body in stage.items():
+            if name == "$match" and isinstance(body, dict):
+                normalized_stage[name] = normalize_shape(body)
+            elif name == "$lookup" and isinstance(body, dict):
+                normalized_stage[name] = {key: (normalize_pipeline(item) if key == "pipeline" else item if isinstance(item, str) else _normalize_stage_value(item)) for key, item in sorted(body.items())}
+            elif name == "$sort":
+                normalized_stage[name] = body
+            else:
+                normalized_stage[name] = _normalize_stage_value(body)
+        normalized.append(normalized_stage)
+
+    return normalized
+
+
+def pipeline_hash(pipeline):
+    """Compact stable hash of an aggregation pipeline shape, independent of literal values"""
+    return hashlib.blake2b(_canonical_json({"pipeline": normalize_pipeline(pipeline)}).encode(), digest_size=8).hexdigest()
+
+
+def pipeline_string(pipeline):
+    """Canonical JSON string of a normalized pipeline, for display"""
+    return _canonical_json(normalize_pipeline(pipeline))
+
+
+def shape_string(query):
+    """Canonical JSON string of a normalized filter, suitable for display and for json.loads"""
+    return _canonical_json(normalize_shape(query or {}))
+
+
+def shape_fields(query, prefix=""):
+    """Field paths referenced by a filter, in first-seen order, including $and/$or/$nor branches and $elemMatch paths"""
+    fields = []
+
+    def add(field):
+        if field not in fields:
+            fields.append(field)
+
+    if not isinstance(query, dict):
+        return fields
+
+    for key, value in query.items():
+        if key in LOGICAL_OPERATORS and isinstance(value, (list, tuple)):
+            for branch in value:
+                for field in shape_fields(branch, prefix):
+                    add(field)
+            continue
+
+        if key.startswith("$"):
+            continue
+
+        field = f"{prefix}.{key}" if prefix else key
+
+        if isinstance(value, dict) and isinstance(value.get("$elemMatch"), dict) and not _is_operator_dict(value["$elemMatch"]):
+            for nested_field in shape_fields(value["$elemMatch"], field):
+                add(nested_field)
+        else:
+            add(field)
+
+    return fields
@@ -8,14 +8,47 @@ import importlib
 import pandas as pd
 import streamlit as st
 
-from db_queries import DBQueries
-from db_connect import db_connect
+from db_queries import READ_PREFERENCES, DBQueries
+from db_connect import get_client
 from index_recommender import IndexRecommender
+from index_audit import apply_plan_step, audit_database, drop_plan
+from index_validation import DEFAULT_ALPHA, DEFAULT_BLOCKS, ab_validate, baseline_hints, rollback, wait_for_index_build
+from metrics_store import DEFAULT_STORE_PATH, MetricsStore
+from instrumentation import METRICS, configure_logging
 
 st.set_page_config(page_title="MongoDB Index Recommender", page_icon="📊", layout="wide")
 
 st.title("MongoDB Automated Index Recommendation System")
 
+
+@st.cache_resource
+def setup_logging():
+    # Once per process: the script body reruns on every interaction
+    configure_logging(os.environ.get("LOG_LEVEL", "INFO"))
+
+
+setup_logging()
+
+
+@st.cache_resource
+def get_metrics_store():
+    return MetricsStore(os.environ.get("INDEX_METRICS_DB", DEFAULT_STORE_PATH))
+
+
+@st.cache_resource
+def shared_client(mongo_uri):
+    # One pooled client per URI for every session; db_connect closes it at interpreter exit
+    return get_client(mongo_uri)
+
+
+def new_db_queries(database_name):
+    return DBQueries(database_name, client=st.session_state.client, read_preference=st.session_state.read_preference)
+
+
+def new_recommender(db_queries):
+    return IndexRecommender(db_queries, metrics_store=get_metrics_store())
+
+
 if "connected" not in st.session_state:
     st.session_state.connected = False
 if "client" not in st.session_state:
@@ -30,24 +63,27 @@ if "recommendations" not in st.session_state:
     st.session_state.recommendations = []
 if "selected_db" not in st.session_state:
     st.session_state.selected_db = None
+if "read_preference" not in st.session_state:
+    st.session_state.read_preference = None
 
 st.sidebar.title("Navigation")
-page = st.sidebar.radio("Go to", ["Connect to MongoDB", "Analyze Queries", "View Recommendations", "Apply Indexes"])
+page = st.sidebar.radio("Go to", ["Connect to MongoDB", "Analyze Queries", "View Recommendations", "Apply Indexes", "Audit Indexes"])
 
 if page == "Connect to MongoDB":
     st.header("Connect to MongoDB")
 
     with st.form("mongodb_connection_form"):
         mongo_uri = st.text_input("MongoDB Connection String", "mongodb://localhost:27017")
+        read_preference = st.selectbox("Send analysis queries to", list(READ_PREFERENCES), index=list(READ_PREFERENCES).index("secondaryPreferred"), help="Replays, explains and sampling follow this read preference; index builds always go to the primary")
         submit_button = st.form_submit_button("Connect")
 
         if submit_button:
             with st.spinner("Connecting to MongoDB..."):
                 try:
-                    os.environ["MONGO_URL"] = mongo_uri
-                    client = db_connect()
+                    client = shared_client(mongo_uri)
 
                     st.session_state.client = client
+                    st.session_state.read_preference = read_preference
                     st.session_state.connected = True
 
                     st.success("Successfully connected to MongoDB!")
@@ -62,9 +98,9 @@ if page == "Connect to MongoDB":
 
                     if selected_db:
                         st.session_state.selected_db = selected_db
-                        st.session_state.db_queries = DBQueries(selected_db)
+                        st.session_state.db_queries = new_db_queries(selected_db)
 
-                        st.session_state.recommender = IndexRecommender(st.session_state.db_queries)
+                        st.session_state.recommender = new_recommender(st.session_state.db_queries)
 
                         collections = st.session_state.db_queries.list_collections()
                         st.write(f"Collections in {selected_db}:", collections)
@@ -82,8 +118,8 @@ if page == "Connect to MongoDB":
 
             if new_db != st.session_state.selected_db:
                 st.session_state.selected_db = new_db
-                st.session_state.db_queries = DBQueries(new_db)
-                st.session_state.recommender = IndexRecommender(st.session_state.db_queries)
+                st.session_state.db_queries = new_db_queries(new_db)
+                st.session_state.recommender = new_recommender(st.session_state.db_queries)
                 st.session_state.query_results = []
                 st.session_state.recommendations = []
                 st.rerun()
@@ -99,7 +135,7 @@ elif page == "Analyze Queries":
 
     if not st.session_state.recommender:
         try:
-            st.session_state.recommender = IndexRecommender(st.session_state.db_queries)
+            st.session_state.recommender = new_recommender(st.session_state.db_queries)
             st.info("Initialized new index recommender")
         except Exception as e:
             st.error(f"Failed to initialize recommender: {e}")
@@ -122,6 +158,28 @@ elif page == "Analyze Queries":
                 st.error("queries.json file not found in the current directory")
                 st.stop()
 
+    replay_col1, replay_col2, replay_col3 = st.columns(3)
+
+    with replay_col1:
+        max_workers = st.number_input("Parallel workers", min_value=1, max_value=64, value=1)
+
+    with replay_col2:
+        max_per_collection = st.number_input("Max concurrent queries per collection (0 = no cap)", min_value=0, max_value=64, value=0)
+
+    with replay_col3:
+        use_asyncio = st.checkbox("Use asyncio driver", value=False)
+
+    timing_col1, timing_col2 = st.columns(2)
+
+    with timing_col1:
+        warmup = st.number_input("Warmup runs per query", min_value=0, max_value=20, value=1)
+
+    with timing_col2:
+        trials = st.number_input("Timed trials per query", min_value=1, max_value=100, value=5)
+
+    incremental = st.checkbox("Reuse stored results for collections whose indexes and size bucket are unchanged", value=True)
+    drain = st.checkbox("Drain results as raw BSON (count documents and bytes without decoding; for large result sets)", value=False)
+
     if st.button("Run Query Analysis"):
         with st.spinner("Running test queries and analyzing performance..."):
             try:
@@ -129,19 +187,43 @@ elif page == "Analyze Queries":
                     st.error("The recommender does not have a run_test_queries method. Reinitializing...")
                     if "index_recommender" in sys.modules:
                         importlib.reload(sys.modules["index_recommender"])
-                    st.session_state.recommender = IndexRecommender(st.session_state.db_queries)
+                    st.session_state.recommender = new_recommender(st.session_state.db_queries)
                     if not hasattr(st.session_state.recommender, "run_test_queries"):
                         st.error("Still cannot find run_test_queries method after reload.")
                         st.stop()
 
-                query_results = st.session_state.recommender.run_test_queries(queries_file_path)
+                st.session_state.db_queries.drain = drain
+                query_results = st.session_state.recommender.run_test_queries(queries_file_path, max_workers=int(max_workers), max_per_collection=int(max_per_collection) or None, use_asyncio=use_asyncio, warmup=int(warmup), trials=int(trials), incremental=incremental)
 
                 st.session_state.query_results = query_results
 
-                st.success(f"Successfully analyzed {len(query_results)} queries")
+                reused = sum(1 for q in query_results if q.get("cached"))
+                st.success(f"Successfully analyzed {len(query_results)} queries ({reused} served from the metrics store)")
             except Exception as e:
                 st.error(f"Error analyzing queries: {e}")
 
+    with st.expander("Ingest real workload from the profiler or mongod logs"):
+        workload_source = st.radio("Workload source", ["system.profile", "mongod log files"], horizontal=True)
+        slow_ms = st.number_input("Only include operations slower than (ms)", min_value=0, value=100)
+
+        if workload_source == "system.profile":
+            follow_s = st.number_input("Keep tailing system.profile for up to (seconds, 0 reads only the current contents)", min_value=0, value=60)
+        if workload_source == "mongod log files":
+            log_paths = st.text_input("Log file paths or glob (rotated and .gz files are picked up automatically)", "/var/log/mongodb/mongod.log")
+
+        if st.button("Ingest Workload"):
+            with st.spinner("Streaming workload and aggregating query shapes..."):
+                try:
+                    if workload_source == "system.profile":
+                        query_results = st.session_state.recommender.ingest_profile(tailable=follow_s > 0, max_duration_s=follow_s, slow_ms=slow_ms)
+                    else:
+                        query_results = st.session_state.recommender.ingest_logs([path.strip() for path in log_paths.split(",") if path.strip()], slow_ms=slow_ms)
+
+                    st.session_state.query_results = query_results
+                    st.success(f"Ingested {sum(q.get('execution_count', 1) for q in query_results)} operations across {len(query_results)} query shapes")
+                except Exception as e:
+                    st.error(f"Error ingesting workload: {e}")
+
     if uploaded_queries and "queries_file_path" in locals():
         try:
             os.unlink(queries_file_path)
@@ -171,12 +253,30 @@ elif page == "Analyze Queries":
         if not display_queries:
             st.info("No queries to display with current filter. Try changing the filter option.")
         else:
-            df_queries = pd.DataFrame([{"Collection": q.get("collection"), "Query Name": q.get("query_name", ""), "Time (ms)": round(q.get("execution_time_ms", 0), 2), "Indexed?": "✅" if q.get("is_indexed", False) else "❌", "Results": q.get("result_count", 0), "Query": str(q.get("query", ""))[:50] + "..." if len(str(q.get("query", ""))) > 50 else str(q.get("query", ""))} for q in display_queries])
+            df_queries = pd.DataFrame([{"Collection": q.get("collection"), "Query Name": q.get("query_name", ""), "Time (ms)": round(q.get("execution_time_ms", 0), 2), "p95 (ms)": round(q.get("timing", {}).get("p95_ms", 0), 2), "p99 (ms)": round(q.get("timing", {}).get("p99_ms", 0), 2), "Stddev (ms)": round(q.get("timing", {}).get("stddev_ms", 0), 2), "Server (ms)": q.get("plan", {}).get("execution_time_ms"), "Client (ms)": round(q.get("timing", {}).get("client_p50_ms", 0), 2), "Indexed?": "✅" if q.get("is_indexed", False) else "❌", "Docs Examined / Returned": round(q.get("plan", {}).get("docs_examined_per_returned", 0), 1), "In-memory Sort": "⚠️" if q.get("plan", {}).get("has_in_memory_sort") else "", "Results": q.get("result_count", 0), "Query": str(q.get("query", ""))[:50] + "..." if len(str(q.get("query", ""))) > 50 else str(q.get("query", ""))} for q in display_queries])
 
             df_queries = df_queries.sort_values(by="Time (ms)", ascending=False)
 
             st.dataframe(df_queries)
 
+        with st.expander("Latency history from the metrics store"):
+            shape_names = {q.get("shape_hash"): f"{q.get('collection')}: {q.get('query_name') or q.get('query_shape')}" for q in st.session_state.query_results if q.get("shape_hash")}
+            if shape_names:
+                trend_shape = st.selectbox("Query shape", list(shape_names), format_func=shape_names.get)
+                trend = get_metrics_store().latency_trend(shape_hash=trend_shape, bucket_seconds=3600)
+
+                if trend.empty:
+                    st.info("No stored samples for this shape yet")
+                else:
+                    trend["hour"] = pd.to_datetime(trend["bucket"], unit="s")
+                    st.line_chart(trend.set_index("hour")[["p50_ms", "p95_ms", "p99_ms"]])
+
+        with st.expander("Time and server round trips per stage"):
+            st.caption("Totals since the app started, across all sessions. Stage time minus server time is spent in the recommender itself.")
+            stages = METRICS.snapshot()
+            if stages:
+                st.dataframe(pd.DataFrame([{"Stage": name, "Calls": entry["calls"], "Errors": entry["errors"], "Time (s)": round(entry["seconds"], 3), "Server Time (s)": round(entry["command_seconds"], 3), "Round Trips": entry["round_trips"], "Failed Commands": entry["failed_commands"]} for name, entry in sorted(stages.items())]))
+
 elif page == "View Recommendations":
     st.header("Index Recommendations")
 
@@ -185,14 +285,22 @@ elif page == "View Recommendations":
         st.stop()
 
     if st.session_state.db_queries and not st.session_state.recommender:
-        st.session_state.recommender = IndexRecommender(st.session_state.db_queries)
+        st.session_state.recommender = new_recommender(st.session_state.db_queries)
+
+    verify_covering = st.checkbox("Verify covering indexes with explain on a scratch sample", value=False)
+    verify_partial = st.checkbox("Verify partial and sparse indexes are picked by the planner on a scratch sample", value=False)
+
+    if not st.session_state.recommender or not st.session_state.recommender.query_results:
+        st.warning("Run or ingest a workload on the Analyze Queries page first")
+        st.stop()
 
     if st.button("Generate Recommendations"):
         with st.spinner("Analyzing queries..."):
             recommender = st.session_state.recommender
-            recommendations = recommender.recommend_indexes()
+            recommendations = recommender.recommend_indexes(verify_covering=verify_covering, verify_partial=verify_partial)
 
             st.session_state.recommendations = recommendations
+            st.session_state.what_if_reports = {}
 
             if recommendations:
                 st.success(f"Generated {len(recommendations)} recommendations")
@@ -202,25 +310,57 @@ elif page == "View Recommendations":
     if st.session_state.recommendations:
         recommendation_data = []
         for i, rec in enumerate(st.session_state.recommendations):
-            recommendation_data.append({"#": i + 1, "Collection": rec["collection"], "Fields": ", ".join(rec["fields"]), "Query Time (ms)": round(rec["avg_execution_time_ms"], 2), "Count": rec["execution_count"]})
+            recommendation_data.append({"#": i + 1, "Collection": rec["collection"], "Fields": ", ".join(rec["fields"]), "Query Time (ms)": round(rec["avg_execution_time_ms"], 2), "p95 (ms)": round(rec.get("p95_ms") or 0, 2), "p99 (ms)": round(rec.get("p99_ms") or 0, 2), "Net Benefit (ms)": round(rec.get("net_benefit_ms", 0), 1), "Write Cost (ms)": round(rec.get("write_cost_ms", 0), 1), "Wasted Work": rec.get("wasted_work", 0), "Est. Size (MB)": round(rec.get("estimated_size_bytes", 0) / 1024 ** 2, 1), "Partial": "sparse" if (rec.get("index_options") or {}).get("sparse") else ("✅" if rec.get("partial_filter") else ""), "Shapes Served": len(rec.get("serves", [])) or 1, "Count": rec["execution_count"]})
 
         st.table(pd.DataFrame(recommendation_data))
 
+        budget_mb = st.number_input("Index memory budget (MB, 0 = no budget)", min_value=0.0, value=0.0, step=256.0)
+        if budget_mb:
+            selection = st.session_state.recommender.select_within_budget(int(budget_mb * 1024 ** 2), st.session_state.recommendations)
+            st.write(f"Best indexes for {budget_mb:.0f} MB: {len(selection['selected'])} of {len(st.session_state.recommendations)}, using ~{selection['total_bytes'] / 1024 ** 2:.1f} MB for ~{selection['total_benefit_ms']:.0f} ms of workload benefit")
+            st.table(pd.DataFrame([{"Collection": rec["collection"], "Index Keys": ", ".join(f"{field}: {direction}" for field, direction in rec["index_spec"]), "Est. Size (MB)": round(rec["estimated_size_bytes"] / 1024 ** 2, 1), "Net Benefit (ms)": round(rec.get("net_benefit_ms", 0), 1)} for rec in selection["selected"]]))
+
         selected_index = st.selectbox("View details for recommendation:", range(1, len(st.session_state.recommendations) + 1), format_func=lambda x: f"#{x}")
 
         if selected_index:
             rec = st.session_state.recommendations[selected_index - 1]
             st.write(f"Collection: {rec['collection']}")
             st.write(f"Fields to index: {', '.join(rec['fields'])}")
+            st.write(f"Index keys: {', '.join(f'{field}: {direction}' for field, direction in st.session_state.recommender.generate_index_spec(rec))} ({' / '.join(rec.get('esr', []))})")
             st.write(f"Query pattern: {rec['query_pattern']}")
+            if rec.get("covering"):
+                verified = {True: " (verified: no FETCH stage)", False: " (not covered on the sample)"}.get(rec.get("covered_verified"), "")
+                st.write(f"Covering index: the projection is answered from index keys without fetching documents{verified}")
+            if rec.get("partial_filter"):
+                kind = "Sparse" if rec["index_options"].get("sparse") else "Partial"
+                verified = {True: " (verified: the planner uses it)", False: ""}.get(rec.get("partial_verified"), "")
+                st.write(f"{kind} index over ~{rec['subset_fraction']:.1%} of documents: {json.dumps(rec['partial_filter'], default=str)}{verified}")
+            if rec.get("lookup_from"):
+                st.write(f"Probed by $lookup from collection {rec['lookup_from']}")
+            if rec.get("pipeline"):
+                st.json(rec["pipeline"], expanded=False)
             st.write(f"Average execution time: {rec['avg_execution_time_ms']:.2f} ms")
+            st.write(f"Latency p50 / p95 / p99: {rec.get('p50_ms') or 0:.2f} / {rec.get('p95_ms') or 0:.2f} / {rec.get('p99_ms') or 0:.2f} ms (stddev {rec.get('stddev_ms') or 0:.2f} ms)")
             st.write(f"Execution count: {rec['execution_count']}")
+            st.write(f"Winning plan stages: {' → '.join(rec.get('plan_stages', []))}")
+            st.write(f"Docs examined per doc returned: {rec.get('docs_examined_per_returned') or 0:.1f}")
+            write_mix = rec.get("write_mix") or {}
+            st.write(f"Read benefit {rec.get('read_benefit_ms', 0):.0f} ms − index maintenance {rec.get('write_cost_ms', 0):.1f} ms over {write_mix.get('insert', 0):.0f} inserts / {write_mix.get('update', 0):.0f} updates / {write_mix.get('delete', 0):.0f} deletes = net {rec.get('net_benefit_ms', 0):.0f} ms")
+            if rec.get("estimated_selectivity") is not None:
+                st.write(f"Estimated selectivity of equality keys: {rec['estimated_selectivity']:.2%} of documents")
+            for shape in rec.get("serves", [])[1:]:
+                st.write(f"Also serves: {shape['query_pattern']} ({shape['execution_count']} executions)")
+
+        suppressed = getattr(st.session_state.recommender, "suppressed_recommendations", [])
+        if suppressed:
+            with st.expander(f"{len(suppressed)} recommendations suppressed (covered by existing indexes, too unselective or net-negative)"):
+                st.table(pd.DataFrame([{"Collection": rec["collection"], "Query Pattern": rec["query_pattern"], "Reason": rec["suppressed_reason"]} for rec in suppressed]))
 
         if st.button("Export as JSON"):
             with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as tmp_file:
                 export_data = {"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "recommendations": st.session_state.recommendations}
 
-                tmp_file.write(json.dumps(export_data, indent=2).encode())
+                tmp_file.write(json.dumps(export_data, indent=2, default=str).encode())
                 export_path = tmp_file.name
 
             with open(export_path, "rb") as file:
@@ -243,68 +383,121 @@ elif page == "Apply Indexes":
 
     if "applied_indexes" not in st.session_state:
         st.session_state.applied_indexes = []
+    if "what_if_reports" not in st.session_state:
+        st.session_state.what_if_reports = {}
+
+    what_if_fraction = st.slider("What-if sample size (% of collection)", min_value=0.1, max_value=20.0, value=1.0, step=0.1) / 100
+
+    ab_col1, ab_col2 = st.columns(2)
+
+    with ab_col1:
+        ab_blocks = st.number_input("Validation ABBA blocks per shape", min_value=4, max_value=100, value=DEFAULT_BLOCKS)
+
+    with ab_col2:
+        ab_alpha = st.number_input("Significance level", min_value=0.001, max_value=0.2, value=DEFAULT_ALPHA, step=0.01, format="%.3f")
 
     for i, rec in enumerate(st.session_state.recommendations):
         col1, col2 = st.columns([3, 1])
 
         with col1:
-            st.markdown(f"**Index on `{rec['collection']}` fields:** `{', '.join(rec['fields'])}`")
+            st.markdown(f"**Index on `{rec['collection']}` keys:** `{', '.join(f'{field}: {direction}' for field, direction in st.session_state.recommender.generate_index_spec(rec))}`")
             st.caption(f"Current query time: {rec['avg_execution_time_ms']:.2f} ms")
 
+            report = st.session_state.what_if_reports.get(i)
+            if report:
+                speedup = f"{report['speedup']:.1f}x" if report["speedup"] else "n/a"
+                st.caption(f"What-if on {report['sample_documents']} sampled documents: speedup {speedup}, estimated saving {report['estimated_saving_ms']:.0f} ms across the workload, index used: {'yes' if report['index_used'] else 'no'}, covered: {'yes' if all(shape.get('covered') for shape in report['shapes']) else 'no'}")
+
         with col2:
-            if st.button(f"Apply #{i+1}", key=f"apply_btn_{i}"):
-                with st.spinner(f"Creating index on {rec['collection']}..."):
-                    previous_time = rec.get("avg_execution_time_ms", 0)
+            if st.button(f"What-if #{i+1}", key=f"what_if_btn_{i}"):
+                with st.spinner(f"Evaluating index on a sample of {rec['collection']}..."):
+                    try:
+                        st.session_state.what_if_reports[i] = st.session_state.recommender.evaluate_what_if(rec, sample_fraction=what_if_fraction)
+                        st.session_state.recommender.attach_what_if(rec, st.session_state.what_if_reports[i])
+                    except Exception as e:
+                        st.error(f"Error evaluating index: {e}")
+
+                if i in st.session_state.what_if_reports:
+                    st.rerun()
 
+            if st.button(f"Apply #{i+1}", key=f"apply_btn_{i}"):
+                with st.spinner(f"Creating index on {rec['collection']} and validating it against the workload..."):
                     index_spec = st.session_state.recommender.generate_index_spec(rec)
 
+                    # Hinted trials must run where the build was awaited: a secondary may not have the index yet
+                    validation_queries = DBQueries(st.session_state.selected_db, client=st.session_state.client, read_preference="primary")
+
                     try:
-                        index_name = st.session_state.db_queries.create_index(rec["collection"], index_spec)
+                        before_hints = baseline_hints(validation_queries, rec)
+                        index_name = st.session_state.db_queries.create_index(rec["collection"], index_spec, **rec.get("index_options") or {})
 
-                        fields = rec.get("fields", [])
-                        sample_query = {fields[0]: {"$exists": True}} if fields else {"_id": {"$exists": True}}
+                        # Recorded before validating, so a failed validation still leaves the index offered for rollback
+                        applied = {"collection": rec["collection"], "fields": rec["fields"], "index_name": index_name, "previous_time": 0.0, "current_time": 0.0, "improvement_pct": 0.0, "timestamp": time.strftime("%H:%M:%S"), "is_indexed": False, "validation": None, "rolled_back": False}
+                        st.session_state.applied_indexes.append(applied)
 
-                        results, current_time, explain = st.session_state.db_queries.execute_query(rec["collection"], sample_query)
+                        wait_for_index_build(validation_queries, rec["collection"], index_name)
 
-                        time_diff = previous_time - current_time
-                        improvement_pct = (time_diff / previous_time) * 100 if previous_time > 0 else 0
+                        validation = ab_validate(validation_queries, rec, index_name, before_hints, blocks=int(ab_blocks), alpha=ab_alpha)
+                        previous_time = validation["before_p50_ms"]
+                        current_time = validation["after_p50_ms"]
+                        improvement_pct = (1 - current_time / previous_time) * 100 if previous_time > 0 else 0
 
-                        st.session_state.applied_indexes.append({"collection": rec["collection"], "fields": rec["fields"], "index_name": index_name, "previous_time": previous_time, "current_time": current_time, "improvement_pct": improvement_pct, "timestamp": time.strftime("%H:%M:%S"), "is_indexed": "COLLSCAN" not in str(explain)})
+                        applied.update({"previous_time": previous_time, "current_time": current_time, "improvement_pct": improvement_pct, "is_indexed": validation["planner_uses_index"], "validation": validation})
 
                         st.success(f"Index '{index_name}' created successfully!")
 
                         performance_col1, performance_col2, performance_col3 = st.columns([1, 1, 1])
 
                         with performance_col1:
-                            st.metric("Before", f"{previous_time:.2f} ms")
+                            st.metric("Before (p50)", f"{previous_time:.2f} ms")
 
                         with performance_col2:
-                            st.metric("After", f"{current_time:.2f} ms")
+                            st.metric("After (p50)", f"{current_time:.2f} ms")
 
                         with performance_col3:
                             st.metric("Improvement", f"{improvement_pct:.1f}%", delta=f"{improvement_pct:.1f}%", delta_color="normal")
 
-                        if "COLLSCAN" not in str(explain):
-                            st.success("✅ Index is being used for this query!")
+                        st.caption(f"{len(validation['shapes'])} workload shapes replayed in {validation['blocks']} interleaved ABBA blocks, both plans forced with hint")
+                        if not validation["shapes"]:
+                            st.info("No replayable shapes ($lookup probes run inside another collection's pipeline); the improvement cannot be validated here.")
+                        elif validation["confirmed"]:
+                            st.success(f"✅ Improvement confirmed (Mann-Whitney p < {validation['alpha']}) for {validation['improved_share']:.0%} of executions")
                         else:
-                            st.warning("⚠️ Index is not being used for this query.")
+                            st.warning("⚠️ The improvement is not statistically significant or some shapes got slower. Consider rolling back below.")
+
+                        if not validation["planner_uses_index"]:
+                            st.warning("⚠️ Without a hint, the planner does not choose this index for every shape.")
 
                     except Exception as e:
-                        st.error(f"Error creating index: {e}")
+                        st.error(f"Error applying or validating the index: {e}")
 
     if st.session_state.applied_indexes:
         st.subheader("Performance Improvements")
 
         performance_data = []
         for idx in st.session_state.applied_indexes:
-            performance_data.append({"Collection": idx["collection"], "Fields": ", ".join(idx["fields"]), "Previous (ms)": round(idx["previous_time"], 2), "Current (ms)": round(idx["current_time"], 2), "Improvement": f"{round(idx['improvement_pct'], 1)}%", "Index Used": "Yes" if idx.get("is_indexed", False) else "No"})
+            validation = idx.get("validation") or {}
+            performance_data.append({"Collection": idx["collection"], "Fields": ", ".join(idx["fields"]), "Previous (ms)": round(idx["previous_time"], 2), "Current (ms)": round(idx["current_time"], 2), "Improvement": f"{round(idx['improvement_pct'], 1)}%", "Confirmed": "Yes" if validation.get("confirmed") else "No", "Worst p-value": round(max((shape["p_value"] for shape in validation.get("shapes", [])), default=1.0), 4), "Index Used": "Yes" if idx.get("is_indexed", False) else "No", "Status": "rolled back" if idx.get("rolled_back") else "applied"})
 
         if performance_data:
             st.dataframe(pd.DataFrame(performance_data))
 
+            for position, idx in enumerate(st.session_state.applied_indexes):
+                if idx.get("rolled_back") or (idx.get("validation") or {}).get("confirmed"):
+                    continue
+
+                reason = "improvement not confirmed" if idx.get("validation") else "validation did not finish"
+                if st.button(f"Roll back {idx['index_name']} on {idx['collection']} ({reason})", key=f"rollback_btn_{position}"):
+                    try:
+                        rollback(st.session_state.db_queries, idx["collection"], idx["index_name"])
+                        idx["rolled_back"] = True
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Error dropping index: {e}")
+
             st.subheader("Performance Visualization")
 
-            improved_indexes = [idx for idx in st.session_state.applied_indexes if idx["improvement_pct"] > 0]
+            improved_indexes = [idx for idx in st.session_state.applied_indexes if idx["improvement_pct"] > 0 and not idx.get("rolled_back")]
 
             if improved_indexes:
                 import matplotlib.pyplot as plt
@@ -371,12 +564,59 @@ elif page == "Apply Indexes":
             st.info("Applied indexes data cleared.")
             st.rerun()
 
+elif page == "Audit Indexes":
+    st.header("Audit Existing Indexes")
+
+    if not st.session_state.connected:
+        st.warning("Please connect to MongoDB first")
+        st.stop()
+
+    if "index_audit" not in st.session_state:
+        st.session_state.index_audit = None
 
-def on_shutdown():
-    if "client" in st.session_state and st.session_state.client:
-        st.session_state.client.close()
+    min_observation_days = st.number_input("Only call an index unused after its access counters cover at least (days)", min_value=0.0, value=7.0)
 
+    if st.button("Run Index Audit"):
+        with st.spinner("Reading $indexStats and index sizes..."):
+            st.session_state.index_audit = audit_database(st.session_state.db_queries, min_observation_s=min_observation_days * 86400)
 
-import atexit
+    audit = st.session_state.index_audit
+    if audit:
+        for collection, error in audit["errors"].items():
+            st.warning(f"Could not audit {collection}: {error}")
 
-atexit.register(on_shutdown)
+        col1, col2, col3 = st.columns(3)
+
+        with col1:
+            st.metric("Flagged Indexes", len(audit["findings"]))
+
+        with col2:
+            st.metric("Reclaimable Disk", f"{audit['reclaimable_disk_bytes'] / 1024 ** 2:.1f} MB")
+
+        with col3:
+            st.metric("Reclaimable Cache (RAM)", f"{audit['reclaimable_cache_bytes'] / 1024 ** 2:.1f} MB")
+
+        if not audit["findings"]:
+            st.success("No unused, redundant or duplicate indexes found")
+        else:
+            st.dataframe(pd.DataFrame([{"Collection": item["collection"], "Index": item["name"], "Keys": ", ".join(f"{field}: {direction}" for field, direction in item["key"]), "Issue": item["issue"], "Reason": item["reason"], "Accesses": item["accesses"], "Disk (MB)": round(item["disk_bytes"] / 1024 ** 2, 2), "Cache (MB)": round(item["cache_bytes"] / 1024 ** 2, 2), "Hidden": "✅" if item["hidden"] else ""} for item in audit["findings"]]))
+
+            st.subheader("Guarded Drop Plan")
+            st.caption("Hide an index first and watch the workload; only a hidden index can be dropped, and unhiding restores it instantly.")
+
+            for i, step in enumerate(drop_plan(audit["findings"])):
+                col1, col2 = st.columns([3, 1])
+
+                with col1:
+                    st.markdown(f"**{step['action'].capitalize()}** `{step['collection']}.{step['name']}` ({step['reason']})")
+
+                with col2:
+                    actions = [step["action"]] + (["unhide"] if step["action"] == "drop" else [])
+                    for action in actions:
+                        if st.button(action.capitalize(), key=f"audit_{action}_{i}"):
+                            try:
+                                apply_plan_step(st.session_state.db_queries, {**step, "action": action})
+                                st.session_state.index_audit = audit_database(st.session_state.db_queries, min_observation_s=min_observation_days * 86400)
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"Error applying {action} to {step['name']}: {e}")
@@ -0,0 +1,102 @@
+from unittest import mock
+
+from pymongo import ReadPreference
+
+from db_queries import DBQueries, SHADOW_COLLECTION_PREFIX
+
+
+def make_queries(read_preference=None):
+    """DBQueries over a mocked client; each get_database call returns a fresh mock keeping its read preference"""
+    client = mock.MagicMock()
+
+    def get_database(name, read_preference=None):
+        database = mock.MagicMock()
+        database.read_preference = read_preference
+        return database
+
+    client.get_database.side_effect = get_database
+    return DBQueries("shop", client=client, read_preference=read_preference)
+
+
+def test_command_forwards_value_and_keyword_arguments():
+    queries = make_queries("secondaryPreferred")
+
+    queries._command("orders", "explain", {"find": "orders"}, verbosity="queryPlanner")
+
+    queries.db.command.assert_called_once_with("explain", {"find": "orders"}, read_preference=ReadPreference.SECONDARY_PREFERRED, verbosity="queryPlanner")
+
+
+def test_command_value_defaults_to_one():
+    queries = make_queries()
+
+    queries._command("orders", "ping")
+
+    queries.db.command.assert_called_once_with("ping", 1, read_preference=None)
+
+
+def test_command_on_shadow_collection_reads_from_primary():
+    queries = make_queries("secondary")
+
+    queries._command(f"{SHADOW_COLLECTION_PREFIX}orders_1", "explain", {"find": "x"})
+
+    queries.primary_db.command.assert_called_once_with("explain", {"find": "x"}, read_preference=ReadPreference.PRIMARY)
+    queries.db.command.assert_not_called()
+
+
+def test_explain_query_sends_the_find_as_executed():
+    queries = make_queries()
+    queries.db.command.return_value = {"queryPlanner": {}}
+
+    plan = queries.explain_query("orders", {"status": "A"}, {"_id": 0}, [("created", -1)], 10, hint=[("status", 1)])
+
+    assert plan == {"queryPlanner": {}}
+    queries.db.command.assert_called_once_with("explain", {"find": "orders", "filter": {"status": "A"}, "projection": {"_id": 0}, "sort": {"created": -1}, "limit": 10, "hint": {"status": 1}}, read_preference=None, verbosity="executionStats")
+
+
+def test_explain_aggregate_sends_the_pipeline():
+    queries = make_queries()
+    pipeline = [{"$match": {"status": "A"}}]
+
+    queries.explain_aggregate("orders", pipeline)
+
+    queries.db.command.assert_called_once_with("explain", {"aggregate": "orders", "pipeline": pipeline, "cursor": {}, "allowDiskUse": True}, read_preference=None, verbosity="executionStats")
+
+
+def test_drop_shadow_collections_keeps_recent_scratch_collections():
+    queries = make_queries("secondary")
+    recent = queries._shadow_name("orders")
+    queries.primary_db.list_collection_names.return_value = ["orders", f"{SHADOW_COLLECTION_PREFIX}orders_100_abcd1234", f"{SHADOW_COLLECTION_PREFIX}orders_abcd1234", recent]
+
+    dropped = queries.drop_shadow_collections()
+
+    assert dropped == [f"{SHADOW_COLLECTION_PREFIX}orders_100_abcd1234", f"{SHADOW_COLLECTION_PREFIX}orders_abcd1234"]
+    assert [call.args[0] for call in queries.primary_db.drop_collection.call_args_list] == dropped
+
+
+def test_shadow_collection_sweeps_stale_collections_on_exit():
+    queries = make_queries()
+    queries.db.__getitem__.return_value.aggregate.return_value = []
+    queries.db.__getitem__.return_value.estimated_document_count.return_value = 0
+    queries.primary_db.list_collection_names.return_value = [f"{SHADOW_COLLECTION_PREFIX}orders_100_abcd1234"]
+
+    with queries.shadow_collection("orders") as shadow:
+        assert shadow["name"].startswith(f"{SHADOW_COLLECTION_PREFIX}orders_")
+
+    queries.db.drop_collection.assert_called_once_with(shadow["name"])
+    queries.primary_db.drop_collection.assert_called_once_with(f"{SHADOW_COLLECTION_PREFIX}orders_100_abcd1234")
+
+
+def test_shadow_collection_copies_source_indexes():
+    queries = make_queries()
+    queries.db.__getitem__.return_value.aggregate.return_value = []
+    queries.db.__getitem__.return_value.estimated_document_count.return_value = 0
+    queries.primary_db.list_collection_names.return_value = []
+    queries.primary_db.__getitem__.return_value.list_indexes.return_value = [{"v": 2, "key": {"_id": 1}, "name": "_id_"}, {"v": 2, "key": {"status": 1, "created": -1}, "name": "status_1_created_-1", "partialFilterExpression": {"status": "A"}}, {"v": 2, "key": {"created": 1}, "name": "created_1", "expireAfterSeconds": 3600}]
+
+    with queries.shadow_collection("orders") as shadow:
+        assert shadow["indexes"] == ["status_1_created_-1", "created_1"]
+
+    create_index = queries.primary_db.__getitem__.return_value.create_index
+    assert create_index.call_args_list[0].args == ([("status", 1), ("created", -1)],)
+    assert create_index.call_args_list[0].kwargs == {"name": "status_1_created_-1", "partialFilterExpression": {"status": "A"}}
+    assert create_index.call_args_list[1].kwargs == {"name": "created_1"}
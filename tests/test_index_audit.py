@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta, timezone
+
+from index_audit import REDUNDANT, UNUSED, audit_indexes
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+SINCE = NOW - timedelta(days=30)
+INDEXES = [{"name": "_id_", "key": [("_id", 1)]}, {"name": "a_1", "key": [("a", 1)]}, {"name": "a_1_b_1", "key": [("a", 1), ("b", 1)]}]
+
+
+def test_unused_wider_index_does_not_make_its_prefix_redundant():
+    stats = {"a_1": {"ops": 100000, "since": SINCE}, "a_1_b_1": {"ops": 0, "since": SINCE}}
+
+    findings = audit_indexes("orders", INDEXES, stats, now=NOW)
+
+    assert [(item["name"], item["issue"]) for item in findings] == [("a_1_b_1", UNUSED)]
+
+
+def test_used_wider_index_makes_its_prefix_redundant():
+    stats = {"a_1": {"ops": 10, "since": SINCE}, "a_1_b_1": {"ops": 500, "since": SINCE}}
+
+    findings = audit_indexes("orders", INDEXES, stats, now=NOW)
+
+    assert [(item["name"], item["issue"], item["covered_by"]) for item in findings] == [("a_1", REDUNDANT, "a_1_b_1")]
@@ -0,0 +1,156 @@
+import pytest
+
+from index_validation import NATURAL_ORDER, _average_ranks, ab_validate, mann_whitney_u, replayable_shapes, wait_for_index_build
+
+
+def test_average_ranks_share_ties():
+    ranks, tie_sizes = _average_ranks([10, 20, 10, 30])
+
+    assert ranks == [1.5, 3.0, 1.5, 4.0]
+    assert sorted(tie_sizes) == [1, 1, 2]
+
+
+def test_mann_whitney_u_detects_lower_after():
+    before = [10, 11, 12, 13, 14, 15, 16, 17]
+    after = [1, 2, 3, 4, 5, 6, 7, 8]
+
+    result = mann_whitney_u(before, after)
+
+    assert result["u"] == len(before) * len(after)
+    assert result["p_value"] < 0.001
+
+
+def test_mann_whitney_u_is_one_sided():
+    before = [1, 2, 3, 4, 5, 6, 7, 8]
+    after = [10, 11, 12, 13, 14, 15, 16, 17]
+
+    assert mann_whitney_u(before, after)["u"] == 0
+    assert mann_whitney_u(before, after)["p_value"] > 0.999
+    assert mann_whitney_u(after, before)["p_value"] < 0.001
+
+
+def test_mann_whitney_u_identical_samples_are_not_significant():
+    assert mann_whitney_u([5.0] * 8, [5.0] * 8) == {"u": 32.0, "z": 0.0, "p_value": 1.0}
+
+
+def test_mann_whitney_u_tie_correction():
+    # Pooled ranks of [3, 3, 4, 4] are 4, 4, 7, 7, so U = 22 - 10 = 12; the two tie groups of three shrink the variance
+    # from 4 * 4 / 12 * 9 to 4 * 4 / 12 * (9 - 48 / 56)
+    result = mann_whitney_u([3, 3, 4, 4], [1, 2, 3, 4])
+
+    assert result["u"] == 12.0
+    assert result["z"] == pytest.approx((12 - 8 - 0.5) / (16 / 12 * (9 - 48 / 56)) ** 0.5)
+
+
+def test_mann_whitney_u_empty_sample():
+    assert mann_whitney_u([], [1, 2])["p_value"] == 1.0
+
+
+class FakeValidationDB:
+    """Timed runs return the latency configured for the hint; explains report the index the planner would pick"""
+
+    def __init__(self, latency_ms, planner_index=None):
+        self.latency_ms = latency_ms
+        self.planner_index = planner_index
+        self.hints = []
+        self.calls = 0
+
+    def timed_find(self, collection_name, query, projection=None, sort=None, limit=None, hint=None):
+        self.hints.append(hint)
+        self.calls += 1
+        # A small alternating jitter keeps the samples from tying
+        return self.latency_ms[str(hint)] + (self.calls % 3) * 0.01
+
+    def explain_query(self, collection_name, query, projection=None, sort=None, limit=None, hint=None):
+        stage = {"stage": "IXSCAN", "indexName": self.planner_index} if self.planner_index else {"stage": "COLLSCAN"}
+        return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": stage}}, "executionStats": {}}
+
+
+def _recommendation(*shapes):
+    return {"collection": "orders", "serves": list(shapes)}
+
+
+def test_ab_validate_runs_abba_blocks_and_confirms_faster_index():
+    db = FakeValidationDB({str(NATURAL_ORDER): 20.0, "status_1": 2.0}, planner_index="status_1")
+    recommendation = _recommendation({"query_pattern": "{status: ?}", "example_query": {"status": "A"}, "execution_count": 3})
+
+    report = ab_validate(db, recommendation, "status_1", [NATURAL_ORDER], blocks=4, warmup=1)
+
+    # One warmup pair, then A B B A per block
+    assert db.hints[:2] == [NATURAL_ORDER, "status_1"]
+    assert db.hints[2:6] == [NATURAL_ORDER, "status_1", "status_1", NATURAL_ORDER]
+    assert len(db.hints) == 2 + 4 * 4
+
+    shape = report["shapes"][0]
+    assert shape["before"]["trials"] == shape["after"]["trials"] == 8
+    assert shape["improved"] and not shape["regressed"]
+    assert report["confirmed"] and report["planner_uses_index"]
+    assert report["improved_share"] == 1.0
+    assert report["saving_ms"] == pytest.approx((shape["before"]["p50_ms"] - shape["after"]["p50_ms"]) * 3)
+
+
+def test_ab_validate_rejects_slower_index():
+    db = FakeValidationDB({"old_1": 2.0, "status_1": 20.0})
+    recommendation = _recommendation({"query_pattern": "{status: ?}", "example_query": {"status": "A"}})
+
+    report = ab_validate(db, recommendation, "status_1", ["old_1"], blocks=4, warmup=0)
+
+    assert report["shapes"][0]["regressed"]
+    assert not report["confirmed"]
+    assert not report["planner_uses_index"]
+
+
+def test_ab_validate_weights_improved_share_by_executions():
+    db = FakeValidationDB({"a_1": 20.0, "b_1": 2.0, "status_1": 5.0})
+    recommendation = _recommendation({"example_query": {"a": 1}, "execution_count": 1}, {"example_query": {"b": 1}, "execution_count": 3})
+
+    report = ab_validate(db, recommendation, "status_1", ["a_1", "b_1"], blocks=4, warmup=0)
+
+    assert [shape["improved"] for shape in report["shapes"]] == [True, False]
+    assert report["improved_share"] == 0.25
+    assert not report["confirmed"]
+
+
+def test_replayable_shapes_skip_lookup_probes():
+    recommendation = _recommendation({"example_query": {"a": 1}}, {"example_query": {"b": "?lookup"}, "lookup_from": "orders"})
+
+    assert replayable_shapes(recommendation) == [{"example_query": {"a": 1}}]
+
+
+class FakeBuildDB:
+    def __init__(self, building_polls, current_op_error=None):
+        self.building_polls = building_polls
+        self.current_op_error = current_op_error
+        self.polls = 0
+
+    def index_stats(self, collection_name):
+        self.polls += 1
+        if self.polls == 1:
+            return {}
+        return {"status_1": {"name": "status_1", "building": self.polls <= self.building_polls}}
+
+    def index_build_in_progress(self, collection_name, index_name):
+        if self.current_op_error:
+            raise self.current_op_error
+        return False
+
+
+def test_wait_for_index_build_polls_until_built():
+    db = FakeBuildDB(building_polls=3)
+
+    wait_for_index_build(db, "orders", "status_1", poll_s=0)
+
+    assert db.polls == 4
+
+
+def test_wait_for_index_build_trusts_index_stats_without_current_op():
+    db = FakeBuildDB(building_polls=1, current_op_error=PermissionError("not authorized"))
+
+    wait_for_index_build(db, "orders", "status_1", poll_s=0)
+
+    assert db.polls == 2
+
+
+def test_wait_for_index_build_times_out():
+    with pytest.raises(TimeoutError):
+        wait_for_index_build(FakeBuildDB(building_polls=10 ** 6), "orders", "status_1", timeout_s=0, poll_s=0)
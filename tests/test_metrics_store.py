@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from bson import Decimal128, ObjectId
+
+from metrics_store import MetricsStore, workload_item_key
+
+
+def test_cached_result_keeps_bson_types():
+    store = MetricsStore(":memory:")
+    result = {"collection": "orders", "shape_hash": "abc", "query": {"_id": ObjectId("64b7f0c2a1b2c3d4e5f60718"), "created": {"$gt": datetime(2024, 1, 1)}, "total": Decimal128("9.99")}, "execution_time_ms": 1.5, "timing": {"samples_ms": [1.5]}}
+
+    store.record_results(store.start_run(), [result], ["key"], {"orders": "fingerprint"})
+
+    assert store.cached_result("orders", "key", "fingerprint") == result
+    assert store.cached_result("orders", "key", "other") is None
+
+
+def test_workload_item_key_depends_on_measurement_settings():
+    item = {"name": "by_status", "query": {"status": "A"}, "description": "ignored"}
+
+    assert workload_item_key(item, 1, 5) == workload_item_key({**item, "description": "changed"}, 1, 5)
+    assert workload_item_key(item, 1, 5) != workload_item_key(item, 1, 1)
+    assert workload_item_key(item, 1, 5) != workload_item_key(item, 0, 5)
+    assert workload_item_key(item, 1, 5) != workload_item_key(item, 1, 5, drain=True)
@@ -0,0 +1,18 @@
+from partial_index import recurring_constants, tally_constants
+
+
+def test_recurring_constants_need_enough_executions():
+    single = tally_constants({}, {"title": "The Godfather"})
+
+    assert recurring_constants(single, 1) == {}
+    assert recurring_constants(single, 1, min_executions=0) == {}
+
+
+def test_recurring_constants_from_observed_executions():
+    tally = {}
+    for _ in range(19):
+        tally_constants(tally, {"status": "A", "user": "u1"})
+    tally_constants(tally, {"status": "A", "user": "u2"})
+
+    assert recurring_constants(tally, 20) == {"status": {"$eq": "A"}, "user": {"$eq": "u1"}}
+    assert recurring_constants(tally, 20, min_executions=50) == {}
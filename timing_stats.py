@@ -0,0 +1,33 @@
+import math
+
+
+def percentile(sorted_samples, pct):
+    """Linear-interpolated percentile of an already sorted list of samples"""
+    if not sorted_samples:
+        return 0.0
+
+    if len(sorted_samples) == 1:
+        return float(sorted_samples[0])
+
+    rank = (len(sorted_samples) - 1) * pct / 100.0
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+
+    if lower == upper:
+        return float(sorted_samples[lower])
+
+    return sorted_samples[lower] + (sorted_samples[upper] - sorted_samples[lower]) * (rank - lower)
+
+
+def summarize_timings(samples_ms):
+    """Reduce timing samples in milliseconds to the distribution summary used across the recommender"""
+    samples = sorted(samples_ms)
+    count = len(samples)
+
+    if count == 0:
+        return {"trials": 0, "min_ms": 0.0, "max_ms": 0.0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "stddev_ms": 0.0, "samples_ms": []}
+
+    mean = sum(samples) / count
+    variance = sum((sample - mean) ** 2 for sample in samples) / (count - 1) if count > 1 else 0.0
+
+    return {"trials": count, "min_ms": samples[0], "max_ms": samples[-1], "mean_ms": mean, "p50_ms": percentile(samples, 50), "p95_ms": percentile(samples, 95), "p99_ms": percentile(samples, 99), "stddev_ms": math.sqrt(variance), "samples_ms": list(samples_ms)}
@@ -0,0 +1,238 @@
+import os
+import glob
+import gzip
+import json
+import random
+import time
+
+from timing_stats import summarize_timings
+from explain_analyzer import plan_from_summary
+from partial_index import tally_constants
+from pipeline_analysis import analyze_pipeline, index_sort
+from query_shape import pipeline_hash, pipeline_string, shape_hash, shape_string
+
+SLOW_QUERY_LOG_ID = 51803
+GZIP_MAGIC = b"\x1f\x8b"
+COMMAND_NAMES = ["find", "aggregate", "count", "distinct", "findAndModify", "update", "delete", "insert"]
+PROFILE_WRITE_OPS = {"insert": "insert", "update": "update", "remove": "delete"}
+
+
+def expand_log_paths(paths):
+    """Resolve files, globs and active log paths into an oldest-first list including rotated siblings"""
+    if isinstance(paths, str):
+        paths = [paths]
+
+    resolved = []
+    for path in paths:
+        matches = glob.glob(path) if glob.has_magic(path) else [path]
+
+        for match in matches:
+            if os.path.isdir(match):
+                continue
+
+            # mongod rotates "mongod.log" to "mongod.log.<timestamp>" and logrotate may compress it to ".gz"
+            rotated = [candidate for candidate in glob.glob(glob.escape(match) + ".*") if os.path.isfile(candidate)]
+            rotated.sort(key=os.path.getmtime)
+
+            for candidate in rotated + [match]:
+                if candidate not in resolved and os.path.isfile(candidate):
+                    resolved.append(candidate)
+
+    return resolved
+
+
+def open_log(path):
+    with open(path, "rb") as f:
+        is_gzip = f.read(2) == GZIP_MAGIC
+
+    if is_gzip:
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def iter_log_lines(paths):
+    """Lazily yield lines from every resolved log file, one file open at a time"""
+    for path in expand_log_paths(paths):
+        with open_log(path) as f:
+            for line in f:
+                yield line
+
+
+def _parse_sort(sort):
+    if not sort:
+        return None
+
+    if isinstance(sort, dict):
+        return [(field, direction) for field, direction in sort.items()]
+
+    return [(item[0], item[1]) for item in sort if isinstance(item, (list, tuple)) and len(item) == 2]
+
+
+def normalize_command(ns, command):
+    """Extract the query parts of a find/aggregate/... command as logged by the server"""
+    command = command or {}
+    op = next((name for name in COMMAND_NAMES if name in command), None)
+    collection = ns.split(".", 1)[1] if ns and "." in ns else command.get(op, "")
+
+    if op == "aggregate":
+        pipeline = command.get("pipeline", [])
+        analysis = analyze_pipeline(pipeline)
+        return {"op": op, "collection": collection, "filter": analysis["filter"], "pipeline": pipeline, "lookups": analysis["lookups"], "sort": index_sort(analysis), "projection": None, "limit": None}
+
+    if op == "insert":
+        return {"op": op, "collection": collection, "filter": {}, "sort": None, "projection": None, "limit": None}
+
+    if op in ["update", "delete"]:
+        statements = command.get("updates") or command.get("deletes") or [{}]
+        return {"op": op, "collection": collection, "filter": statements[0].get("q", {}), "update": statements[0].get("u"), "sort": None, "projection": None, "limit": None}
+
+    filter_doc = command.get("filter", command.get("query", {}))
+    return {"op": op or "unknown", "collection": collection, "filter": filter_doc or {}, "sort": _parse_sort(command.get("sort")), "projection": command.get("projection") or command.get("fields"), "limit": command.get("limit")}
+
+
+def parse_log_lines(lines):
+    """Yield normalized operations from mongod structured JSON log lines, skipping anything that is not a slow query"""
+    for line in lines:
+        if '"Slow query"' not in line and str(SLOW_QUERY_LOG_ID) not in line:
+            continue
+
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+
+        if entry.get("id") != SLOW_QUERY_LOG_ID and entry.get("msg") != "Slow query":
+            continue
+
+        attr = entry.get("attr", {})
+        if attr.get("type") not in [None, "command"]:
+            continue
+
+        op = normalize_command(attr.get("ns", ""), attr.get("command"))
+        op.update({"ns": attr.get("ns", ""), "source": "log", "ts": (entry.get("t") or {}).get("$date"), "duration_ms": attr.get("durationMillis", 0), "docs_examined": attr.get("docsExamined", 0), "keys_examined": attr.get("keysExamined", 0), "n_returned": attr.get("nreturned", attr.get("nReturned", 0)), "plan_summary": attr.get("planSummary", ""), "has_sort_stage": attr.get("hasSortStage", False)})
+        yield op
+
+
+def parse_profile_entries(entries):
+    """Yield normalized operations from system.profile documents"""
+    for entry in entries:
+        op = normalize_command(entry.get("ns", ""), entry.get("command"))
+
+        # Profiled writes record the individual statement ({q, u}) rather than the whole write command
+        if entry.get("op") in PROFILE_WRITE_OPS:
+            command = entry.get("command") or {}
+            op.update({"op": PROFILE_WRITE_OPS[entry["op"]], "filter": command.get("q", op.get("filter", {})), "update": command.get("u", op.get("update"))})
+        op.update({"ns": entry.get("ns", ""), "source": "profile", "ts": entry.get("ts"), "duration_ms": entry.get("millis", 0), "docs_examined": entry.get("docsExamined", 0), "keys_examined": entry.get("keysExamined", 0), "n_returned": entry.get("nreturned", 0), "plan_summary": entry.get("planSummary", ""), "has_sort_stage": entry.get("hasSortStage", False)})
+        yield op
+
+
+def follow_profile(db_queries, since=None, tailable=True, idle_timeout_s=None, poll_interval_s=1.0, max_duration_s=None):
+    """Yield system.profile documents, following the capped collection through a tailable cursor
+
+    The cursor is reopened after the last seen timestamp whenever the server closes it. Iteration stops once no
+    new entry arrived for idle_timeout_s seconds, after max_duration_s in total, or immediately after the current
+    contents when tailable is off.
+    """
+    last_ts = since
+    started = last_seen = time.monotonic()
+
+    while True:
+        cursor = db_queries.profile_cursor(since=last_ts, tailable=tailable)
+        try:
+            while True:
+                for entry in cursor:
+                    last_ts = entry.get("ts", last_ts)
+                    last_seen = time.monotonic()
+                    yield entry
+                    # A busy tailable cursor may never run dry, so the total bound is checked per entry as well
+                    if max_duration_s is not None and last_seen - started >= max_duration_s:
+                        return
+
+                if not tailable:
+                    return
+
+                if idle_timeout_s is not None and time.monotonic() - last_seen >= idle_timeout_s:
+                    return
+                if max_duration_s is not None and time.monotonic() - started >= max_duration_s:
+                    return
+
+                if not cursor.alive:
+                    break
+        finally:
+            cursor.close()
+
+        # A tailable cursor on an empty or rolled-over capped collection dies immediately, so back off before reopening
+        time.sleep(poll_interval_s)
+
+
+def filter_slow_ops(ops, slow_ms=100, op_types=None):
+    for op in ops:
+        if op.get("duration_ms", 0) < slow_ms:
+            continue
+        if op_types and op.get("op") not in op_types:
+            continue
+        yield op
+
+
+def aggregate_ops(ops, max_shapes=100000, reservoir_size=256):
+    """Fold a stream of operations into per-shape aggregates in bounded memory
+
+    Each shape keeps running counters and a fixed-size reservoir sample of durations for percentiles. Shapes beyond
+    max_shapes are counted as overflow rather than tracked.
+    """
+    aggregates = {}
+    overflow = 0
+
+    for op in ops:
+        fingerprint = pipeline_hash(op["pipeline"]) if op.get("pipeline") else shape_hash(op.get("filter"), op.get("sort"), op.get("projection"))
+        key = (op.get("collection", ""), fingerprint)
+        aggregate = aggregates.get(key)
+
+        if aggregate is None:
+            if len(aggregates) >= max_shapes:
+                overflow += 1
+                continue
+
+            aggregate = {"collection": op.get("collection", ""), "op": op.get("op"), "source": op.get("source"), "example": op, "count": 0, "total_duration_ms": 0, "reservoir": [], "docs_examined": 0, "keys_examined": 0, "n_returned": 0, "plan_summaries": {}, "has_sort_stage": False, "constants": {}}
+            aggregates[key] = aggregate
+
+        aggregate["count"] += 1
+        tally_constants(aggregate["constants"], op.get("filter"))
+        duration_ms = op.get("duration_ms", 0)
+        aggregate["total_duration_ms"] += duration_ms
+
+        if len(aggregate["reservoir"]) < reservoir_size:
+            aggregate["reservoir"].append(duration_ms)
+        else:
+            slot = random.randrange(aggregate["count"])
+            if slot < reservoir_size:
+                aggregate["reservoir"][slot] = duration_ms
+
+        aggregate["docs_examined"] += op.get("docs_examined", 0) or 0
+        aggregate["keys_examined"] += op.get("keys_examined", 0) or 0
+        aggregate["n_returned"] += op.get("n_returned", 0) or 0
+        aggregate["has_sort_stage"] = aggregate["has_sort_stage"] or bool(op.get("has_sort_stage"))
+
+        plan_summary = op.get("plan_summary", "")
+        aggregate["plan_summaries"][plan_summary] = aggregate["plan_summaries"].get(plan_summary, 0) + 1
+
+    return {"aggregates": aggregates, "overflow": overflow}
+
+
+def aggregates_to_results(aggregated):
+    """Turn per-shape aggregates into IndexRecommender query result records"""
+    results = []
+
+    for (collection, fingerprint), aggregate in aggregated["aggregates"].items():
+        count = aggregate["count"]
+        example = aggregate["example"]
+        plan_summary = max(aggregate["plan_summaries"], key=aggregate["plan_summaries"].get) if aggregate["plan_summaries"] else ""
+
+        timing = summarize_timings(aggregate["reservoir"])
+        timing["mean_ms"] = aggregate["total_duration_ms"] / count
+        plan = plan_from_summary(plan_summary, aggregate["docs_examined"] // count, aggregate["keys_examined"] // count, aggregate["n_returned"] // count, aggregate["has_sort_stage"], timing["mean_ms"])
+
+        results.append({"collection": collection, "query": example.get("filter", {}), "query_name": f"{aggregate['source']}:{aggregate['op']}", "query_shape": pipeline_string(example["pipeline"]) if example.get("pipeline") else shape_string(example.get("filter", {})), "shape_hash": fingerprint, "pipeline": example.get("pipeline"), "lookups": example.get("lookups", []), "sort": example.get("sort"), "projection": example.get("projection"), "limit": example.get("limit"), "execution_time_ms": timing["p50_ms"], "timing": timing, "execution_count": count, "is_indexed": plan["is_indexed"], "plan": plan, "result_count": plan["n_returned"], "source": aggregate["source"], "constants": aggregate.get("constants", {})})
+
+    return results
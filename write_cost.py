@@ -0,0 +1,111 @@
+from collections import Counter
+
+WRITE_OPS = ["insert", "update", "delete"]
+ALL_FIELDS = "*"
+
+
+def updated_fields(update):
+    """Field paths an update document modifies; a replacement or pipeline update touches every field"""
+    if not update or isinstance(update, list):
+        return [ALL_FIELDS]
+
+    if not any(key.startswith("$") for key in update):
+        return [ALL_FIELDS]
+
+    fields = []
+    for operator, changes in update.items():
+        if isinstance(changes, dict):
+            fields.extend(field.split(".$")[0] for field in changes)
+
+    return fields or [ALL_FIELDS]
+
+
+def _paths_overlap(field, other):
+    return field == other or field.startswith(other + ".") or other.startswith(field + ".")
+
+
+def touches_index(update_fields, index_fields):
+    return any(field == ALL_FIELDS or any(_paths_overlap(field, index_field) for index_field in index_fields) for field in update_fields)
+
+
+def new_write_mix(source):
+    return {"source": source, "insert": 0, "update": 0, "delete": 0, "update_fields": Counter()}
+
+
+def record_writes(ops, write_mixes, max_tracked_fields=1000):
+    """Pass operations through unchanged while tallying writes per collection into write_mixes"""
+    for op in ops:
+        op_type = op.get("op")
+        if op_type in WRITE_OPS:
+            write_mix = write_mixes.setdefault(op.get("collection", ""), new_write_mix(op.get("source", "profile")))
+            write_mix[op_type] += 1
+
+            if op_type == "update":
+                update_fields = write_mix["update_fields"]
+                for field in set(updated_fields(op.get("update"))):
+                    if field in update_fields or len(update_fields) < max_tracked_fields:
+                        update_fields[field] += 1
+
+        yield op
+
+
+def write_mix_from_stats(collection_stats, opcounters, workload_reads):
+    """Project a collection's write volume onto the analyzed read workload
+
+    $collStats latencyStats gives the collection's read/write ratio; serverStatus opcounters split writes into
+    inserts, updates and deletes. The result is the write traffic expected while the workload's reads happen.
+    """
+    latency = collection_stats.get("latencyStats", {})
+    reads = latency.get("reads", {}).get("ops", 0)
+    writes = latency.get("writes", {}).get("ops", 0)
+
+    write_mix = new_write_mix("collStats")
+    if not writes:
+        return write_mix
+
+    expected_writes = workload_reads * writes / max(reads, 1)
+    server_writes = sum(opcounters.get(op_type, 0) for op_type in WRITE_OPS)
+
+    for op_type in WRITE_OPS:
+        share = opcounters.get(op_type, 0) / server_writes if server_writes else 1 / len(WRITE_OPS)
+        write_mix[op_type] = expected_writes * share
+
+    return write_mix
+
+
+class WriteCostModel:
+    def __init__(self, key_write_cost_ms=0.02, default_update_touch_ratio=0.5):
+        self.key_write_cost_ms = key_write_cost_ms
+        self.default_update_touch_ratio = default_update_touch_ratio
+
+    def keys_per_document(self, index_fields, field_stats=None):
+        """Index entries written per document, multiplied out for the (single) multikey field"""
+        keys = 1.0
+        for field in index_fields:
+            stats = (field_stats or {}).get(field)
+            if stats and stats["is_array"]:
+                keys *= max(stats["avg_array_length"], 1)
+
+        return keys
+
+    def update_touch_ratio(self, write_mix, index_fields):
+        update_fields = write_mix.get("update_fields")
+        observed_updates = sum(update_fields.values()) if update_fields else 0
+
+        if not observed_updates:
+            return self.default_update_touch_ratio
+
+        touching = sum(count for field, count in update_fields.items() if touches_index([field], index_fields))
+        return min(touching / max(write_mix.get("update", 0), 1), 1.0)
+
+    def maintenance_cost_ms(self, index_fields, write_mix, field_stats=None):
+        """Estimated time the write path spends maintaining an index over the write mix"""
+        if not write_mix:
+            return 0.0
+
+        keys = self.keys_per_document(index_fields, field_stats)
+        key_writes = keys * (write_mix.get("insert", 0) + write_mix.get("delete", 0))
+        # Changing an indexed value removes the old key and inserts the new one
+        key_writes += 2 * keys * write_mix.get("update", 0) * self.update_touch_ratio(write_mix, index_fields)
+
+        return key_writes * self.key_write_cost_ms